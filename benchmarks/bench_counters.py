@@ -0,0 +1,71 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение get_counters с прежней реализацией (re.match('.*правило.*') по каждому правилу).
+
+Запуск из корня проекта: ./benchmarks/bench_counters.py
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from source.lib import COUNTER_RULES, get_counters
+
+LEGACY_COUNTER_TYPES = [
+    (counter_name, re.compile(r'.*' + pattern + r'.*', re.I + re.S))
+    for counter_name, pattern in COUNTER_RULES
+]
+
+CHUNKS = (
+    '<div class="item">', 'lorem ipsum dolor sit amet ', '<script src="/static/app.js"></script>',
+    '<a href="http://example.com/a/b">link</a>', 'google ', 'mail.ru ', 'counter ', '\n',
+)
+COUNTERS = (
+    '<script src="//mc.yandex.ru/metrika/watch.js"></script>',
+    '<img src="//top-fwz1.mail.ru/counter?id=1">',
+    '<script src="http://www.google-analytics.com/ga.js"></script>',
+)
+
+
+def legacy_get_counters(content):
+    counters = []
+    for counter_name, regexp in LEGACY_COUNTER_TYPES:
+        if re.match(regexp, content):
+            counters.append(counter_name)
+    return counters
+
+
+def make_page(size, with_counters):
+    random.seed(size)
+    parts = []
+    length = 0
+    while length < size:
+        chunk = random.choice(CHUNKS)
+        parts.append(chunk)
+        length += len(chunk)
+    if with_counters:
+        for counter in COUNTERS:
+            parts.insert(random.randint(0, len(parts)), counter)
+    return ''.join(parts)
+
+
+def main():
+    print '{:>10} {:>9} {:>12} {:>12} {:>8}'.format('size', 'counters', 'legacy, ms', 'new, ms', 'speedup')
+    for size in (10 * 1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024):
+        for with_counters in (False, True):
+            page = make_page(size, with_counters)
+            assert legacy_get_counters(page) == get_counters(page)
+            number = max(1, 10 * 1024 * 1024 // size)
+            legacy = min(timeit.repeat(lambda: legacy_get_counters(page), number=number, repeat=3)) / number
+            new = min(timeit.repeat(lambda: get_counters(page), number=number, repeat=3)) / number
+            print '{:>10} {:>9} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                size, with_counters, legacy * 1000, new * 1000, legacy / new
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение prepare_url с прежней реализацией (без запоминания и быстрого пути).
+
+Проверяет, что на наборе урлов результат не изменился, и замеряет время
+первого прохода по урлам (память очищена перед проходом) и повторного.
+
+Запуск из корня проекта: ./benchmarks/bench_prepare_url.py
+"""
+import logging
+import os
+import random
+import sys
+import timeit
+from urllib import quote, quote_plus
+from urlparse import urlparse, urlunparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from source.lib import clear_url_memo, prepare_url, to_str, to_unicode
+
+HOSTS = (
+    'example.com', 'www.example.com', 'click.tracker.net', 'bit.ly', 'r.mail.ru', 'EXAMPLE.ORG:8080',
+    u'пример.рф', u'кто.рф', 'user:pass@secure.example.com', 'a..b',
+)
+PATHS = (
+    '', '/', '/landing', '/a/b/c-d_e.html', '/go/12345', "/p/!$*'(),+%20", '/a b', '/a:b', u'/путь/к/странице',
+    '/x;params=1', '/x;a b', '/a~b', '/a#frag',
+)
+QUERIES = ('', '?', '?utm_source=ad&utm_campaign=summer', '?q=a b', u'?q=значение', '?next=http://example.com/')
+
+
+def legacy_prepare_url(url):
+    if url is None:
+        return url
+    scheme, netloc, path, qs, anchor, fragments = urlparse(
+        to_unicode(url),
+        allow_fragments=False
+    )
+    try:
+        netloc = netloc.encode('idna')
+    except UnicodeError:
+        pass
+    path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
+    qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
+    return urlunparse((scheme, netloc, path, qs, anchor, fragments))
+
+
+def make_urls(count, unique):
+    """Урлы с повторяющимися хостами, из них unique различных"""
+    random.seed(count + unique)
+    urls = []
+    for i in xrange(unique):
+        url = u'{}://{}{}{}'.format(
+            random.choice(('http', 'https', 'HTTP')), random.choice(HOSTS), random.choice(PATHS),
+            random.choice(QUERIES)
+        )
+        if random.random() < 0.3:
+            url += u'&id={}'.format(i)
+        if random.random() < 0.5 and all(ord(c) < 128 for c in url):
+            url = url.encode('utf8')
+        urls.append(url)
+    return [random.choice(urls) for _ in xrange(count)]
+
+
+def check(urls):
+    for url in urls:
+        assert legacy_prepare_url(url) == prepare_url(url), url
+        clear_url_memo()
+        assert legacy_prepare_url(url) == prepare_url(url), url
+
+
+def run_first(urls):
+    clear_url_memo()
+    for url in urls:
+        prepare_url(url)
+
+
+def run_again(urls):
+    for url in urls:
+        prepare_url(url)
+
+
+def run_legacy(urls):
+    for url in urls:
+        legacy_prepare_url(url)
+
+
+def main():
+    # "encode exception" для заведомо плохих хостов
+    logging.getLogger('redirect_checker').disabled = True
+
+    print '{:>8} {:>8} {:>12} {:>12} {:>12} {:>8}'.format(
+        'urls', 'unique', 'legacy, us', 'first, us', 'again, us', 'speedup'
+    )
+    for count, unique in ((10000, 100), (10000, 1000), (10000, 10000)):
+        urls = make_urls(count, unique)
+        check(urls)
+        legacy = min(timeit.repeat(lambda: run_legacy(urls), number=1, repeat=3)) / count
+        first = min(timeit.repeat(lambda: run_first(urls), number=1, repeat=3)) / count
+        again = min(timeit.repeat(lambda: run_again(urls), number=1, repeat=3)) / count
+        print '{:>8} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            count, unique, legacy * 1e6, first * 1e6, again * 1e6, legacy / first
+        )
+
+
+if __name__ == '__main__':
+    main()
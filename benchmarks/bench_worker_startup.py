@@ -0,0 +1,86 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Время от запуска воркеров (spawn_workers) до того, как каждый из них берет первую задачу,
+без прогрева супервизора (preload_worker) и с ним, для обоих режимов воркеров.
+
+Каждый замер - в отдельном интерпретаторе, чтобы прогрев одного замера не достался другому.
+Очереди подменены: первый take записывает время и завершает воркер, tarantool не нужен.
+
+Запуск из корня проекта: ./benchmarks/bench_worker_startup.py
+"""
+import logging
+import os
+import subprocess
+import sys
+from time import time
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+
+WORKERS = 4
+REPEAT = 5
+
+
+class FakeQueue(object):
+    host, port, space = 'localhost', 0, 0
+
+
+class FakeTube(object):
+    """Очередь, первый take из которой сообщает время в pipe и завершает воркер"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.queue = FakeQueue()
+        self.opt = {'tube': 'bench'}
+
+    def take(self, timeout):
+        os.write(self.fd, '{!r}\n'.format(time()))
+        os._exit(0)
+
+
+def measure(mode, preload):
+    """
+    :return: время до первой задачи каждого воркера в мс, по возрастанию
+    """
+    from lib import CheckContext, worker
+    from lib.utils import Config, load_config_from_pyfile, spawn_workers
+
+    config = Config()
+    config.__dict__.update(load_config_from_pyfile(os.path.join(SOURCE_DIR, 'config', 'checker_config.py')).__dict__)
+    config.WORKER_MODE = mode
+    config.EVENT_LOOP_PROCESSES = WORKERS
+    read_fd, write_fd = os.pipe()
+    worker.get_tube = lambda **kwargs: FakeTube(write_fd)
+    target, _ = worker.get_worker(config)
+
+    if preload:
+        worker.preload_worker(config)
+    started = time()
+    spawn_workers(num=WORKERS, target=target, args=(config, CheckContext()), parent_pid=os.getpid())
+    data = ''
+    while data.count('\n') < WORKERS:
+        data += os.read(read_fd, 4096)
+    return sorted((float(line) - started) * 1000 for line in data.split())
+
+
+def main():
+    if len(sys.argv) == 3:
+        logging.getLogger('redirect_checker').disabled = True
+        print ' '.join('{:.1f}'.format(ms) for ms in measure(sys.argv[1], sys.argv[2] == 'preload'))
+        return
+
+    print 'workers per run: {}, runs: {}'.format(WORKERS, REPEAT)
+    print '{:>8} {:>10} {:>14} {:>14}'.format('mode', 'preload', 'median, ms', 'slowest, ms')
+    for mode in ('process', 'gevent'):
+        for preload in ('cold', 'preload'):
+            times = []
+            for _ in xrange(REPEAT):
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), mode, preload])
+                times.extend(float(ms) for ms in output.split())
+            times.sort()
+            print '{:>8} {:>10} {:>14.1f} {:>14.1f}'.format(mode, preload, times[len(times) // 2], times[-1])
+
+
+if __name__ == '__main__':
+    main()
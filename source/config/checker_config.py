@@ -12,17 +12,84 @@ OUTPUT_QUEUE_SPACE = 0
 
 OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
+WORKER_MODE = 'process'
 WORKER_POOL_SIZE = 10
+EVENT_LOOP_PROCESSES = 1
 QUEUE_TAKE_TIMEOUT = 0.1
+QUEUE_BATCH_SIZE = 10
+QUEUE_FLUSH_INTERVAL = 1
+QUEUE_TASK_TTR = 60
+DRAIN_TIMEOUT = 5
+
+AUTOSCALE = True
+AUTOSCALE_MIN_WORKERS = 2
+AUTOSCALE_MAX_WORKERS = 30
+AUTOSCALE_DRAIN_TIME = 60
+AUTOSCALE_TARGET_UTILIZATION = 0.8
+AUTOSCALE_UP_CHECKS = 2
+AUTOSCALE_DOWN_CHECKS = 6
+AUTOSCALE_STEP = 4
+AUTOSCALE_MAX_LOAD = 2.0
+AUTOSCALE_MAX_RSS_MB = 2048
 
 SLEEP = 10
 
 HTTP_TIMEOUT = 3
 MAX_REDIRECTS = 30
 RECHECK_DELAY = 300
+HOP_RETRIES = 2
+HOP_RETRY_DELAY = 0.5
+HOP_RETRY_MAX_DELAY = 4
+HTTP_HEAD_BYTES_LIMIT = 64 * 1024
+HTTP_BODY_BYTES_LIMIT = 4 * 1024 * 1024
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
-CHECK_URL = "http://t.mail.ru"
+CURL_POOL_SIZE = 10
+CURL_POOL_SHARE_COOKIES = False
+CURL_POOL_SHARE_DNS = True
+CURL_POOL_SHARE_SSL = True
+
+ENGINE_CONCURRENCY = 100
+ENGINE_HOST_CONCURRENCY = 4
+ENGINE_IP_CONCURRENCY = 8
+
+STATS_INTERVAL = 60
+
+RESULT_CACHE_SLOTS = 8192
+RESULT_CACHE_SLOT_SIZE = 4096
+RESULT_CACHE_TTL = 600
+
+HOP_CACHE_SLOTS = 16384
+HOP_CACHE_SLOT_SIZE = 1024
+HOP_CACHE_TTL = 60
+
+DNS_CACHE_SLOTS = 4096
+DNS_CACHE_SLOT_SIZE = 512
+DNS_CACHE_TTL = 300
+DNS_PREFETCH_THREADS = 2
+
+INFLIGHT_CACHE_SLOTS = 1024
+INFLIGHT_CACHE_SLOT_SIZE = 4096
+INFLIGHT_CACHE_TTL = 30
+
+COUNTER_RULES = (
+    ('GOOGLE_ANALYTICS', r'google-analytics\.com/ga\.js'),
+    ('YA_METRICA', r'mc\.yandex\.ru/metrika/watch\.js'),
+    ('TOP_MAIL_RU', r'top-fwz1\.mail\.ru/counter'),
+    ('TOP_MAIL_RU', r'top\.mail\.ru/jump\?from'),
+    ('DOUBLECLICK', r'//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion'),
+    ('VISUALDNA', r'//a1\.vdna-assets\.com/analytics\.js'),
+    ('LI_RU', r'/counter\.yadro\.ru/hit'),
+    ('RAMBLER_TOP100', r'counter\.rambler\.ru/top100'),
+)
+
+NETWORK_CHECK_URLS = ("http://t.mail.ru", "http://mail.ru", "http://ya.ru")
+NETWORK_CHECK_TIMEOUT = 1
+NETWORK_CHECK_INTERVAL = 2
+NETWORK_CHECK_DOWN_CHECKS = 3
+NETWORK_CHECK_UP_CHECKS = 2
+NETWORK_CHECK_MAX_ERROR_RATE = 0.9
+NETWORK_CHECK_MIN_FETCHES = 20
 
 LOGGING = {
     'version': 1,
@@ -6,13 +6,37 @@ QUEUE_PORT = 33013
 QUEUE_SPACE = 0
 QUEUE_TAKE_TIMEOUT = 0.1
 QUEUE_TUBE = 'api.push_notifications'
+QUEUE_TAKERS = 2
+QUEUE_PREFETCH = 5
+QUEUE_PREFETCH_MAX_AGE = 10
+ACK_BATCH_SIZE = 100
 
 HTTP_CONNECTION_TIMEOUT = 30
-SLEEP = 0.1
 SLEEP_ON_FAIL = 10
 
 WORKER_POOL_SIZE = 10
 
+HTTP_POOL_HOSTS = 100
+HTTP_POOL_HOST_SIZE = 0
+HTTP_POOL_WAIT_TIMEOUT = 10
+
+HOST_MAX_SHARE = 0.5
+HOST_DEFER_DELAY = 5
+BREAKER_WINDOW = 30
+BREAKER_MIN_REQUESTS = 10
+BREAKER_MAX_ERROR_RATE = 0.5
+BREAKER_OPEN_TIMEOUT = 30
+
+RETRY_MAX_ATTEMPTS = 5
+RETRY_DELAY = 10
+RETRY_MAX_DELAY = 600
+
+BATCH_CALLBACK_URLS = ()
+BATCH_WINDOW = 0.5
+BATCH_MAX_SIZE = 100
+
+STATS_INTERVAL = 60
+
 LOGGING = {
     'version': 1,
     'formatters': {
@@ -2,12 +2,16 @@
 from StringIO import StringIO
 from logging import getLogger, NullHandler
 import re
+import time
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
 
 from bs4 import BeautifulSoup
 import pycurl
 
+from .meta import MetaTagScanner, find_first_meta
+from .stats import stats as checker_stats
+
 logger = getLogger('redirect_checker')
 logger.addHandler(NullHandler())
 
@@ -18,16 +22,19 @@ OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.
 OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
 MM_URL = re.compile(r'http(?:s)?://my\.mail\.ru/apps/', re.I)
 
-COUNTER_TYPES = (
-    ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I + re.S)),
-    ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I + re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top-fwz1\.mail\.ru/counter.*', re.I + re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top\.mail\.ru/jump\?from.*', re.I + re.S)),
-    ('DOUBLECLICK', re.compile(r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*', re.I + re.S)),
-    ('VISUALDNA', re.compile(r'.*//a1\.vdna-assets\.com/analytics\.js.*', re.I + re.S)),
-    ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I + re.S)),
-    ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I + re.S))
+COUNTER_RULES = (
+    ('GOOGLE_ANALYTICS', r'google-analytics\.com/ga\.js'),
+    ('YA_METRICA', r'mc\.yandex\.ru/metrika/watch\.js'),
+    ('TOP_MAIL_RU', r'top-fwz1\.mail\.ru/counter'),
+    ('TOP_MAIL_RU', r'top\.mail\.ru/jump\?from'),
+    ('DOUBLECLICK', r'//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion'),
+    ('VISUALDNA', r'//a1\.vdna-assets\.com/analytics\.js'),
+    ('LI_RU', r'/counter\.yadro\.ru/hit'),
+    ('RAMBLER_TOP100', r'counter\.rambler\.ru/top100')
 )
+"""Правила поиска счетчиков: имя счетчика и регулярное выражение, найденное в любом месте страницы"""
+
+LITERAL_PATTERN = re.compile(r'^(?:[^.^$*+?{}\[\]|()\\]|\\[^A-Za-z0-9])*$')
 
 
 def to_unicode(val, errors='strict'):
@@ -44,27 +51,59 @@ def to_str(val, errors='strict'):
         return val
 
 
-def get_counters(content):
+class CounterDetector(object):
+    """
+    Ищет счетчики в хтмл-странице по таблице правил (имя счетчика, регулярное выражение).
+
+    Правила без метасимволов ищутся как подстроки в странице, приведенной к
+    нижнему регистру, остальные - через re.search. Страница не сканируется
+    заново с бэктрекингом, как при re.match('.*правило.*').
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        for counter_name, pattern in rules:
+            if LITERAL_PATTERN.match(pattern):
+                literal = re.sub(r'\\(.)', r'\1', pattern).lower()
+                self.rules.append((counter_name, literal, None))
+            else:
+                self.rules.append((counter_name, None, re.compile(pattern, re.I + re.S)))
+        self.has_literals = any(literal is not None for _, literal, _ in self.rules)
+
+    def detect(self, content):
+        """
+        :return: имена найденных счетчиков в порядке правил
+        """
+        lowered = content.lower() if self.has_literals else None
+        counters = []
+        for counter_name, literal, regexp in self.rules:
+            if literal is not None:
+                found = literal in lowered
+            else:
+                found = regexp.search(content) is not None
+            if found:
+                counters.append(counter_name)
+        return counters
+
+
+DEFAULT_COUNTER_DETECTOR = CounterDetector(COUNTER_RULES)
+
+
+def get_counters(content, detector=DEFAULT_COUNTER_DETECTOR):
     """
     Ищет в хтмл-странице счетичик и возвращает массив типов найденных
     """
-    counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
-            counters.append(counter_name)
-    return counters
+    return detector.detect(content)
 
 
-def check_for_meta(content, url):
+def meta_refresh_url(attrs, url):
     """
-    Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
+    Возвращает урл редиректа по атрибутам мета-тега, если это мета-редирект
     """
-    soup = BeautifulSoup(content, "html.parser")
-    result = soup.find("meta")
-    if result and 'content' in result.attrs:
-        for attr, value in result.attrs.items():
+    if 'content' in attrs:
+        for attr, value in attrs.items():
             if attr == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
+                splitted = attrs['content'].split(";")
                 if len(splitted) != 2:
                     return
                 wait, text = splitted
@@ -75,6 +114,31 @@ def check_for_meta(content, url):
                     return urljoin(url, to_unicode(meta_url, 'ignore'))
 
 
+def check_for_meta(content, url):
+    """
+    Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
+
+    Смотрит только первый мета-тег в начале страницы, страница разбирается потоково
+    до него. Полный разбор в BeautifulSoup - только если потоковый не справился.
+    """
+    attrs, failed = find_first_meta(content)
+    if failed:
+        checker_stats.incr('meta.soup_fallback')
+        return check_for_meta_with_soup(content, url)
+    if attrs:
+        return meta_refresh_url(attrs, url)
+
+
+def check_for_meta_with_soup(content, url):
+    """
+    То же, что check_for_meta, с разбором всей страницы в BeautifulSoup
+    """
+    soup = BeautifulSoup(content, "html.parser")
+    result = soup.find("meta")
+    if result:
+        return meta_refresh_url(result.attrs, url)
+
+
 PREFIX_GOOGLE_MARKET = 'http://play.google.com/store/apps/'
 
 
@@ -83,26 +147,204 @@ def fix_market_url(url):
     return PREFIX_GOOGLE_MARKET + url.lstrip("market://")
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+class BodyBuffer(object):
+    """
+    Буфер тела ответа с ограничением размера.
 
+    Пока неизвестно, конечная ли это страница, читается не больше head_limit байт:
+    ответ с http-редиректом или страница с мета-редиректом - промежуточный хоп,
+    которому тело не нужно. Страница без мета-редиректа считается конечной,
+    для нее (ради счетчиков) читается до body_limit байт. Сверх лимита передача
+    прерывается. Лимит None - без ограничения.
+
+    У прерванной передачи curl не отдает REDIRECT_URL, поэтому урл из Location
+    запоминается в redirect_url.
     """
-    prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
-    curl.setopt(curl.URL, prepared_url)
+
+    def __init__(self, url, head_limit=None, body_limit=None, resolver=None):
+        self.url = url
+        self.head_limit = head_limit
+        self.body_limit = body_limit
+        self.resolver = resolver
+        self.buff = StringIO()
+        self.scanner = MetaTagScanner() if head_limit is not None else None
+        self.http_redirect = False
+        self.redirect_url = None
+        self.keep = True
+        self.limit = head_limit
+        self.size = 0
+        self.received = 0
+        self.aborted = False
+
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            status = line.split(None, 2)[1:2]
+            self.http_redirect = bool(status) and status[0].startswith('3')
+            self.redirect_url = None
+        elif self.http_redirect and line[:9].lower() == 'location:':
+            self.redirect_url = urljoin(self.url, to_unicode(line[9:].strip(), 'ignore'))
+            self.scanner = None
+            prefetch_host(self.redirect_url, self.resolver)
+
+    def write(self, data):
+        self.received += len(data)
+        offset = 0
+        while self.keep and offset < len(data):
+            chunk = data[offset:] if self.limit is None else data[offset:offset + self.limit - self.size]
+            offset += len(chunk)
+            self.buff.write(chunk)
+            self.size += len(chunk)
+            if self.scanner is not None:
+                self._scan(chunk)
+            if self.limit is not None and self.size >= self.limit:
+                self.keep = False
+        if self.limit is not None and self.received > self.limit:
+            self.aborted = True
+            return 0
+
+    def _scan(self, chunk):
+        if self.scanner.feed(chunk) and not self.scanner.failed:
+            refresh_url = self.scanner.attrs and meta_refresh_url(self.scanner.attrs, self.url)
+            if not refresh_url:
+                self.limit = self.body_limit
+            else:
+                self.keep = False
+                prefetch_host(refresh_url, self.resolver)
+            self.scanner = None
+        elif self.size >= self.head_limit:
+            self.limit = self.body_limit
+            self.scanner = None
+
+    def getvalue(self):
+        return self.buff.getvalue()
+
+
+class CheckContext(object):
+    """
+    Окружение проверки редиректов, передается в get_redirect_history явно.
+
+    + handle_pool - пул curl-хэндлов воркера (CurlPool), без него на каждый запрос создается новый хэндл
+    + resolver - разрешение имен с общим для воркеров кэшем адресов (DnsResolver), без него DNS разрешает curl
+    + performer - кооперативное выполнение запросов (GeventCurlPerformer), без него запрос блокирует процесс
+    + retry_policy - повтор хопов с временными ошибками сети (RetryPolicy), без нее хоп не повторяется
+    + result_cache - общий для воркеров кэш результатов проверки по нормализованному урлу (SharedCache)
+    + hop_cache - общий для воркеров кэш хопов: урл -> (следующий урл, тип редиректа, счетчики конечной страницы)
+    + inflight_cache - общий для воркеров реестр урлов, проверяемых сейчас (SharedCache): урл -> (результат или None,)
+    + counter_detector - поиск счетчиков на конечной странице (CounterDetector)
+    + head_limit, body_limit - лимиты размера тела ответа: для промежуточных хопов и для конечной страницы
+      (см. BodyBuffer)
+    + interrupt_check - вызывается перед каждым запросом, может прервать проверку исключением
+      (Drain.check_deadline)
+
+    Не заданный кэш выключен.
+    """
+
+    def __init__(self, handle_pool=None, resolver=None, performer=None, retry_policy=None, result_cache=None,
+                 hop_cache=None, inflight_cache=None, counter_detector=DEFAULT_COUNTER_DETECTOR,
+                 head_limit=None, body_limit=None, interrupt_check=None):
+        self.handle_pool = handle_pool
+        self.resolver = resolver
+        self.performer = performer
+        self.retry_policy = retry_policy
+        self.result_cache = result_cache
+        self.hop_cache = hop_cache
+        self.inflight_cache = inflight_cache
+        self.counter_detector = counter_detector
+        self.head_limit = head_limit
+        self.body_limit = body_limit
+        self.interrupt_check = interrupt_check
+
+
+DEFAULT_CONTEXT = CheckContext()
+"""Окружение по умолчанию: без пула, кэшей, повторов и лимитов. Не изменяется."""
+
+
+def create_body_buffer(url, context=DEFAULT_CONTEXT):
+    """
+    Буфер для ответа на запрос url с лимитами из context
+
+    :rtype: BodyBuffer
+    """
+    return BodyBuffer(url, context.head_limit, context.body_limit, context.resolver)
+
+
+def prefetch_host(url, resolver):
+    """Начинает заранее разрешать хост урла, на который ведет редирект"""
+    if resolver is not None:
+        resolver.prefetch(to_str(prepare_url(url), 'ignore'))
+
+
+def get_host_address(url, resolver, blocking=True):
+    """
+    :param blocking: можно ли ждать DNS, если адреса нет в кэше resolver
+    :return: ip-адрес хоста урла или None, если адрес неизвестен
+    """
+    if resolver is None:
+        return None
+    return resolver.address(url, blocking)
+
+
+def prepare_curl(curl, url, timeout, buff, useragent=None, resolver=None, blocking=True):
+    """
+    Настраивает curl-хэндл на запрос одного урла (без перехода по редиректам)
+
+    :param blocking: можно ли ждать DNS, если адреса нет в кэше resolver (иначе хост разрешает curl)
+    """
+    curl.setopt(curl.URL, url)
+    if resolver is not None:
+        resolve = resolver.curl_resolve(url, blocking)
+        if resolve:
+            curl.setopt(curl.RESOLVE, resolve)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
-    curl.setopt(curl.WRITEDATA, buff)
+    curl.setopt(curl.WRITEFUNCTION, buff.write)
+    curl.setopt(curl.HEADERFUNCTION, buff.header)
     curl.setopt(curl.FOLLOWLOCATION, False)
     # curl.setopt(curl.CONNECTTIMEOUT, timeout)
     curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
-    content = buff.getvalue()
-    redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
+
+
+def perform(curl, performer=None, host=None, ip=None):
+    if performer is None:
+        curl.perform()
+    else:
+        performer.perform(curl, host, ip)
+
+
+def get_url_host(url):
+    try:
+        return urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+
+
+def make_pycurl_request(url, timeout, useragent=None, context=DEFAULT_CONTEXT):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа и возможный редирект
+    :return: содержимое ответа, урл редиректа
+
+    """
+    prepared_url = to_str(prepare_url(url), 'ignore')
+    buff = create_body_buffer(url, context)
+    handle_pool = context.handle_pool
+    curl = handle_pool.acquire() if handle_pool else pycurl.Curl()
+    try:
+        prepare_curl(curl, prepared_url, timeout, buff, useragent, context.resolver)
+        host = ip = None
+        if context.performer is not None:
+            host, ip = get_url_host(prepared_url), get_host_address(prepared_url, context.resolver)
+        try:
+            perform(curl, context.performer, host, ip)
+        except pycurl.error:
+            if not buff.aborted:
+                raise
+        content = buff.getvalue()
+        redirect_url = curl.getinfo(curl.REDIRECT_URL) or buff.redirect_url
+    finally:
+        if handle_pool:
+            handle_pool.release(curl)
+        else:
+            curl.close()
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
     return content, redirect_url
@@ -113,17 +355,73 @@ ERROR_REDIRECT = 'ERROR'
 MARKET_SCHEME = 'market'
 
 
-def get_url(url, timeout, user_agent=None):
+def get_url(url, timeout, user_agent=None, context=DEFAULT_CONTEXT):
     """
     :return: урл, тип редиректа, содержимое страницы (если есть)
     """
     content = None
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
+        content, new_redirect_url = make_request_with_retries(url, timeout, user_agent, context)
     except (pycurl.error, ValueError) as e:
         logger.error(u'error in url {} {}'.format(url, e))
         return url, ERROR_REDIRECT, content  # TODO add exception in ERROR
 
+    return process_response(url, content, new_redirect_url)
+
+
+def make_request_with_retries(url, timeout, user_agent=None, context=DEFAULT_CONTEXT):
+    """
+    make_pycurl_request, временные ошибки которого повторяются по context.retry_policy.
+    Пауза перед повтором - time.sleep, в gevent-воркере он кооперативный.
+
+    :raises: pycurl.error, ValueError - ошибка последней попытки
+    """
+    attempt = 0
+    while True:
+        try:
+            response = make_pycurl_request(url, timeout, user_agent, context)
+        except (pycurl.error, ValueError) as e:
+            delay = get_retry_delay(url, attempt, e, context.retry_policy)
+            if delay is None:
+                raise
+            attempt += 1
+            time.sleep(delay)
+            check_interrupt(context)
+        else:
+            if attempt:
+                checker_stats.incr('retry.success')
+            return response
+
+
+def check_interrupt(context):
+    if context.interrupt_check is not None:
+        context.interrupt_check()
+
+
+def get_retry_delay(url, attempt, error, retry_policy):
+    """
+    Решает по retry_policy, повторять ли хоп, и учитывает решение в статистике.
+
+    :param attempt: сколько повторов хопа уже сделано
+    :param error: ошибка последней попытки
+    :param retry_policy: RetryPolicy или None - не повторять
+    :return: пауза перед повтором в секундах или None, если хоп не повторяется
+    """
+    if retry_policy is None or not retry_policy.should_retry(attempt, error):
+        if attempt:
+            checker_stats.incr('retry.exhausted')
+        return None
+    delay = retry_policy.delay(attempt)
+    checker_stats.incr('retry.attempt')
+    logger.info(u'retry #{} of url {} in {:.2f}s after {}'.format(attempt + 1, url, delay, error))
+    return delay
+
+
+def process_response(url, content, new_redirect_url):
+    """
+    Определяет редирект по ответу на запрос url
+    :return: урл, тип редиректа, содержимое страницы (если есть)
+    """
     redirect_type = None
 
     # ignoring ok login redirects
@@ -141,7 +439,171 @@ def get_url(url, timeout, user_agent=None):
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+class RedirectChain(object):
+    """
+    Состояние проверки цепочки редиректов одного урла
+    """
+
+    def __init__(self, url, max_redirects=30, context=DEFAULT_CONTEXT):
+        self.url = prepare_url(url)
+        self.max_redirects = max_redirects
+        self.context = context
+        self.history_types = []
+        self.history_urls = [self.url]
+        self.redirect_url = self.url
+        self.content = None
+        self.counters = None
+        self.final_url = None
+        # ignore mm / ok domains
+        self.finished = bool(re.match(MM_URL, self.url) or re.match(OK_URL, self.url))
+
+    def add_hop(self, redirect_url, redirect_type, content):
+        """
+        Добавляет результат очередного хопа (см. get_url)
+        :return: True, если проверка цепочки завершена
+        """
+        self.content = content
+        if not redirect_url:
+            self.final_url = self.redirect_url
+            self.finished = True
+            return self.finished
+
+        if redirect_type != ERROR_REDIRECT:
+            cache_hop(self.redirect_url, (redirect_url, redirect_type, None), self.context.hop_cache)
+        return self._follow(redirect_url, redirect_type)
+
+    def add_cached_hops(self):
+        """
+        Проходит по хопам, уже известным из кэша хопов.
+        :return: True, если проверка цепочки завершена
+        """
+        while not self.finished:
+            hop = get_cached_hop(self.redirect_url, self.context.hop_cache)
+            if hop is None:
+                break
+            redirect_url, redirect_type, counters = hop
+            self.content = None
+            if redirect_url is None:
+                self.counters = counters
+                self.finished = True
+            else:
+                self._follow(redirect_url, redirect_type)
+        return self.finished
+
+    def _follow(self, redirect_url, redirect_type):
+        self.redirect_url = redirect_url
+        self.history_types.append(redirect_type)
+        self.history_urls.append(redirect_url)
+
+        if redirect_type == ERROR_REDIRECT:
+            self.finished = True
+        elif len(self.history_urls) > self.max_redirects or (redirect_url in self.history_urls[:-1]):
+            self.finished = True
+        return self.finished
+
+    def result(self):
+        """
+        :return: типы редиректов, урлы редиректов, счетчики на конечном урле
+        """
+        if self.counters is None:
+            self.counters = get_counters(self.content, self.context.counter_detector) if self.content else []
+            if self.final_url is not None:
+                cache_hop(self.final_url, (None, None, self.counters), self.context.hop_cache)
+        return self.history_types, self.history_urls, self.counters
+
+
+def get_cached_history(url, result_cache):
+    """
+    :param url: нормализованный урл (см. prepare_url)
+    :return: закэшированный результат get_redirect_history или None
+    """
+    if result_cache is None:
+        return None
+    return result_cache.get(to_str(url))
+
+
+def cache_history(url, result, result_cache):
+    """
+    Кладет результат проверки в кэш. Результаты с ошибками не кэшируются.
+    """
+    history_types = result[0]
+    if result_cache is not None and ERROR_REDIRECT not in history_types:
+        result_cache.set(to_str(url), result)
+
+
+INFLIGHT_POLL_INTERVAL = 0.05
+INFLIGHT_DONE_TTL = 2
+"""Сколько секунд законченная проверка хранится в реестре для воркеров, ждущих ее результат"""
+
+
+def claim_url(url, inflight_cache):
+    """
+    Отмечает урл как проверяемый этим воркером. Отметка снимается finish_url
+    или истекает через TTL реестра, если воркер пропал.
+
+    :param url: нормализованный урл (см. prepare_url)
+    :return: True, если урл никто другой не проверяет (или реестр выключен)
+    """
+    if inflight_cache is None:
+        return True
+    return inflight_cache.add(to_str(url), (None,))
+
+
+def wait_for_history(url, inflight_cache, result_cache):
+    """
+    Ждет результат проверки урла другим воркером, но не дольше TTL реестра.
+
+    :return: результат get_redirect_history или None, если проверка прервана или не закончилась
+    """
+    key = to_str(url)
+    started = time.time()
+    deadline = started + inflight_cache.ttl
+    try:
+        while time.time() < deadline:
+            entry = inflight_cache.get(key)
+            if entry is None:
+                return get_cached_history(url, result_cache)
+            if entry[0] is not None:
+                return entry[0]
+            time.sleep(INFLIGHT_POLL_INTERVAL)
+        return None
+    finally:
+        checker_stats.timing('coalesce.wait', time.time() - started)
+
+
+def finish_url(url, result, inflight_cache):
+    """
+    Снимает отметку claim_url и на INFLIGHT_DONE_TTL оставляет результат ждущим его воркерам.
+    Если результат не помещается в слот реестра, отметка просто удаляется:
+    ждущие возьмут результат из кэша результатов или проверят урл сами.
+
+    :param result: результат проверки, None - проверка прервана
+    """
+    if inflight_cache is None:
+        return
+    if result is None or not inflight_cache.set(to_str(url), (result,), INFLIGHT_DONE_TTL):
+        inflight_cache.delete(to_str(url))
+
+
+def get_cached_hop(url, hop_cache):
+    """
+    :return: закэшированный хоп (см. cache_hop) или None
+    """
+    if hop_cache is None:
+        return None
+    return hop_cache.get(to_str(url))
+
+
+def cache_hop(url, hop, hop_cache):
+    """
+    Кладет хоп в кэш. Для редиректа hop = (следующий урл, тип редиректа, None),
+    для конечной страницы - (None, None, счетчики на странице).
+    """
+    if hop_cache is not None:
+        hop_cache.set(to_str(url), hop)
+
+
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, context=DEFAULT_CONTEXT):
     """
     Входные параметры:
 
@@ -149,6 +611,7 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     + timeout - таймаут на проверку *одного* урла
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
+    + context - окружение проверки (CheckContext): пул хэндлов, кэши, повторы
 
 
     Выходные параметры:
@@ -158,52 +621,91 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     2. урлы редиректов (включая конечный)
     3. установленные счетчики на конечном урле
 
+    Если тот же урл сейчас проверяет другой воркер, ждет и возвращает его результат.
     """
-    url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
+    chain = RedirectChain(url, max_redirects, context)
+    result = get_cached_history(chain.url, context.result_cache)
+    if result is not None:
+        return result
+
+    owner = claim_url(chain.url, context.inflight_cache)
+    if not owner:
+        result = wait_for_history(chain.url, context.inflight_cache, context.result_cache)
+        if result is not None:
+            checker_stats.incr('coalesce.hit')
+            return result
+        checker_stats.incr('coalesce.miss')
+        owner = claim_url(chain.url, context.inflight_cache)
 
-    # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
+    try:
+        while not chain.add_cached_hops():
+            check_interrupt(context)
+            chain.add_hop(*get_url(
+                url=chain.redirect_url,
+                timeout=timeout,
+                user_agent=user_agent,
+                context=context
+            ))
+        result = chain.result()
+        cache_history(chain.url, result, context.result_cache)
+    finally:
+        if owner:
+            finish_url(chain.url, result, context.inflight_cache)
+    return result
 
-    content = None
-    while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
-            timeout=timeout,
-            user_agent=user_agent
-        )
-        if not redirect_url:
-            break
 
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
+URL_MEMO_SIZE = 10000
+"""Сколько урлов (и отдельно хостов) помнить для prepare_url, при переполнении память очищается"""
 
-        if redirect_type == ERROR_REDIRECT:
-            break
+SAFE_URL = re.compile(r"[A-Za-z][A-Za-z0-9+.\-]*://[^/?#]*[A-Za-z0-9_.\-/%+$!*'(),]*(?:\?.*)?\Z", re.S)
+"""Урл, путь которого состоит только из символов, не изменяемых quote, и без параметров (;)"""
+
+prepared_urls = {}
+idna_netlocs = {}
+
+
+def clear_url_memo():
+    prepared_urls.clear()
+    idna_netlocs.clear()
 
-        if len(history_urls) > max_redirects or (redirect_url in history_urls[:-1]):
-            break
 
-    counters = get_counters(content) if content else []
+def memoize(memo, key, value):
+    if len(memo) >= URL_MEMO_SIZE:
+        memo.clear()
+    memo[key] = value
 
-    return history_types, history_urls, counters
+
+def encode_netloc(netloc):
+    """Кодирование хоста в idna с запоминанием результата"""
+    encoded = idna_netlocs.get(netloc)
+    if encoded is None:
+        try:
+            encoded = netloc.encode('idna')
+        except UnicodeError:
+            logger.error("encode exception")
+            return netloc
+        memoize(idna_netlocs, netloc, encoded)
+    return encoded
 
 
 def prepare_url(url):
     """Нормализация урла"""
     if url is None:
         return url
+    prepared = prepared_urls.get(url)
+    if prepared is None:
+        prepared = normalize_url(url)
+        memoize(prepared_urls, url, prepared)
+    return prepared
+
+
+def normalize_url(url):
     scheme, netloc, path, qs, anchor, fragments = urlparse(
         to_unicode(url),
         allow_fragments=False
     )
-    try:
-        netloc = netloc.encode('idna')
-    except UnicodeError:
-        logger.error("encode exception")
-    path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
-    qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
+    netloc = encode_netloc(netloc)
+    if not SAFE_URL.match(url):
+        path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
+        qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
     return urlunparse((scheme, netloc, path, qs, anchor, fragments))
@@ -0,0 +1,168 @@
+# coding: utf-8
+import math
+from multiprocessing import RawArray
+import socket
+from time import time
+
+from tarantool.error import DatabaseError
+
+from .shared_cache import ProcessLock
+from .utils import get_load_per_cpu, get_rss
+
+
+class TaskMeter(object):
+    """
+    Сколько задач проверили воркеры и сколько времени на это ушло.
+
+    Счетчики в разделяемой памяти: метр создается супервизором до запуска
+    воркеров, воркеры (fork) пишут в него, супервизор читает. Блокировка -
+    ProcessLock: воркер, убитый посреди записи, не оставит метр занятым.
+    """
+
+    def __init__(self):
+        self.lock = ProcessLock()
+        self.values = RawArray('d', 2)
+
+    def record(self, seconds):
+        with self.lock:
+            self.values[0] += 1
+            self.values[1] += seconds
+
+    def snapshot(self):
+        """
+        :return: число задач и суммарное время их проверки в секундах
+        """
+        with self.lock:
+            return int(self.values[0]), self.values[1]
+
+
+def get_backlog(tube):
+    """
+    :return: сколько задач ждет во входной очереди или None, если узнать не удалось
+    """
+    try:
+        return int(tube.statistics()['tasks']['ready'])
+    except (DatabaseError, socket.error, KeyError, TypeError, ValueError):
+        return None
+
+
+class Autoscaler(object):
+    """
+    Размер пула воркеров по нагрузке, между min_workers и max_workers.
+
+    Нужное число воркеров - сколько их в среднем было занято проверкой
+    задач за период (время проверки / длительность периода) плюс сколько
+    нужно, чтобы разобрать очередь за drain_time при текущем времени
+    на задачу; с запасом до загрузки target_utilization. Воркер проверяет
+    worker_concurrency задач одновременно (gevent-воркер - несколько).
+    Если загрузка процессоров (load average на ядро) выше max_load или
+    воркеры заняли больше max_rss байт памяти, пул не растет, а уменьшается.
+
+    Чтобы размер не колебался, пул растет только после up_checks подряд
+    проверок с нехваткой воркеров, уменьшается - после down_checks подряд
+    проверок с избытком, и не больше чем на step воркеров за раз.
+    """
+
+    def __init__(self, min_workers, max_workers, meter, tube=None, worker_concurrency=1, drain_time=60,
+                 target_utilization=0.8, up_checks=2, down_checks=6, step=4, max_load=None, max_rss=None):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.meter = meter
+        self.tube = tube
+        self.worker_concurrency = worker_concurrency
+        self.drain_time = drain_time
+        self.target_utilization = target_utilization
+        self.up_checks = up_checks
+        self.down_checks = down_checks
+        self.step = step
+        self.max_load = max_load
+        self.max_rss = max_rss
+        self.up = 0
+        self.down = 0
+        self.tasks, self.busy = meter.snapshot()
+        self.sampled_at = time()
+
+    def clamp(self, workers):
+        return max(self.min_workers, min(self.max_workers, workers))
+
+    def update(self, current, pids):
+        """
+        Снимает показатели за период с прошлого вызова и решает, сколько держать воркеров.
+
+        :param current: сколько воркеров держится сейчас
+        :param pids: pid запущенных воркеров, для учета памяти
+        :return: сколько воркеров держать
+        """
+        now = time()
+        tasks, busy = self.meter.snapshot()
+        desired = self.desired(
+            get_backlog(self.tube) if self.tube is not None else None,
+            tasks - self.tasks, busy - self.busy, now - self.sampled_at
+        )
+        self.tasks, self.busy, self.sampled_at = tasks, busy, now
+        return self.decide(current, desired, get_load_per_cpu(), get_rss(pids))
+
+    def desired(self, backlog, tasks, busy, elapsed):
+        """
+        :param backlog: задач в очереди, None - неизвестно
+        :param tasks: сколько задач проверено за период
+        :param busy: суммарное время их проверки
+        :param elapsed: длительность периода
+        :return: сколько нужно воркеров или None, если по показателям не понять
+        """
+        if elapsed <= 0 or (backlog and not tasks):
+            return None
+        demand = busy / elapsed
+        if backlog:
+            demand += backlog * (busy / tasks) / self.drain_time
+        return int(math.ceil(demand / self.worker_concurrency / self.target_utilization))
+
+    def decide(self, current, desired, load=None, rss=None):
+        """
+        :return: сколько воркеров держать с учетом ограничений ресурсов и гистерезиса
+        """
+        if desired is None:
+            desired = current
+        if (self.max_load is not None and load is not None and load > self.max_load) or \
+                (self.max_rss is not None and rss is not None and rss > self.max_rss):
+            desired = min(desired, current - 1)
+        desired = self.clamp(desired)
+
+        if desired > current:
+            self.up, self.down = self.up + 1, 0
+            if self.up >= self.up_checks:
+                self.up = 0
+                return min(desired, current + self.step)
+        elif desired < current:
+            self.up, self.down = 0, self.down + 1
+            if self.down >= self.down_checks:
+                self.down = 0
+                return max(desired, current - self.step)
+        else:
+            self.up = self.down = 0
+        return self.clamp(current)
+
+
+def create_autoscaler(config, tube, worker_concurrency):
+    """
+    Создает автомасштабирование пула по настройкам AUTOSCALE_* из конфига.
+
+    :param tube: входная очередь, по которой оценивается очередь задач
+    :return: Autoscaler или None, если автомасштабирование выключено
+    """
+    if not config.AUTOSCALE:
+        return None
+    return Autoscaler(
+        min_workers=config.AUTOSCALE_MIN_WORKERS,
+        max_workers=config.AUTOSCALE_MAX_WORKERS,
+        meter=TaskMeter(),
+        tube=tube,
+        worker_concurrency=worker_concurrency,
+        drain_time=config.AUTOSCALE_DRAIN_TIME,
+        target_utilization=config.AUTOSCALE_TARGET_UTILIZATION,
+        up_checks=config.AUTOSCALE_UP_CHECKS,
+        down_checks=config.AUTOSCALE_DOWN_CHECKS,
+        step=config.AUTOSCALE_STEP,
+        max_load=config.AUTOSCALE_MAX_LOAD,
+        max_rss=config.AUTOSCALE_MAX_RSS_MB * 1024 * 1024
+    )
@@ -0,0 +1,83 @@
+# coding: utf-8
+import pycurl
+
+from .stats import stats
+
+
+class CurlPool(object):
+    """
+    Пул переиспользуемых curl-хэндлов.
+
+    Хэндл после запроса не закрывается, а возвращается в пул, поэтому
+    открытые keep-alive соединения и DNS-кэш libcurl переживают запрос.
+    Через pycurl.CurlShare хэндлы пула могут делить между собой куки,
+    DNS-кэш и SSL-сессии.
+    """
+
+    def __init__(self, size=10, share_cookies=False, share_dns=True, share_ssl=True):
+        """
+        :param size: сколько свободных хэндлов держать в пуле
+        :type size: int
+        """
+        self.size = size
+        self.free = []
+
+        shared_data = []
+        if share_cookies:
+            shared_data.append(pycurl.LOCK_DATA_COOKIE)
+        if share_dns:
+            shared_data.append(pycurl.LOCK_DATA_DNS)
+        if share_ssl:
+            shared_data.append(pycurl.LOCK_DATA_SSL_SESSION)
+
+        self.share = None
+        if shared_data:
+            self.share = pycurl.CurlShare()
+            for data in shared_data:
+                self.share.setopt(pycurl.SH_SHARE, data)
+
+    def acquire(self):
+        """
+        Берет свободный хэндл из пула, если свободных нет - создает новый.
+
+        :rtype: pycurl.Curl
+        """
+        if self.free:
+            stats.incr('curl_pool.hit')
+            return self.free.pop()
+
+        stats.incr('curl_pool.miss')
+        curl = pycurl.Curl()
+        if self.share is not None:
+            curl.setopt(pycurl.SHARE, self.share)
+        return curl
+
+    def release(self, curl):
+        """
+        Возвращает хэндл в пул. Настройки хэндла сбрасываются, соединения,
+        кэши и подключенный CurlShare остаются.
+        """
+        if len(self.free) >= self.size:
+            curl.close()
+            return
+        curl.reset()
+        self.free.append(curl)
+
+    def close(self):
+        for curl in self.free:
+            curl.close()
+        self.free = []
+
+
+def create_curl_pool(config):
+    """
+    Создает пул хэндлов по настройкам CURL_POOL_* из конфига.
+
+    :rtype: CurlPool
+    """
+    return CurlPool(
+        size=config.CURL_POOL_SIZE,
+        share_cookies=config.CURL_POOL_SHARE_COOKIES,
+        share_dns=config.CURL_POOL_SHARE_DNS,
+        share_ssl=config.CURL_POOL_SHARE_SSL
+    )
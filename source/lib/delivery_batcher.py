@@ -0,0 +1,85 @@
+# coding: utf-8
+import gevent
+
+from .stats import stats
+
+
+class DeliveryBatcher(object):
+    """
+    Сбор уведомлений на один callback_url в пачки.
+
+    Пачками отправляются только уведомления на urls - адреса партнеров,
+    которые принимают массив уведомлений одним запросом. Пачка открывается
+    первой задачей (open) и отдается send(url, tasks) через window секунд
+    или сразу, как только в ней наберется max_size задач. Пока пачка
+    открыта, следующие задачи на тот же адрес присоединяются к ней (join).
+    """
+
+    def __init__(self, urls, window, max_size, send):
+        self.urls = frozenset(urls)
+        self.window = window
+        self.max_size = max_size
+        self.send = send
+        self.pending = {}
+        self.timers = {}
+
+    def accepts(self, url):
+        """
+        :return: отправляются ли уведомления на url пачками
+        """
+        return url in self.urls
+
+    def open(self, url, task):
+        """
+        Открывает пачку на url с первой задачей task.
+        """
+        self.pending[url] = [task]
+        self.timers[url] = gevent.spawn_later(self.window, self.flush, url)
+        self._flush_full(url)
+
+    def join(self, url, task):
+        """
+        Добавляет задачу в открытую пачку на url.
+
+        :return: добавлена ли задача (False, если открытой пачки на url нет)
+        """
+        tasks = self.pending.get(url)
+        if tasks is None:
+            return False
+        tasks.append(task)
+        self._flush_full(url)
+        return True
+
+    def _flush_full(self, url):
+        if len(self.pending[url]) >= self.max_size:
+            self.timers[url].kill()
+            self.flush(url)
+
+    def flush(self, url):
+        """
+        Закрывает пачку на url и отдает ее send.
+        """
+        tasks = self.pending.pop(url)
+        del self.timers[url]
+        stats.incr('batch.sent')
+        stats.incr('batch.tasks', len(tasks))
+        self.send(url, tasks)
+
+    def drain(self):
+        """
+        Закрывает все пачки, не отправляя их.
+
+        :return: задачи из неотправленных пачек
+        """
+        gevent.killall(self.timers.values())
+        tasks = [task for tasks in self.pending.itervalues() for task in tasks]
+        self.pending.clear()
+        self.timers.clear()
+        return tasks
+
+
+def create_delivery_batcher(config, send):
+    """
+    Создает сборщик пачек уведомлений по настройкам BATCH_* из конфига.
+    """
+    return DeliveryBatcher(config.BATCH_CALLBACK_URLS, config.BATCH_WINDOW, config.BATCH_MAX_SIZE, send)
@@ -0,0 +1,163 @@
+# coding: utf-8
+import os
+import socket
+from Queue import Full, Queue
+from threading import Thread
+from time import time
+from urlparse import urlsplit
+
+from .stats import stats
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+PREFETCH_QUEUE_SIZE = 1000
+
+
+def split_host(url):
+    """
+    :return: хост и порт урла или None, если хоста нет, схема не http(s) или хост - ip-адрес
+    :rtype: tuple
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port or DEFAULT_PORTS.get(parts.scheme.lower())
+    except ValueError:
+        return None
+    host = parts.hostname
+    if not host or port is None or is_ip_address(host):
+        return None
+    return host, port
+
+
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+class DnsResolver(object):
+    """
+    Разрешение имен хостов для curl с кэшем, общим для всех воркеров.
+
+    Адреса хранятся в SharedCache (время жизни - TTL кэша), поэтому хост,
+    разрешенный одним воркером, не запрашивается у DNS другими. В запрос
+    адреса подставляются через pycurl.RESOLVE, и curl сам DNS не опрашивает.
+
+    prefetch разрешает хост в фоновых потоках, пока текущий хоп еще
+    скачивается; потоки запускаются в том процессе, где prefetch
+    вызван впервые (после fork воркера).
+
+    С blocking=False (цикл RedirectEngine) адрес берется только из кэша:
+    при промахе хост ставится на фоновое разрешение, а этот запрос
+    разрешает сам curl, не останавливая остальные.
+    """
+
+    def __init__(self, cache, prefetch_threads=2):
+        """
+        :param cache: SharedCache для адресов
+        :param prefetch_threads: сколько потоков разрешают хосты заранее, 0 - без prefetch
+        """
+        self.cache = cache
+        self.prefetch_threads = prefetch_threads
+        self.queue = None
+        self.pid = None
+
+    def resolve(self, host, port, blocking=True):
+        """
+        :param blocking: можно ли ждать DNS, если адреса нет в кэше
+        :return: список адресов хоста, пустой, если хост не разрешился (или не в кэше при blocking=False)
+        """
+        key = '{}:{}'.format(host, port)
+        addresses = self.cache.get(key)
+        if addresses is not None:
+            stats.incr('dns.hit')
+            return addresses
+        if not blocking:
+            stats.incr('dns.deferred')
+            self._enqueue(host, port)
+            return []
+
+        stats.incr('dns.miss')
+        started = time()
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except (socket.error, UnicodeError):
+            stats.incr('dns.error')
+            return []
+        finally:
+            stats.timing('dns.resolve', time() - started)
+
+        addresses = []
+        for _, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        self.cache.set(key, addresses)
+        return addresses
+
+    def curl_resolve(self, url, blocking=True):
+        """
+        :return: значение для pycurl.RESOLVE ['хост:порт:адрес,...'] или None
+        """
+        host_port = split_host(url)
+        if host_port is None:
+            return None
+        host, port = host_port
+        addresses = self.resolve(host, port, blocking)
+        if not addresses:
+            return None
+        return ['{}:{}:{}'.format(host, port, ','.join(
+            '[{}]'.format(address) if ':' in address else address for address in addresses
+        ))]
+
+    def address(self, url, blocking=True):
+        """
+        :return: первый адрес хоста урла или None
+        """
+        host_port = split_host(url)
+        if host_port is None:
+            return None
+        addresses = self.resolve(host_port[0], host_port[1], blocking)
+        return addresses[0] if addresses else None
+
+    def prefetch(self, url):
+        """Ставит хост урла в очередь на фоновое разрешение"""
+        host_port = split_host(url)
+        if host_port is not None:
+            self._enqueue(*host_port)
+
+    def _enqueue(self, host, port):
+        if not self.prefetch_threads:
+            return
+        self._start()
+        try:
+            self.queue.put_nowait((host, port))
+            stats.incr('dns.prefetch')
+        except Full:
+            stats.incr('dns.prefetch_dropped')
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.queue = Queue(PREFETCH_QUEUE_SIZE)
+        for _ in xrange(self.prefetch_threads):
+            thread = Thread(target=self._prefetch_loop, args=(self.queue,))
+            thread.daemon = True
+            thread.start()
+
+    def _prefetch_loop(self, queue):
+        while True:
+            host, port = queue.get()
+            self.resolve(host, port)
+
+
+def create_dns_resolver(cache, prefetch_threads):
+    """
+    :return: DnsResolver или None, если кэш адресов выключен
+    """
+    if cache is None:
+        return None
+    return DnsResolver(cache, prefetch_threads)
@@ -0,0 +1,82 @@
+# coding: utf-8
+import os
+import signal
+from time import time
+
+DRAIN_SIGNAL = signal.SIGUSR1
+
+
+class DrainTimeout(Exception):
+    """Проверка задачи не закончилась до срока остановки воркера"""
+
+
+class Drain(object):
+    """
+    Плавная остановка воркера по сигналу супервизора (DRAIN_SIGNAL).
+
+    После сигнала requested = True: воркер перестает брать задачи, дорабатывает
+    взятые и завершается. Если задан timeout, через timeout секунд после сигнала
+    (по SIGALRM) срок остановки истекает (expired = True), и проверка прерывается
+    исключением DrainTimeout между запросами (check_deadline), чтобы воркер вернул
+    задачу в очередь, а не бросил ее. Обработчики сигналов только ставят флаги:
+    исключение из обработчика вылетело бы посреди curl-запроса, а системные вызовы,
+    на которых сигнал застал процесс, перезапускаются (siginterrupt), а не падают с EINTR.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.requested = False
+        self.expired = False
+
+    def install(self):
+        signal.signal(DRAIN_SIGNAL, self._on_drain)
+        signal.siginterrupt(DRAIN_SIGNAL, False)
+        if self.timeout is not None:
+            signal.signal(signal.SIGALRM, self._on_deadline)
+            signal.siginterrupt(signal.SIGALRM, False)
+
+    def run(self, func, *args):
+        """
+        Выполняет проверку func(*args), которую можно прервать по сроку остановки:
+        проверка вызывает check_deadline между запросами (CheckContext.interrupt_check).
+
+        :raises: DrainTimeout
+        """
+        self.check_deadline()
+        return func(*args)
+
+    def check_deadline(self):
+        """
+        :raises: DrainTimeout, если срок остановки истек
+        """
+        if self.expired:
+            raise DrainTimeout()
+
+    def _on_drain(self, signum, frame):
+        if self.requested:
+            return
+        self.requested = True
+        if self.timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, max(self.timeout, 0.001))
+
+    def _on_deadline(self, signum, frame):
+        self.expired = True
+
+
+def drain_workers(workers, timeout):
+    """
+    Плавно останавливает воркеры: посылает им DRAIN_SIGNAL, ждет завершения
+    до timeout секунд и завершает (terminate) тех, кто не успел.
+
+    :param workers: процессы воркеров (multiprocessing.Process)
+    """
+    for p in workers:
+        try:
+            os.kill(p.pid, DRAIN_SIGNAL)
+        except OSError:
+            pass
+    deadline = time() + timeout
+    for p in workers:
+        p.join(max(deadline - time(), 0))
+        if p.is_alive():
+            p.terminate()
@@ -0,0 +1,143 @@
+# coding: utf-8
+import fcntl
+import os
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.select import select
+import pycurl
+
+from .scheduler import HostScheduler
+
+SELECT_TIMEOUT = 1.0
+
+
+class GeventCurlPerformer(object):
+    """
+    Кооперативное выполнение запросов curl-хэндлов для gevent.
+
+    perform(curl) не блокирует процесс, как curl.perform(): хэндл добавляется
+    в общий CurlMulti, а вызвавший гринлет ждет завершения запроса.
+    Передачу данных всех хэндлов ведет один гринлет, ожидающий сокеты
+    через gevent.select, поэтому пока идут запросы, остальные гринлеты работают.
+    Новый хэндл будит ожидание через pipe, чтобы запрос начался сразу.
+
+    Одновременных запросов к одному хосту не больше host_limit, к одному ip -
+    не больше ip_limit, как в RedirectEngine: запрос сверх лимита ждет
+    своей очереди в HostScheduler.
+    """
+
+    def __init__(self, host_limit=None, ip_limit=None):
+        self.scheduler = HostScheduler(host_limit, ip_limit)
+        self.multi = pycurl.CurlMulti()
+        self.waiters = {}
+        self.driver = None
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.woken = False
+
+    def perform(self, curl, host=None, ip=None):
+        """
+        Выполняет запрос хэндла, ошибки - как у curl.perform().
+
+        :param host: хост запроса, None - без ограничения по хосту и ip
+        :param ip: адрес хоста, None - неизвестен
+        :raises: pycurl.error
+        """
+        if host is None:
+            self._perform(curl)
+            return
+        self._acquire(host, ip)
+        try:
+            self._perform(curl)
+        finally:
+            self._release(host, ip)
+
+    def _acquire(self, host, ip):
+        turn = AsyncResult()
+        self.scheduler.push(host, ip, turn)
+        self._dispatch()
+        try:
+            turn.get()
+        except BaseException:
+            if turn.ready():
+                self._release(host, ip)
+            else:
+                # гринлет прерван в очереди: _dispatch пропустит его запрос
+                turn.set(False)
+            raise
+
+    def _release(self, host, ip):
+        self.scheduler.done(host, ip)
+        self._dispatch()
+
+    def _dispatch(self):
+        while True:
+            item = self.scheduler.pop()
+            if item is None:
+                return
+            host, ip, turn = item
+            if turn.ready():
+                self.scheduler.done(host, ip)
+                continue
+            turn.set(True)
+
+    def _perform(self, curl):
+        result = AsyncResult()
+        self.waiters[curl] = result
+        self.multi.add_handle(curl)
+        if self.driver is None or self.driver.dead:
+            self.driver = gevent.spawn(self._run)
+        elif not self.woken:
+            self.woken = True
+            os.write(self.wakeup_write, '.')
+        try:
+            error = result.get()
+        except BaseException:
+            # гринлет прерван (kill): хэндл убирается из multi, пока его не вернули в пул
+            if self.waiters.pop(curl, None) is not None:
+                self.multi.remove_handle(curl)
+            raise
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while self.waiters:
+            while True:
+                ret, _ = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, ok_list, err_list = self.multi.info_read()
+                for curl in ok_list:
+                    self._done(curl, None)
+                for curl, errno, errmsg in err_list:
+                    self._done(curl, pycurl.error(errno, errmsg))
+                if not queued:
+                    break
+
+            if self.waiters:
+                self._wait()
+
+    def close(self):
+        self.multi.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def _wait(self):
+        timeout = self.multi.timeout()
+        timeout = SELECT_TIMEOUT if timeout < 0 else min(timeout / 1000.0, SELECT_TIMEOUT)
+        read, write, error = self.multi.fdset()
+        ready = select(read + [self.wakeup_read], write, error, timeout)[0]
+        if self.wakeup_read in ready:
+            self.woken = False
+            try:
+                os.read(self.wakeup_read, 4096)
+            except OSError:
+                pass
+
+    def _done(self, curl, error):
+        self.multi.remove_handle(curl)
+        self.waiters.pop(curl).set(error)
@@ -0,0 +1,177 @@
+# coding: utf-8
+from collections import defaultdict, deque
+from time import time
+
+from .stats import stats
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+SWEEP_INTERVAL = 60
+"""Как часто (в секундах) HostGuard забывает предохранители простаивающих хостов"""
+
+
+class CircuitBreaker(object):
+    """
+    Предохранитель для одного хоста.
+
+    Учитывает результаты запросов за последние window секунд; если их не меньше
+    min_requests и доля ошибок выше max_error_rate, размыкается, и запросы к хосту
+    не делаются open_timeout секунд. Затем пропускает один пробный запрос
+    (half_open): удачный замыкает предохранитель, неудачный снова размыкает.
+    """
+
+    def __init__(self, window=30, min_requests=10, max_error_rate=0.5, open_timeout=30):
+        self.window = window
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.open_timeout = open_timeout
+        self.state = BREAKER_CLOSED
+        self.results = deque()
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+
+    def allow(self, now):
+        """
+        :return: можно ли сейчас сделать запрос к хосту
+        """
+        if self.state == BREAKER_OPEN:
+            if now - self.opened_at < self.open_timeout:
+                return False
+            self.state = BREAKER_HALF_OPEN
+            self.trial = False
+        if self.state == BREAKER_HALF_OPEN:
+            if self.trial:
+                return False
+            self.trial = True
+        return True
+
+    def record(self, failed, now):
+        """
+        Учитывает результат запроса к хосту.
+        """
+        if self.state == BREAKER_HALF_OPEN:
+            self._switch(BREAKER_OPEN if failed else BREAKER_CLOSED, now)
+            return
+        if self.state == BREAKER_OPEN:
+            return
+
+        self.results.append((now, failed))
+        self.failures += failed
+        while self.results[0][0] <= now - self.window:
+            _, expired_failed = self.results.popleft()
+            self.failures -= expired_failed
+
+        requests = len(self.results)
+        if requests >= self.min_requests and float(self.failures) / requests > self.max_error_rate:
+            self._switch(BREAKER_OPEN, now)
+
+    def idle(self, now):
+        """
+        :return: замкнут ли предохранитель и нет ли у него результатов за последние window секунд
+        """
+        return self.state == BREAKER_CLOSED and (not self.results or self.results[-1][0] <= now - self.window)
+
+    def _switch(self, state, now):
+        self.state = state
+        self.opened_at = now
+        self.trial = False
+        self.results.clear()
+        self.failures = 0
+
+
+class HostGuard(object):
+    """
+    Перегородки и предохранители по хостам уведомлений.
+
+    К одному хосту одновременно идет не больше max_requests запросов, чтобы
+    медленный хост не занимал весь пул обработчиков, а к хосту с разомкнутым
+    предохранителем (см. CircuitBreaker) запросы не идут вовсе.
+
+    В статистике: отказы (host_guard.bulkhead, host_guard.open), переходы
+    предохранителей (breaker.open, breaker.half_open, breaker.closed), число
+    хостов с не замкнутым предохранителем (breaker.open_hosts) и число хостов,
+    предохранители которых помнятся (host_guard.hosts).
+
+    Хостов уведомлений много, поэтому раз в SWEEP_INTERVAL секунд
+    предохранители простаивающих хостов (см. CircuitBreaker.idle), к которым
+    нет запросов в полете, забываются: заново созданный будет таким же.
+    """
+
+    def __init__(self, max_requests, **breaker_kwargs):
+        self.max_requests = max_requests
+        self.breaker_kwargs = breaker_kwargs
+        self.breakers = {}
+        self.in_flight = defaultdict(int)
+        self.open_hosts = 0
+        self.swept_at = time()
+
+    def acquire(self, host):
+        """
+        :return: можно ли сейчас отправить запрос к host; если да, после запроса нужно вызвать release
+        """
+        if self.in_flight.get(host, 0) >= self.max_requests:
+            stats.incr('host_guard.bulkhead')
+            return False
+
+        now = time()
+        self._sweep(now)
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker(**self.breaker_kwargs)
+        state = breaker.state
+        allowed = breaker.allow(now)
+        self._track(breaker, state)
+        if not allowed:
+            stats.incr('host_guard.open')
+            return False
+
+        self.in_flight[host] += 1
+        return True
+
+    def release(self, host, failed):
+        """
+        Завершает запрос к host, начатый после успешного acquire.
+
+        :param failed: закончился ли запрос ошибкой или таймаутом
+        """
+        self.in_flight[host] -= 1
+        if not self.in_flight[host]:
+            del self.in_flight[host]
+
+        breaker = self.breakers[host]
+        state = breaker.state
+        breaker.record(failed, time())
+        self._track(breaker, state)
+
+    def _sweep(self, now):
+        if now - self.swept_at < SWEEP_INTERVAL:
+            return
+        self.swept_at = now
+        for host in [host for host, breaker in self.breakers.iteritems()
+                     if host not in self.in_flight and breaker.idle(now)]:
+            del self.breakers[host]
+        stats.gauge('host_guard.hosts', len(self.breakers))
+
+    def _track(self, breaker, state):
+        if breaker.state == state:
+            return
+        stats.incr('breaker.' + breaker.state)
+        self.open_hosts += (breaker.state != BREAKER_CLOSED) - (state != BREAKER_CLOSED)
+        stats.gauge('breaker.open_hosts', self.open_hosts)
+
+
+def create_host_guard(config):
+    """
+    Создает перегородки и предохранители по настройкам HOST_* и BREAKER_* из конфига.
+    Одному хосту достается не больше доли HOST_MAX_SHARE пула обработчиков (но хотя бы один).
+    """
+    return HostGuard(
+        max(1, int(config.WORKER_POOL_SIZE * config.HOST_MAX_SHARE)),
+        window=config.BREAKER_WINDOW,
+        min_requests=config.BREAKER_MIN_REQUESTS,
+        max_error_rate=config.BREAKER_MAX_ERROR_RATE,
+        open_timeout=config.BREAKER_OPEN_TIMEOUT
+    )
@@ -0,0 +1,120 @@
+# coding: utf-8
+from cookielib import DefaultCookiePolicy
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import EmptyPoolError
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+
+from .stats import stats
+
+
+class MeteredPoolMixin(object):
+    """
+    Пул соединений с одним хостом, который учитывает в stats ожидание
+    свободного соединения (http_pool.wait), переиспользованные
+    (http_pool.reused) и новые (http_pool.new) соединения.
+
+    Соединение ждется не дольше wait_timeout секунд (None - без ограничения).
+    """
+
+    wait_timeout = None
+
+    def _get_conn(self, timeout=None):
+        started = time()
+        connections = self.num_connections
+        try:
+            conn = super(MeteredPoolMixin, self)._get_conn(self.wait_timeout)
+        except EmptyPoolError:
+            stats.incr('http_pool.wait_timeout')
+            raise
+        finally:
+            stats.timing('http_pool.wait', time() - started)
+        stats.incr('http_pool.new' if self.num_connections > connections else 'http_pool.reused')
+        return conn
+
+
+class MeteredHTTPConnectionPool(MeteredPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class MeteredHTTPSConnectionPool(MeteredPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+METERED_POOL_CLASSES = {
+    'http': MeteredHTTPConnectionPool,
+    'https': MeteredHTTPSConnectionPool,
+}
+
+
+class MeteredPoolManager(PoolManager):
+    """
+    Пулы соединений по хостам (не больше num_pools, лишние закрываются
+    по LRU), каждый не больше maxsize соединений.
+    """
+
+    def __init__(self, num_pools=10, wait_timeout=None, **connection_pool_kw):
+        super(MeteredPoolManager, self).__init__(num_pools, **connection_pool_kw)
+        self.wait_timeout = wait_timeout
+
+    def _new_pool(self, scheme, host, port):
+        kwargs = self.connection_pool_kw
+        if scheme == 'http':
+            kwargs = self.connection_pool_kw.copy()
+            for kw in SSL_KEYWORDS:
+                kwargs.pop(kw, None)
+        pool = METERED_POOL_CLASSES[scheme](host, port, **kwargs)
+        pool.wait_timeout = self.wait_timeout
+        return pool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    Адаптер requests с keep-alive соединениями, общими для всех гринлетов:
+    на каждый хост не больше pool_size соединений, гринлет ждет свободное
+    не дольше wait_timeout секунд, иначе получает requests.ConnectionError.
+    """
+
+    def __init__(self, pool_hosts, pool_size, wait_timeout=None):
+        self.wait_timeout = wait_timeout
+        super(PooledHTTPAdapter, self).__init__(pool_connections=pool_hosts, pool_maxsize=pool_size,
+                                                pool_block=True)
+
+    def init_poolmanager(self, connections, maxsize, block=True):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = MeteredPoolManager(num_pools=connections, wait_timeout=self.wait_timeout,
+                                              maxsize=maxsize, block=block)
+
+    def send(self, request, *args, **kwargs):
+        try:
+            return super(PooledHTTPAdapter, self).send(request, *args, **kwargs)
+        except EmptyPoolError as e:
+            raise requests.ConnectionError(e)
+
+
+def create_http_session(config):
+    """
+    Создает HTTP-сессию с пулом соединений по настройкам HTTP_POOL_* из конфига.
+    Соединений с одним хостом - HTTP_POOL_HOST_SIZE, если 0 - WORKER_POOL_SIZE
+    (по одному на гринлет).
+
+    Сессия общая для уведомлений всех партнеров, поэтому куки она не хранит
+    и не отправляет: кука из ответа одного партнера не уйдет с чужим уведомлением.
+
+    :rtype: requests.Session
+    """
+    adapter = PooledHTTPAdapter(
+        pool_hosts=config.HTTP_POOL_HOSTS,
+        pool_size=config.HTTP_POOL_HOST_SIZE or config.WORKER_POOL_SIZE,
+        wait_timeout=config.HTTP_POOL_WAIT_TIMEOUT
+    )
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,73 @@
+# coding: utf-8
+import codecs
+from HTMLParser import HTMLParser, HTMLParseError
+
+HEAD_TAGS = frozenset(('html', 'head', 'title', 'base', 'link', 'style', 'script', 'noscript', 'template'))
+"""Теги, которые могут идти до первого meta, не означая начала body"""
+
+CHUNK_SIZE = 4096
+
+
+class StopScan(Exception):
+    pass
+
+
+class MetaTagScanner(HTMLParser):
+    """
+    Потоковый поиск первого тега <meta> в начале хтмл-страницы.
+
+    Страница подается кусками через feed, дерево документа не строится.
+    Разбор прекращается (done) на первом <meta>, на </head> или на первом
+    теге содержимого страницы. Если страница не в utf-8 или не разбирается,
+    выставляется failed - тогда нужен полный разбор страницы.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.done = False
+        self.failed = False
+        self.attrs = None
+
+    def feed(self, data):
+        """
+        Разбирает очередной кусок страницы.
+
+        :return: True, если разбор закончен
+        """
+        if self.done:
+            return True
+        try:
+            if isinstance(data, str):
+                data = self.decoder.decode(data)
+            HTMLParser.feed(self, data)
+        except StopScan:
+            self.done = True
+        except (UnicodeError, HTMLParseError):
+            self.failed = self.done = True
+        return self.done
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            self.attrs = dict((key, '' if value is None else value) for key, value in attrs)
+            raise StopScan()
+        elif tag not in HEAD_TAGS:
+            raise StopScan()
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            raise StopScan()
+
+
+def find_first_meta(content):
+    """
+    Ищет первый тег <meta> в начале страницы.
+
+    :return: атрибуты тега или None и признак того, что страницу не удалось разобрать
+    :rtype: tuple
+    """
+    scanner = MetaTagScanner()
+    for start in xrange(0, len(content), CHUNK_SIZE):
+        if scanner.feed(content[start:start + CHUNK_SIZE]):
+            break
+    return scanner.attrs, scanner.failed
@@ -0,0 +1,308 @@
+# coding: utf-8
+import heapq
+from itertools import count
+from logging import getLogger
+from time import sleep, time
+
+import pycurl
+
+from .curl_pool import CurlPool
+from .scheduler import HostScheduler
+from .stats import stats
+from . import (DEFAULT_CONTEXT, ERROR_REDIRECT, INFLIGHT_POLL_INTERVAL, RedirectChain, cache_history, claim_url,
+               create_body_buffer, finish_url, get_cached_history, get_host_address, get_retry_delay, get_url_host,
+               prepare_curl, prepare_url, process_response, to_str, to_unicode)
+
+logger = getLogger('redirect_checker')
+
+DEFAULT_CONCURRENCY = 100
+SELECT_TIMEOUT = 1.0
+
+
+class RedirectEngine(object):
+    """
+    Проверяет цепочки редиректов многих урлов одновременно в одном процессе.
+
+    Хопы всех цепочек выполняются параллельно через pycurl.CurlMulti,
+    одновременно открыто не более concurrency соединений.
+    Хэндлы берутся из пула pool (по умолчанию собственный CurlPool движка).
+    Ожидающие хопы планируются HostScheduler: на один хост не больше
+    host_concurrency запросов, на один ip - не больше ip_concurrency
+    (ip известен, если в context задан resolver и адрес хоста уже в его кэше),
+    хосты обходятся по кругу. DNS в цикле не ждется: адреса берутся только
+    из кэша, промахи разрешает curl (асинхронно) и фоновый prefetch.
+    Хоп с временной ошибкой сети повторяется по context.retry_policy: до паузы
+    он лежит в delayed и слот не занимает. Кэши и лимиты тела ответа тоже
+    берутся из context (CheckContext).
+    Как и get_redirect_history, движок отмечает урл в context.inflight_cache;
+    цепочка урла, который уже проверяет другой воркер (или эта же цепочка
+    движка), лежит в parked, не занимая слот, и раз в INFLIGHT_POLL_INTERVAL
+    проверяет, готов ли результат; если проверку прервали или она длится
+    дольше TTL реестра, урл проверяется самостоятельно.
+    Результат по каждому урлу такой же, как у get_redirect_history.
+    """
+
+    def __init__(self, timeout, max_redirects=30, user_agent=None, concurrency=DEFAULT_CONCURRENCY, pool=None,
+                 host_concurrency=None, ip_concurrency=None, context=DEFAULT_CONTEXT):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.concurrency = concurrency
+        self.context = context
+
+        self.multi = pycurl.CurlMulti()
+        self.own_pool = pool is None
+        self.pool = CurlPool(concurrency) if self.own_pool else pool
+        self.waiting = HostScheduler(host_concurrency, ip_concurrency)
+        self.active = {}
+        self.delayed = []
+        self.delayed_sequence = count()
+        self.parked = []
+        self.parked_poll_at = 0
+        self.owned = set()
+
+    def add(self, url, callback=None):
+        """
+        Ставит урл в очередь на проверку.
+
+        :param url: урл для которого необходимо получить редиректы
+        :param callback: вызывается с результатом get_redirect_history, когда проверка завершена
+        :rtype: RedirectChain
+        """
+        chain = RedirectChain(url, self.max_redirects, self.context)
+        cached = get_cached_history(chain.url, self.context.result_cache)
+        if cached is not None:
+            self._set_result(chain, cached, callback)
+        elif claim_url(chain.url, self.context.inflight_cache):
+            self.owned.add(chain)
+            self._schedule_hop(chain, callback)
+        else:
+            self.parked.append((time(), chain, callback))
+        return chain
+
+    def has_work(self):
+        return bool(len(self.waiting) or self.active or self.delayed or self.parked)
+
+    def step(self, select_timeout=SELECT_TIMEOUT):
+        """
+        Одна итерация цикла: запускает ожидающие хопы, продвигает передачу данных
+        и обрабатывает завершенные хопы. Ждет сетевой активности не дольше select_timeout.
+        """
+        self._start_hops()
+        if not self.active:
+            if self.delayed or self.parked:
+                sleep(self._select_timeout(select_timeout))
+            return
+
+        while True:
+            ret, _ = self.multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self._hop_done(curl)
+            for curl, errno, errmsg in err_list:
+                self._hop_done(curl, pycurl.error(errno, errmsg))
+            if not queued:
+                break
+
+        # хопы, запущенные вместо завершенных, сначала должны пройти через perform
+        if not self._start_hops() and self.active:
+            self.multi.select(self._select_timeout(select_timeout))
+
+    def run(self):
+        """Выполняет все поставленные в очередь проверки"""
+        while self.has_work():
+            self.step()
+
+    def close(self):
+        for curl in self.active.keys():
+            self.multi.remove_handle(curl)
+            curl.close()
+        for chain in self.owned:
+            finish_url(chain.url, None, self.context.inflight_cache)
+        self.active = {}
+        self.delayed = []
+        self.parked = []
+        self.owned = set()
+        self.multi.close()
+        if self.own_pool:
+            self.pool.close()
+
+    def _select_timeout(self, select_timeout):
+        """Ожидание, не задерживающее повтор или опрос parked, до которых меньше select_timeout"""
+        if self.delayed:
+            select_timeout = min(select_timeout, self.delayed[0][0] - time())
+        if self.parked:
+            select_timeout = min(select_timeout, self.parked_poll_at - time())
+        return max(0.0, select_timeout)
+
+    def _schedule_hop(self, chain, callback, attempt=0):
+        if chain.add_cached_hops():
+            self._finish(chain, callback)
+            return
+        url = to_str(prepare_url(chain.redirect_url), 'ignore')
+        host = get_url_host(url)
+        ip = get_host_address(url, self.context.resolver, blocking=False)
+        self.waiting.push(host, ip, (chain, callback, url, attempt))
+
+    def _schedule_retry(self, chain, callback, attempt, error):
+        """
+        :return: True, если хоп будет повторен
+        """
+        delay = get_retry_delay(chain.redirect_url, attempt, error, self.context.retry_policy)
+        if delay is None:
+            return False
+        heapq.heappush(self.delayed, (time() + delay, next(self.delayed_sequence), chain, callback, attempt + 1))
+        return True
+
+    def _release_delayed(self):
+        """Переводит повторы, пауза которых истекла, в ожидающие хопы"""
+        now = time()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, chain, callback, attempt = heapq.heappop(self.delayed)
+            self._schedule_hop(chain, callback, attempt)
+
+    def _poll_parked(self):
+        """
+        Раз в INFLIGHT_POLL_INTERVAL проверяет цепочки, ждущие результата другой проверки:
+        готовый результат отдается сразу, иначе по истечении TTL реестра или после
+        прерванной проверки урл проверяется самостоятельно (как wait_for_history).
+        """
+        now = time()
+        if not self.parked or now < self.parked_poll_at:
+            return
+        self.parked_poll_at = now + INFLIGHT_POLL_INTERVAL
+        inflight_cache = self.context.inflight_cache
+        parked, self.parked = self.parked, []
+        for parked_at, chain, callback in parked:
+            entry = inflight_cache.get(to_str(chain.url))
+            if entry is None:
+                result = get_cached_history(chain.url, self.context.result_cache)
+            else:
+                result = entry[0]
+            if result is None and entry is not None and now < parked_at + inflight_cache.ttl:
+                self.parked.append((parked_at, chain, callback))
+                continue
+            stats.timing('coalesce.wait', now - parked_at)
+            if result is not None:
+                stats.incr('coalesce.hit')
+                self._set_result(chain, result, callback)
+                continue
+            stats.incr('coalesce.miss')
+            if claim_url(chain.url, inflight_cache):
+                self.owned.add(chain)
+            self._schedule_hop(chain, callback)
+
+    def _start_hops(self):
+        """
+        Запускает ожидающие хопы, пока есть свободные слоты
+        :return: сколько хопов запущено
+        """
+        self._poll_parked()
+        self._release_delayed()
+        started = 0
+        while len(self.active) < self.concurrency:
+            scheduled = self.waiting.pop()
+            if scheduled is None:
+                break
+            self._start_hop(*scheduled)
+            started += 1
+        return started
+
+    def _start_hop(self, host, ip, hop):
+        chain, callback, url, attempt = hop
+        curl = self.pool.acquire()
+        buff = create_body_buffer(chain.redirect_url, self.context)
+        try:
+            prepare_curl(curl, url, self.timeout, buff, self.user_agent, self.context.resolver, blocking=False)
+        except (pycurl.error, ValueError) as e:
+            self.pool.release(curl)
+            self.waiting.done(host, ip)
+            self._add_hop(chain, callback, self._error_hop(chain, e))
+            return
+        self.active[curl] = (chain, callback, buff, host, ip, attempt)
+        self.multi.add_handle(curl)
+
+    def _hop_done(self, curl, error=None):
+        chain, callback, buff, host, ip, attempt = self.active.pop(curl)
+        self.multi.remove_handle(curl)
+        self.waiting.done(host, ip)
+        if error is None or buff.aborted:
+            if attempt:
+                stats.incr('retry.success')
+            content = buff.getvalue()
+            redirect_url = curl.getinfo(pycurl.REDIRECT_URL) or buff.redirect_url
+            if redirect_url is not None:
+                redirect_url = to_unicode(redirect_url, 'ignore')
+            hop = process_response(chain.redirect_url, content, redirect_url)
+        elif self._schedule_retry(chain, callback, attempt, error):
+            hop = None
+        else:
+            hop = self._error_hop(chain, error)
+        self.pool.release(curl)
+        if hop is not None:
+            self._add_hop(chain, callback, hop)
+
+    def _error_hop(self, chain, error):
+        logger.error(u'error in url {} {}'.format(chain.redirect_url, error))
+        return chain.redirect_url, ERROR_REDIRECT, None
+
+    def _add_hop(self, chain, callback, hop):
+        if chain.add_hop(*hop):
+            self._finish(chain, callback)
+        else:
+            self._schedule_hop(chain, callback)
+
+    def _set_result(self, chain, result, callback):
+        """Завершает цепочку готовым результатом: из кэша или от другой проверки урла"""
+        chain.history_types, chain.history_urls, chain.counters = result
+        chain.finished = True
+        if callback:
+            callback(chain.result())
+
+    def _finish(self, chain, callback):
+        result = chain.result()
+        cache_history(chain.url, result, self.context.result_cache)
+        if chain in self.owned:
+            self.owned.remove(chain)
+            finish_url(chain.url, result, self.context.inflight_cache)
+        if callback:
+            callback(result)
+
+
+def create_redirect_engine(config, pool=None, context=DEFAULT_CONTEXT):
+    """
+    Создает движок по настройкам ENGINE_* и HTTP_* из конфига.
+
+    :rtype: RedirectEngine
+    """
+    return RedirectEngine(
+        timeout=config.HTTP_TIMEOUT,
+        max_redirects=config.MAX_REDIRECTS,
+        user_agent=config.USER_AGENT,
+        concurrency=config.ENGINE_CONCURRENCY,
+        pool=pool,
+        host_concurrency=config.ENGINE_HOST_CONCURRENCY,
+        ip_concurrency=config.ENGINE_IP_CONCURRENCY,
+        context=context
+    )
+
+
+def get_redirect_histories(urls, timeout, max_redirects=30, user_agent=None, concurrency=DEFAULT_CONCURRENCY,
+                           pool=None, host_concurrency=None, ip_concurrency=None, context=DEFAULT_CONTEXT):
+    """
+    Аналог get_redirect_history для списка урлов, урлы проверяются параллельно.
+
+    :return: список результатов get_redirect_history в порядке урлов
+    """
+    engine = RedirectEngine(timeout, max_redirects, user_agent, concurrency, pool, host_concurrency, ip_concurrency,
+                            context)
+    try:
+        chains = [engine.add(url) for url in urls]
+        engine.run()
+    finally:
+        engine.close()
+    return [chain.result() for chain in chains]
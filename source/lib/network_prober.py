@@ -0,0 +1,159 @@
+# coding: utf-8
+from multiprocessing import RawArray
+from threading import Thread
+from time import sleep, time
+
+from .shared_cache import ProcessLock
+from .stats import stats
+from .utils import check_network_status
+
+
+class FetchMeter(object):
+    """
+    Сколько задач проверили воркеры и сколько из них закончились ошибкой загрузки.
+
+    Как и TaskMeter, счетчики в разделяемой памяти под ProcessLock: создается
+    супервизором до запуска воркеров, воркеры пишут, супервизор читает.
+    """
+
+    def __init__(self):
+        self.lock = ProcessLock()
+        self.values = RawArray('d', 2)
+
+    def record(self, failed):
+        with self.lock:
+            self.values[0] += 1
+            if failed:
+                self.values[1] += 1
+
+    def snapshot(self):
+        """
+        :return: число проверенных задач и число ошибок загрузки
+        """
+        with self.lock:
+            return int(self.values[0]), int(self.values[1])
+
+
+class NetworkProber(object):
+    """
+    Проверка доступности сети в фоновом потоке супервизора.
+
+    Раз в interval секунд одновременно запрашиваются все urls (с таймаутом
+    timeout); проверка успешна, если ответил хотя бы один адрес и доля ошибок
+    загрузки у воркеров за период не выше max_error_rate (если воркеры
+    проверили хотя бы min_fetches задач). Сеть считается упавшей после
+    down_checks неудачных проверок подряд и поднявшейся после up_checks
+    успешных подряд. Состояние читается из основного цикла через up.
+
+    Поток не пишет в лог: супервизор делает fork воркеров, и блокировка
+    обработчика лога, захваченная потоком в момент fork, осталась бы
+    захваченной в воркере навсегда. Переходы логирует основной цикл.
+    """
+
+    def __init__(self, urls, timeout=1, interval=1, down_checks=3, up_checks=2, meter=None,
+                 max_error_rate=0.9, min_fetches=20):
+        self.urls = urls
+        self.timeout = timeout
+        self.interval = interval
+        self.down_checks = down_checks
+        self.up_checks = up_checks
+        self.meter = meter
+        self.max_error_rate = max_error_rate
+        self.min_fetches = min_fetches
+        self.up = True
+        self.failures = 0
+        self.successes = 0
+        self.fetches, self.errors = meter.snapshot() if meter is not None else (0, 0)
+        self.thread = None
+
+    def start(self):
+        """
+        Делает первую проверку (ее результат - начальное состояние, без гистерезиса)
+        и запускает фоновые проверки.
+        """
+        self.up = self.check()
+        self.thread = Thread(target=self._loop, name='NetworkProber')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            sleep(self.interval)
+            self.update(self.check())
+
+    def check(self):
+        """
+        :return: успешна ли проверка сети
+        """
+        return self.probe_all() and not self.workers_failing()
+
+    def probe_all(self):
+        """
+        :return: ответил ли хотя бы один из urls
+        """
+        results = [False] * len(self.urls)
+        threads = [Thread(target=self.probe, args=(url, results, i)) for i, url in enumerate(self.urls)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return any(results)
+
+    def probe(self, url, results, index):
+        started = time()
+        results[index] = check_network_status(url, self.timeout)
+        stats.timing('network.probe', time() - started)
+        if not results[index]:
+            stats.incr('network.probe_failed')
+
+    def workers_failing(self):
+        """
+        :return: превысила ли доля ошибок загрузки у воркеров за период max_error_rate
+        """
+        if self.meter is None:
+            return False
+        fetches, errors = self.meter.snapshot()
+        period_fetches, period_errors = fetches - self.fetches, errors - self.errors
+        self.fetches, self.errors = fetches, errors
+        if period_fetches < self.min_fetches:
+            return False
+        return float(period_errors) / period_fetches > self.max_error_rate
+
+    def update(self, ok):
+        """
+        Учитывает результат проверки.
+
+        :return: изменилось ли состояние сети
+        """
+        if ok:
+            self.successes, self.failures = self.successes + 1, 0
+            if not self.up and self.successes >= self.up_checks:
+                self.up = True
+                stats.incr('network.up')
+                return True
+        else:
+            self.successes, self.failures = 0, self.failures + 1
+            if self.up and self.failures >= self.down_checks:
+                self.up = False
+                stats.incr('network.down')
+                return True
+        return False
+
+
+def create_network_prober(config, meter):
+    """
+    Создает проверку сети по настройкам NETWORK_CHECK_* из конфига.
+
+    :param meter: FetchMeter воркеров
+    """
+    return NetworkProber(
+        urls=config.NETWORK_CHECK_URLS,
+        timeout=config.NETWORK_CHECK_TIMEOUT,
+        interval=config.NETWORK_CHECK_INTERVAL,
+        down_checks=config.NETWORK_CHECK_DOWN_CHECKS,
+        up_checks=config.NETWORK_CHECK_UP_CHECKS,
+        meter=meter,
+        max_error_rate=config.NETWORK_CHECK_MAX_ERROR_RATE,
+        min_fetches=config.NETWORK_CHECK_MIN_FETCHES
+    )
@@ -0,0 +1,94 @@
+# coding: utf-8
+import random
+
+import pycurl
+
+TRANSIENT_ERRORS = frozenset((
+    pycurl.E_COULDNT_RESOLVE_HOST,
+    pycurl.E_COULDNT_CONNECT,
+    pycurl.E_PARTIAL_FILE,
+    pycurl.E_OPERATION_TIMEDOUT,
+    pycurl.E_SSL_CONNECT_ERROR,
+    pycurl.E_GOT_NOTHING,
+    pycurl.E_SEND_ERROR,
+    pycurl.E_RECV_ERROR,
+))
+"""Коды ошибок curl, после которых запрос имеет смысл повторить"""
+
+
+class RetryPolicy(object):
+    """
+    Повтор хопа, упавшего с временной ошибкой сети.
+
+    Хоп повторяется не больше retries раз, перед попыткой attempt (с нуля)
+    выжидается случайная пауза от 0 до min(max_delay, base_delay * 2 ** attempt):
+    экспоненциальный рост с полным разбросом, чтобы воркеры не повторяли
+    запросы к упавшему хосту одновременно. Ошибки, не связанные с сетью
+    (например, ValueError на кривом урле), не повторяются.
+    """
+
+    def __init__(self, retries=2, base_delay=0.5, max_delay=4.0, errors=TRANSIENT_ERRORS):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.errors = errors
+
+    def should_retry(self, attempt, error):
+        """
+        :param attempt: сколько повторов уже сделано
+        :param error: ошибка последней попытки
+        """
+        if attempt >= self.retries or not isinstance(error, pycurl.error):
+            return False
+        return bool(error.args) and error.args[0] in self.errors
+
+    def delay(self, attempt):
+        """
+        :return: пауза в секундах перед повтором номер attempt (с нуля)
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class TaskRetryPolicy(object):
+    """
+    Повтор задачи через очередь после неудачной попытки ее выполнить.
+
+    Задача выполняется не больше max_attempts раз; после неудачной попытки
+    attempt (с нуля) она возвращается в очередь с паузой
+    min(max_delay, base_delay * 2 ** attempt) секунд.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=10, max_delay=600):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt):
+        """
+        :param attempt: номер неудачной попытки (с нуля)
+        """
+        return attempt + 1 < self.max_attempts
+
+    def delay(self, attempt):
+        """
+        :return: пауза в секундах перед попыткой, следующей за attempt
+        """
+        return min(self.max_delay, self.base_delay * 2 ** attempt)
+
+
+def create_task_retry_policy(config):
+    """
+    Создает политику повторов задач по настройкам RETRY_* из конфига.
+    """
+    return TaskRetryPolicy(config.RETRY_MAX_ATTEMPTS, config.RETRY_DELAY, config.RETRY_MAX_DELAY)
+
+
+def create_retry_policy(config):
+    """
+    Создает политику повторов по настройкам HOP_RETRY* из конфига.
+
+    :return: RetryPolicy или None, если повторы выключены
+    """
+    if not config.HOP_RETRIES:
+        return None
+    return RetryPolicy(config.HOP_RETRIES, config.HOP_RETRY_DELAY, config.HOP_RETRY_MAX_DELAY)
@@ -0,0 +1,80 @@
+# coding: utf-8
+from collections import defaultdict, deque
+
+
+class HostScheduler(object):
+    """
+    Очередь запросов с ограничением одновременных запросов на хост и на ip.
+
+    У каждого хоста своя очередь, хосты обходятся по кругу, поэтому
+    медленный или перегруженный хост не занимает все слоты движка.
+    Запрос, хост или ip которого уже исчерпал лимит, ждет, пока
+    завершится один из запросов к нему (done). Лимит None - без ограничения.
+    """
+
+    def __init__(self, host_limit=None, ip_limit=None):
+        self.host_limit = host_limit
+        self.ip_limit = ip_limit
+        self.queues = {}
+        self.ring = deque()
+        self.host_active = defaultdict(int)
+        self.ip_active = defaultdict(int)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, host, ip, item):
+        """
+        Ставит запрос к хосту host (с адресом ip, None - неизвестен) в очередь.
+        """
+        queue = self.queues.get(host)
+        if queue is None:
+            queue = self.queues[host] = deque()
+            self.ring.append(host)
+        queue.append((ip, item))
+        self.size += 1
+
+    def pop(self):
+        """
+        Берет запрос следующего по кругу хоста, у которого не исчерпаны лимиты,
+        и учитывает его как выполняющийся.
+
+        :return: хост, ip и запрос или None, если все запросы ждут
+        """
+        for _ in xrange(len(self.ring)):
+            host = self.ring[0]
+            self.ring.rotate(-1)
+            queue = self.queues[host]
+            ip, item = queue[0]
+            if not self._allowed(host, ip):
+                continue
+            queue.popleft()
+            if not queue:
+                del self.queues[host]
+                self.ring.pop()
+            self.size -= 1
+            self.host_active[host] += 1
+            if ip is not None:
+                self.ip_active[ip] += 1
+            return host, ip, item
+        return None
+
+    def done(self, host, ip):
+        """Учитывает завершение запроса, полученного через pop"""
+        self._decr(self.host_active, host)
+        if ip is not None:
+            self._decr(self.ip_active, ip)
+
+    def _allowed(self, host, ip):
+        if self.host_limit is not None and self.host_active.get(host, 0) >= self.host_limit:
+            return False
+        if ip is not None and self.ip_limit is not None and self.ip_active.get(ip, 0) >= self.ip_limit:
+            return False
+        return True
+
+    @staticmethod
+    def _decr(counters, key):
+        counters[key] -= 1
+        if counters[key] <= 0:
+            del counters[key]
@@ -0,0 +1,221 @@
+# coding: utf-8
+import cPickle as pickle
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+from hashlib import md5
+from threading import Lock
+from time import time
+
+SLOT_HEADER = struct.Struct('<QddI')
+"""Заголовок слота: хэш ключа (0 - слот свободен), время истечения, время последнего обращения, длина данных"""
+
+COUNTERS = ('hits', 'misses', 'evictions', 'expired', 'stores', 'too_big', 'corrupt')
+COUNTERS_HEADER = struct.Struct('<' + 'Q' * len(COUNTERS))
+
+
+class ProcessLock(object):
+    """
+    Блокировка между процессами, которую не может навсегда занять умерший процесс.
+
+    Процессы исключаются блокировкой записи (fcntl.lockf) на временном файле:
+    ядро снимает ее, когда владелец завершается, в том числе по SIGKILL или
+    terminate посреди операции. Такая блокировка принадлежит процессу, поэтому
+    потоки одного процесса дополнительно исключаются обычным Lock, который
+    создается заново в каждом процессе после fork.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.pid = None
+        self.thread_lock = None
+
+    def __enter__(self):
+        thread_lock = self._thread_lock()
+        thread_lock.acquire()
+        try:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+        except BaseException:
+            thread_lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def _thread_lock(self):
+        pid = os.getpid()
+        if self.pid != pid:
+            self.thread_lock = Lock()
+            self.pid = pid
+        return self.thread_lock
+
+    def close(self):
+        self.file.close()
+
+
+class SharedCache(object):
+    """
+    Кэш ключ -> значение с TTL в разделяемой памяти.
+
+    Память выделяется анонимным mmap, поэтому кэш общий для создавшего его процесса
+    и всех процессов, порожденных от него через fork после создания (воркеры
+    spawn_workers). Таблица наборно-ассоциативная: ключ попадает в один набор
+    из ways слотов фиксированного размера; если свободного слота в наборе нет,
+    вытесняется тот, к которому дольше всего не обращались (LRU).
+    Значения сериализуются pickle и не должны превышать slot_size.
+    Слот, который не удалось прочитать, освобождается и считается промахом.
+    """
+
+    def __init__(self, slots=4096, slot_size=2048, ttl=600, ways=8):
+        self.ways = min(ways, slots)
+        self.sets = max(slots // self.ways, 1)
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.lock = ProcessLock()
+        self.mm = mmap.mmap(-1, COUNTERS_HEADER.size + self.sets * self.ways * slot_size)
+
+    def get(self, key):
+        """
+        :return: значение или None, если ключа нет или запись устарела
+        """
+        key_hash = self._hash(key)
+        now = time()
+        with self.lock:
+            for offset in self._set_offsets(key_hash):
+                slot_hash, expires_at, _, length = SLOT_HEADER.unpack_from(self.mm, offset)
+                if slot_hash != key_hash:
+                    continue
+                if expires_at <= now:
+                    self._free(offset)
+                    self._incr('expired')
+                    break
+                data = self.mm[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length]
+                try:
+                    slot_key, value = pickle.loads(data)
+                except Exception:
+                    self._free(offset)
+                    self._incr('corrupt')
+                    break
+                if slot_key != key:
+                    break
+                SLOT_HEADER.pack_into(self.mm, offset, slot_hash, expires_at, now, length)
+                self._incr('hits')
+                return value
+            self._incr('misses')
+        return None
+
+    def set(self, key, value, ttl=None):
+        """
+        :return: False, если значение не помещается в слот
+        """
+        return self._store(key, value, ttl, replace=True)
+
+    def add(self, key, value, ttl=None):
+        """
+        Атомарно кладет значение, только если ключа в кэше нет (или запись устарела).
+
+        :return: False, если ключ уже есть или значение не помещается в слот
+        """
+        return self._store(key, value, ttl, replace=False)
+
+    def _store(self, key, value, ttl, replace):
+        data = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        if SLOT_HEADER.size + len(data) > self.slot_size:
+            with self.lock:
+                self._incr('too_big')
+            return False
+
+        key_hash = self._hash(key)
+        now = time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            if not replace and self._find(key_hash, now) is not None:
+                return False
+            target = self._victim(key_hash, now)
+            SLOT_HEADER.pack_into(self.mm, target, key_hash, expires_at, now, len(data))
+            self.mm[target + SLOT_HEADER.size:target + SLOT_HEADER.size + len(data)] = data
+            self._incr('stores')
+        return True
+
+    def delete(self, key):
+        key_hash = self._hash(key)
+        with self.lock:
+            for offset in self._set_offsets(key_hash):
+                if SLOT_HEADER.unpack_from(self.mm, offset)[0] == key_hash:
+                    self._free(offset)
+
+    def stats(self):
+        """
+        Статистика по всем процессам, использующим кэш.
+
+        :return: словарь счетчиков COUNTERS и доля попаданий hit_ratio
+        """
+        with self.lock:
+            result = dict(zip(COUNTERS, COUNTERS_HEADER.unpack_from(self.mm, 0)))
+        lookups = result['hits'] + result['misses']
+        result['hit_ratio'] = float(result['hits']) / lookups if lookups else 0.0
+        return result
+
+    def close(self):
+        self.mm.close()
+        self.lock.close()
+
+    def _hash(self, key):
+        return struct.unpack('<Q', md5(key).digest()[:8])[0] or 1
+
+    def _set_offsets(self, key_hash):
+        first = COUNTERS_HEADER.size + (key_hash % self.sets) * self.ways * self.slot_size
+        return xrange(first, first + self.ways * self.slot_size, self.slot_size)
+
+    def _find(self, key_hash, now):
+        """
+        :return: смещение действующей записи ключа или None
+        """
+        for offset in self._set_offsets(key_hash):
+            slot_hash, expires_at, _, _ = SLOT_HEADER.unpack_from(self.mm, offset)
+            if slot_hash == key_hash and expires_at > now:
+                return offset
+        return None
+
+    def _victim(self, key_hash, now):
+        """
+        Выбирает слот для записи ключа: слот с тем же ключом (в наборе ключ
+        должен быть не больше чем в одном слоте), иначе свободный или устаревший,
+        иначе вытесняется самый давно использованный.
+
+        :return: смещение слота
+        """
+        free_offset = None
+        lru_offset, lru_used_at = None, None
+        for offset in self._set_offsets(key_hash):
+            slot_hash, slot_expires_at, used_at, _ = SLOT_HEADER.unpack_from(self.mm, offset)
+            if slot_hash == key_hash:
+                return offset
+            if free_offset is None and (slot_hash == 0 or slot_expires_at <= now):
+                free_offset = offset
+            if lru_used_at is None or used_at < lru_used_at:
+                lru_offset, lru_used_at = offset, used_at
+        if free_offset is not None:
+            return free_offset
+        self._incr('evictions')
+        return lru_offset
+
+    def _free(self, offset):
+        SLOT_HEADER.pack_into(self.mm, offset, 0, 0, 0, 0)
+
+    def _incr(self, name):
+        offset = COUNTERS.index(name) * 8
+        value = struct.unpack_from('<Q', self.mm, offset)[0]
+        struct.pack_into('<Q', self.mm, offset, value + 1)
+
+
+def create_shared_cache(slots, slot_size, ttl):
+    """
+    :return: SharedCache или None, если slots = 0 (кэш выключен)
+    """
+    if not slots:
+        return None
+    return SharedCache(slots=slots, slot_size=slot_size, ttl=ttl)
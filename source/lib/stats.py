@@ -0,0 +1,76 @@
+# coding: utf-8
+from collections import defaultdict
+from time import time
+
+
+class Stats(object):
+    """
+    Счетчики и тайминги текущего процесса.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = {}
+        self.gauges = {}
+        self.reported_at = time()
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def timing(self, name, seconds):
+        """
+        Учитывает длительность операции name.
+
+        :param seconds: длительность в секундах
+        :type seconds: float
+        """
+        count, total, maximum = self.timings.get(name, (0, 0.0, 0.0))
+        self.timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def gauge(self, name, value):
+        """
+        Запоминает текущее значение величины name (например, число открытых предохранителей).
+        """
+        self.gauges[name] = value
+
+    def ratio(self, hit_name, miss_name):
+        """
+        Доля попаданий, например переиспользования хэндлов или кэша.
+        """
+        hits = self.counters[hit_name]
+        total = hits + self.counters[miss_name]
+        return float(hits) / total if total else 0.0
+
+    def snapshot(self):
+        """
+        :return: словарь имя -> значение; для таймингов count, avg и max
+        """
+        result = dict(self.counters)
+        result.update(self.gauges)
+        for name, (count, total, maximum) in self.timings.iteritems():
+            result[name + '.count'] = count
+            result[name + '.avg'] = total / count
+            result[name + '.max'] = maximum
+        return result
+
+    def reset(self):
+        self.counters.clear()
+        self.timings.clear()
+        self.gauges.clear()
+
+    def report(self, logger, interval):
+        """
+        Пишет снимок статистики в лог, если с прошлого отчета прошло не меньше interval секунд.
+        """
+        now = time()
+        if now - self.reported_at < interval:
+            return False
+        self.reported_at = now
+        logger.info(u'Stats: {}'.format(', '.join(
+            '{}={}'.format(name, value) for name, value in sorted(self.snapshot().iteritems())
+        )))
+        return True
+
+
+stats = Stats()
+"""Статистика процесса"""
@@ -0,0 +1,111 @@
+# coding: utf-8
+from logging import getLogger
+from time import time
+
+from tarantool.error import DatabaseError
+
+from .stats import stats
+
+logger = getLogger('redirect_checker')
+
+
+class TaskBatcher(object):
+    """
+    Пакетная работа воркера с очередями.
+
+    take забирает до batch_size задач за раз: ждет только первую, остальные
+    забираются без ожидания, если уже готовы. Результаты задач (put в очередь)
+    и подтверждения (ack) копятся и отправляются пачкой, когда накопилось
+    batch_size задач или с прошлой отправки прошло flush_interval секунд.
+    Результат задачи всегда кладется в очередь раньше, чем задача подтверждается.
+
+    Если задан ttr (время, через которое очередь возвращает взятую задачу,
+    queue.default.ttr в provision/init.lua), задача, ждавшая в пачке дольше
+    половины ttr, перед проверкой продлевается (см. start).
+    """
+
+    def __init__(self, input_tube, batch_size=1, flush_interval=0, ttr=None):
+        self.input_tube = input_tube
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ttr = ttr
+        self.pending = []
+        self.taken_at = {}
+        self.flushed_at = time()
+
+    def take(self, timeout, limit=None):
+        """
+        :param timeout: сколько ждать первую задачу
+        :param limit: взять не больше limit задач (но не больше batch_size)
+        :return: список задач, пустой, если задач нет
+        """
+        task = self.input_tube.take(timeout)
+        if not task:
+            return []
+        tasks = [task]
+        count = self.batch_size if limit is None else min(limit, self.batch_size)
+        while len(tasks) < count:
+            task = self.input_tube.take(0)
+            if not task:
+                break
+            tasks.append(task)
+        stats.incr('queue.taken', len(tasks))
+        if self.ttr is not None:
+            now = time()
+            for task in tasks[1:]:
+                self.taken_at[task.task_id] = now
+        return tasks
+
+    def start(self, task):
+        """
+        Вызывается перед проверкой задачи из пачки. Если задача ждала в пачке
+        дольше половины ttr, ее ttr продлевается (touch), чтобы за время
+        проверки очередь не отдала ее другому воркеру.
+
+        :return: False, если задачу уже нельзя проверять: продлить не удалось,
+                 очередь ее уже вернула
+        """
+        taken_at = self.taken_at.pop(task.task_id, None)
+        if taken_at is None or time() - taken_at < self.ttr / 2.0:
+            return True
+        try:
+            task.touch()
+        except DatabaseError as e:
+            logger.info(u'Task id={} expired in batch, skipped: {}'.format(task.task_id, e))
+            stats.incr('queue.expired')
+            return False
+        stats.incr('queue.touched')
+        return True
+
+    def done(self, task, tube=None, data=None, **kwargs):
+        """
+        Откладывает завершение задачи: при отправке data будет положена
+        в tube (put с параметрами kwargs), затем задача будет подтверждена.
+        Если tube не задан, задача только подтверждается.
+        """
+        self.pending.append((task, tube, data, kwargs))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush_if_due(self):
+        """Отправляет накопленное, если прошло flush_interval секунд"""
+        if self.pending and time() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Отправляет все накопленные результаты и подтверждения"""
+        pending, self.pending = self.pending, []
+        started = self.flushed_at = time()
+        for task, tube, data, kwargs in pending:
+            if tube is not None:
+                tube.put(data, **kwargs)
+        for task, _, _, _ in pending:
+            try:
+                task.ack()
+                logger.info(u'Task id={} done'.format(task.task_id))
+            except DatabaseError as e:
+                logger.info('Task ack fail')
+                logger.exception(e)
+        if pending:
+            stats.incr('queue.flushed', len(pending))
+            stats.timing('queue.flush', time() - started)
@@ -1,6 +1,7 @@
 # coding: utf-8
 import argparse
-from multiprocessing import Process
+import ctypes
+from multiprocessing import Process, cpu_count
 import os
 import socket
 import urllib2
@@ -123,6 +124,73 @@ def spawn_workers(num, target, args, parent_pid):
         p.start()
 
 
+def sort_by_start(workers):
+    """
+    Упорядочивает процессы-воркеры от запущенных раньше к запущенным позже.
+
+    active_children() отдает процессы в произвольном порядке, а pid после
+    переполнения счетчика не растет со временем запуска, поэтому порядок
+    берется из номера, который multiprocessing дает процессам при создании.
+    """
+    return sorted(workers, key=lambda worker: worker._identity)
+
+
+PR_SET_PDEATHSIG = 1
+
+
+def set_parent_death_signal(signum):
+    """
+    Просит ядро прислать процессу сигнал signum, когда завершится родитель
+    (prctl PR_SET_PDEATHSIG, только Linux). prctl берется из уже загруженной
+    в процесс libc, без поиска библиотеки (find_library запускает ldconfig).
+
+    :return: True, если сигнал установлен
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_PDEATHSIG, signum, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def parent_is_alive(parent_pid):
+    """
+    Проверка без обращения к /proc: после смерти родителя процесс
+    переходит к другому родителю (init или subreaper).
+    """
+    return os.getppid() == parent_pid
+
+
+def get_load_per_cpu():
+    """
+    :return: load average за минуту на одно ядро или None, если недоступен
+    """
+    try:
+        return os.getloadavg()[0] / cpu_count()
+    except (OSError, NotImplementedError):
+        return None
+
+
+def get_rss(pids):
+    """
+    Суммарная резидентная память процессов по /proc (только Linux).
+
+    :return: байты или None, если /proc недоступен
+    """
+    if not os.path.exists('/proc/self/statm'):
+        return None
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * page_size
+        except IOError:
+            # процесс уже завершился
+            pass
+    return total
+
+
 def check_network_status(check_url, timeout):
     try:
         urllib2.urlopen(
@@ -1,30 +1,82 @@
 # coding: utf-8
+import codecs
+from importlib import import_module
 from logging import getLogger
-import os.path
+import signal
+from time import time
 
+import gevent
+from gevent import GreenletExit, queue as gevent_queue
+from gevent.monkey import patch_all
+from gevent.pool import Pool
+import pkg_resources
 from tarantool.error import DatabaseError
-from . import to_unicode, get_redirect_history
 
-from utils import get_tube
+from . import DEFAULT_CONTEXT, CounterDetector, to_unicode, check_for_meta_with_soup, get_redirect_history
+
+from curl_pool import create_curl_pool
+from drain import Drain, DrainTimeout
+from gevent_curl import GeventCurlPerformer
+from multi import create_redirect_engine
+from retry import create_retry_policy
+from stats import stats
+from task_batcher import TaskBatcher
+from utils import get_tube, parent_is_alive, set_parent_death_signal
 
 logger = getLogger('redirect_checker')
 
 history_type_error = "ERROR"
 task_data_suspicious = 'suspicious'
 
+WORKER_MODE_PROCESS = 'process'
+WORKER_MODE_GEVENT = 'gevent'
+WORKER_MODE_ENGINE = 'engine'
+
+ENGINE_POLL_INTERVAL = 0.1
+"""Как часто engine_worker опрашивает пустую очередь и проверяет сигналы, пока идут проверки"""
+
+GEVENT_PATCHED_MODULES = (
+    'gevent.builtins', 'gevent.os', 'gevent.select', 'gevent.signal', 'gevent.socket', 'gevent.ssl',
+    'gevent.subprocess', 'gevent.thread', 'gevent.threading', 'gevent.time',
+)
+"""Модули gevent, которые подгружает patch_all; части из них в старых версиях gevent нет"""
+
+GEVENT_PLUGINS_MODULE = 'gevent.events'
+"""С этим модулем (gevent 1.3) patch_all стал искать плагины через pkg_resources"""
+
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
+def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None, context=DEFAULT_CONTEXT):
+    url = get_task_url(task)
+    history = get_redirect_history(
+        url, timeout, max_redirects, user_agent, context
+    )
+    return get_task_result(task, history)
+
+
+def get_task_url(task):
+    """
+    :return: урл, который проверяет задача
+    """
     url = to_unicode(task.data['url'], 'ignore')
     is_recheck = bool(task.data.get('recheck'))
 
     logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
         task.task_id, url, task.data["url_id"], is_recheck
     ))
+    return url
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
+
+def get_task_result(task, history):
+    """
+    :param history: результат get_redirect_history для урла задачи
+    :return: нужна ли перепроверка и данные для входной или выходной очереди
+    """
+    history_types, history_urls, counters = history
+    is_recheck = bool(task.data.get('recheck'))
+    if fetch_meter is not None:
+        fetch_meter.record(history_type_error in history_types)
     if history_type_error in history_types and not is_recheck:
+        stats.incr('task.recheck')
         task.data['recheck'] = True
         data = task.data
         is_input = True
@@ -41,7 +93,43 @@ def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=N
     return is_input, data
 
 
-def worker(config, parent_pid):
+task_meter = None
+"""Общий для воркеров учет проверенных задач (TaskMeter), по нему супервизор масштабирует пул"""
+
+
+def set_task_meter(meter):
+    global task_meter
+    task_meter = meter
+
+
+fetch_meter = None
+"""Общий для воркеров учет ошибок загрузки (FetchMeter), по нему супервизор судит о сети"""
+
+
+def set_fetch_meter(meter):
+    global fetch_meter
+    fetch_meter = meter
+
+
+def prepare_worker(config, context):
+    """
+    Дополняет окружение проверки context, полученное от супервизора через fork,
+    тем, что у каждого воркера свое: пулом хэндлов, правилами счетчиков,
+    лимитами тела ответа и повторами по конфигу.
+    Статистика, унаследованная от супервизора, сбрасывается.
+    """
+    stats.reset()
+    context.handle_pool = create_curl_pool(config)
+    context.counter_detector = CounterDetector(config.COUNTER_RULES)
+    context.head_limit = config.HTTP_HEAD_BYTES_LIMIT
+    context.body_limit = config.HTTP_BODY_BYTES_LIMIT
+    context.retry_policy = create_retry_policy(config)
+
+
+def connect_tubes(config):
+    """
+    :return: входная и выходная очереди воркера
+    """
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
@@ -67,36 +155,310 @@ def worker(config, parent_pid):
         space=output_tube.queue.space,
         name=output_tube.opt['tube']
     ))
+    return input_tube, output_tube
 
-    parent_proc = '/proc/{}'.format(parent_pid)
-
-    # run while parent is alive
-    while os.path.exists(parent_proc):
-        task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
-        if task:
-            logger.info(u'Starting task id={}.'.format(task.task_id))
-            result = get_redirect_history_from_task(
-                task,
-                config.HTTP_TIMEOUT,
-                config.MAX_REDIRECTS,
-                config.USER_AGENT
+
+def check_task(task, config, context):
+    logger.info(u'Starting task id={}.'.format(task.task_id))
+    started = time()
+    try:
+        return get_redirect_history_from_task(
+            task,
+            config.HTTP_TIMEOUT,
+            config.MAX_REDIRECTS,
+            config.USER_AGENT,
+            context
+        )
+    finally:
+        if task_meter is not None:
+            task_meter.record(time() - started)
+
+
+def complete_task(task, result, batcher, input_tube, output_tube, config):
+    """
+    Отправляет результат проверки: на перепроверку во входную очередь или в выходную.
+    """
+    if result:
+        is_input, data = result
+        if is_input:
+            batcher.done(
+                task, input_tube, data,
+                delay=config.RECHECK_DELAY,
+                pri=task.meta()['pri']
             )
-            if result:
-                is_input, data = result
-                if is_input:
-                    input_tube.put(
-                        data,
-                        delay=config.RECHECK_DELAY,
-                        pri=task.meta()['pri']
-                    )
-                else:
-                    output_tube.put(data)
-                logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+        else:
+            batcher.done(task, output_tube, data)
+        logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+    else:
+        batcher.done(task)
+
+
+def preload_worker(config):
+    """
+    Прогревает супервизор как шаблон воркеров, вызывается до их запуска.
+
+    Воркеры - fork супервизора и получают уже импортированные им модули,
+    но часть работы откладывается до первого использования и повторялась бы
+    в каждом новом воркере: загрузка кодека idna (prepare_url), сборка парсера
+    BeautifulSoup, а для gevent-воркеров - импорт модулей, подменяемых
+    patch_all, и разбор зависимостей плагинов gevent в pkg_resources,
+    который patch_all делает при каждом вызове (около 200 мс на воркер).
+    Соединения с очередями и curl-хэндлы по-прежнему создаются в воркере.
+    """
+    codecs.lookup('idna')
+    check_for_meta_with_soup('<html></html>', 'http://localhost/')
+    if config.WORKER_MODE == WORKER_MODE_GEVENT:
+        import_existing_modules(GEVENT_PATCHED_MODULES)
+        if not import_existing_modules([GEVENT_PLUGINS_MODULE]):
+            return
+        try:
+            pkg_resources.require('gevent')
+        except pkg_resources.ResolutionError as e:
+            logger.warning(u'gevent plugins are not preloaded: {}'.format(e))
+
+
+def import_existing_modules(names):
+    """
+    Импортирует модули names, пропуская те, которых нет.
+
+    :return: имена импортированных модулей
+    """
+    imported = []
+    for name in names:
+        try:
+            import_module(name)
+        except ImportError:
+            continue
+        imported.append(name)
+    return imported
+
+
+def worker_ready(started):
+    """Учитывает время от запуска воркера до готовности взять первую задачу"""
+    elapsed = time() - started
+    stats.timing('worker.startup', elapsed)
+    logger.info(u'Worker ready in {:.1f} ms'.format(elapsed * 1000))
+
+
+def release_task(task):
+    """Возвращает в очередь задачу, проверку которой прервала остановка воркера"""
+    logger.info(u'Task id={} released on drain'.format(task.task_id))
+    stats.incr('drain.released')
+    try:
+        task.release()
+    except DatabaseError as e:
+        logger.exception(e)
+
+
+def get_worker(config):
+    """
+    :return: функция воркера для режима WORKER_MODE и сколько процессов-воркеров держать
+    """
+    if config.WORKER_MODE == WORKER_MODE_GEVENT:
+        return event_loop_worker, config.EVENT_LOOP_PROCESSES
+    if config.WORKER_MODE == WORKER_MODE_ENGINE:
+        return engine_worker, config.EVENT_LOOP_PROCESSES
+    return worker, config.WORKER_POOL_SIZE
+
+
+def worker(config, context, parent_pid):
+    started = time()
+    set_parent_death_signal(signal.SIGTERM)
+    input_tube, output_tube = connect_tubes(config)
+
+    prepare_worker(config, context)
+    batcher = TaskBatcher(input_tube, config.QUEUE_BATCH_SIZE, config.QUEUE_FLUSH_INTERVAL, config.QUEUE_TASK_TTR)
+    drain = Drain(config.DRAIN_TIMEOUT)
+    drain.install()
+    context.interrupt_check = drain.check_deadline
+    worker_ready(started)
+
+    # run while parent is alive; a dead parent also kills the worker with SIGTERM
+    while parent_is_alive(parent_pid) and not drain.requested:
+        for task in batcher.take(config.QUEUE_TAKE_TIMEOUT):
+            if drain.requested:
+                release_task(task)
+                continue
+            if not batcher.start(task):
+                continue
             try:
-                task.ack()
-                logger.info(u'Task id={} done'.format(task.task_id))
-            except DatabaseError as e:
-                logger.info('Task ack fail')
-                logger.exception(e)
+                result = drain.run(check_task, task, config, context)
+            except DrainTimeout:
+                release_task(task)
+                continue
+            complete_task(task, result, batcher, input_tube, output_tube, config)
+            batcher.flush_if_due()
+        batcher.flush_if_due()
+        stats.report(logger, config.STATS_INTERVAL)
+    else:
+        batcher.flush()
+        logger.info('Worker drained. exiting' if drain.requested else 'Parent is dead. exiting')
+
+
+def check_task_in_greenlet(task, config, context, checked_tasks):
+    """
+    Проверка задачи в гринлете; результат кладется в checked_tasks,
+    с очередями работает только основной цикл event_loop_worker.
+    """
+    try:
+        checked_tasks.put((task, check_task(task, config, context), None))
+    except GreenletExit:
+        checked_tasks.put((task, None, DrainTimeout()))
+    except Exception as e:
+        logger.exception(e)
+        checked_tasks.put((task, None, e))
+
+
+def complete_checked_tasks(checked_tasks, batcher, input_tube, output_tube, config):
+    while True:
+        try:
+            task, result, error = checked_tasks.get_nowait()
+        except gevent_queue.Empty:
+            break
+        if isinstance(error, DrainTimeout):
+            release_task(task)
+        elif error is not None:
+            logger.info(u'Task id={} failed, releasing'.format(task.task_id))
+            task.release(delay=config.RECHECK_DELAY)
+        else:
+            complete_task(task, result, batcher, input_tube, output_tube, config)
+
+
+def get_worker_concurrency(config):
+    """
+    :return: сколько задач одновременно проверяет один процесс-воркер режима WORKER_MODE
+    """
+    if config.WORKER_MODE in (WORKER_MODE_GEVENT, WORKER_MODE_ENGINE):
+        return get_tasks_in_flight(config)
+    return 1
+
+
+def get_tasks_in_flight(config):
+    """
+    :return: сколько задач одновременно проверяет один процесс event_loop_worker или engine_worker
+    """
+    return max(1, config.WORKER_POOL_SIZE // config.EVENT_LOOP_PROCESSES)
+
+
+def event_loop_worker(config, context, parent_pid):
+    """
+    Воркер, проверяющий несколько задач одновременно в гринлетах
+    (WORKER_POOL_SIZE задач на все EVENT_LOOP_PROCESSES процессов).
+
+    Запросы curl выполняются кооперативно (GeventCurlPerformer), задачи
+    берутся из очереди, пока в пуле есть свободные гринлеты.
+    При остановке (Drain) проверки, не закончившиеся за DRAIN_TIMEOUT,
+    прерываются, а их задачи возвращаются в очередь.
+    """
+    started = time()
+    set_parent_death_signal(signal.SIGTERM)
+    patch_all()
+    tasks_in_flight = get_tasks_in_flight(config)
+    input_tube, output_tube = connect_tubes(config)
+
+    prepare_worker(config, context)
+    context.performer = GeventCurlPerformer(config.ENGINE_HOST_CONCURRENCY, config.ENGINE_IP_CONCURRENCY)
+    batcher = TaskBatcher(input_tube, config.QUEUE_BATCH_SIZE, config.QUEUE_FLUSH_INTERVAL)
+    pool = Pool(tasks_in_flight)
+    logger.info(u'Event loop worker, tasks in flight={}'.format(tasks_in_flight))
+    checked_tasks = gevent_queue.Queue()
+    drain = Drain()
+    drain.install()
+    worker_ready(started)
+
+    # run while parent is alive; a dead parent also kills the worker with SIGTERM
+    while parent_is_alive(parent_pid) and not drain.requested:
+        free_count = pool.free_count()
+        if free_count:
+            for task in batcher.take(config.QUEUE_TAKE_TIMEOUT, free_count):
+                pool.spawn(check_task_in_greenlet, task, config, context, checked_tasks)
+        else:
+            # Pool.wait_available(timeout) есть только с gevent 1.1, ждем завершения любой проверки
+            gevent.wait(list(pool.greenlets), config.QUEUE_TAKE_TIMEOUT, count=1)
+        complete_checked_tasks(checked_tasks, batcher, input_tube, output_tube, config)
+        batcher.flush_if_due()
+        stats.report(logger, config.STATS_INTERVAL)
+    else:
+        if drain.requested:
+            pool.join(config.DRAIN_TIMEOUT)
+            pool.kill()
+        else:
+            pool.join()
+        complete_checked_tasks(checked_tasks, batcher, input_tube, output_tube, config)
+        batcher.flush()
+        logger.info('Worker drained. exiting' if drain.requested else 'Parent is dead. exiting')
+
+
+def start_engine_check(engine, task, checking, checked_tasks):
+    """
+    Ставит задачу на проверку в движок; результат кладется в checked_tasks.
+
+    :param checking: проверяемые задачи, task_id -> (задача, время начала проверки)
+    """
+    checking[task.task_id] = (task, time())
+    engine.add(get_task_url(task), lambda history: checked_tasks.append((task, history)))
+
+
+def complete_engine_checks(checking, checked_tasks, batcher, input_tube, output_tube, config):
+    while checked_tasks:
+        task, history = checked_tasks.pop(0)
+        _, started = checking.pop(task.task_id)
+        if task_meter is not None:
+            task_meter.record(time() - started)
+        complete_task(task, get_task_result(task, history), batcher, input_tube, output_tube, config)
+        batcher.flush_if_due()
+
+
+def engine_worker(config, context, parent_pid):
+    """
+    Воркер, проверяющий несколько задач одновременно в одном RedirectEngine
+    (WORKER_POOL_SIZE задач на все EVENT_LOOP_PROCESSES процессов).
+
+    Хопы всех задач процесса идут через один CurlMulti с лимитами ENGINE_*
+    на соединения, хост и ip. Задачи берутся из очереди, пока проверяется
+    меньше задач, чем положено процессу; пока движок занят, пустая очередь
+    опрашивается не чаще раза в ENGINE_POLL_INTERVAL.
+    При остановке (Drain) проверки, не закончившиеся за DRAIN_TIMEOUT,
+    бросаются, а их задачи возвращаются в очередь.
+    """
+    started = time()
+    set_parent_death_signal(signal.SIGTERM)
+    tasks_in_flight = get_tasks_in_flight(config)
+    input_tube, output_tube = connect_tubes(config)
+
+    prepare_worker(config, context)
+    engine = create_redirect_engine(config, context.handle_pool, context)
+    batcher = TaskBatcher(input_tube, config.QUEUE_BATCH_SIZE, config.QUEUE_FLUSH_INTERVAL)
+    logger.info(u'Engine worker, tasks in flight={}'.format(tasks_in_flight))
+    checking = {}
+    checked_tasks = []
+    next_take = 0
+    drain = Drain()
+    drain.install()
+    worker_ready(started)
+
+    # run while parent is alive; a dead parent also kills the worker with SIGTERM
+    while parent_is_alive(parent_pid) and not drain.requested:
+        free_count = tasks_in_flight - len(checking)
+        busy = engine.has_work()
+        if free_count and (not busy or time() >= next_take):
+            tasks = batcher.take(0 if busy else config.QUEUE_TAKE_TIMEOUT, free_count)
+            if len(tasks) < free_count:
+                next_take = time() + ENGINE_POLL_INTERVAL
+            for task in tasks:
+                start_engine_check(engine, task, checking, checked_tasks)
+        if engine.has_work():
+            engine.step(ENGINE_POLL_INTERVAL)
+        complete_engine_checks(checking, checked_tasks, batcher, input_tube, output_tube, config)
+        batcher.flush_if_due()
+        stats.report(logger, config.STATS_INTERVAL)
     else:
-        logger.info('Parent is dead. exiting')
+        deadline = time() + config.DRAIN_TIMEOUT if drain.requested else None
+        while engine.has_work() and (deadline is None or time() < deadline):
+            engine.step(ENGINE_POLL_INTERVAL)
+            complete_engine_checks(checking, checked_tasks, batcher, input_tube, output_tube, config)
+        for task, _ in checking.values():
+            release_task(task)
+        engine.close()
+        batcher.flush()
+        logger.info('Worker drained. exiting' if drain.requested else 'Parent is dead. exiting')
@@ -6,19 +6,27 @@ import logging
 import os
 import signal
 import sys
+from functools import partial
 from logging.config import dictConfig
 from threading import current_thread
+from time import time
+from urlparse import urlparse
 
 import gevent
-from gevent import Greenlet
 from gevent import queue as gevent_queue
 from gevent import sleep
+from gevent.lock import RLock, Semaphore
 from gevent.monkey import patch_all
 from gevent.pool import Pool
 import requests
 import tarantool
 import tarantool_queue
 
+from source.lib.delivery_batcher import create_delivery_batcher
+from source.lib.host_guard import create_host_guard
+from source.lib.http_pool import create_http_session
+from source.lib.retry import create_task_retry_policy
+from source.lib.stats import stats
 from source.lib.utils import parse_cmd_args, daemonize, create_pidfile, load_config_from_pyfile, get_tube
 
 
@@ -31,12 +39,85 @@ run = True
 exit_code = 0
 """Код возврата приложения"""
 
+http_session = None
+"""Общая для обработчиков HTTP-сессия с пулом keep-alive соединений по хостам"""
+
+host_guard = None
+"""Перегородки и предохранители по хостам уведомлений"""
+
+retry_policy = None
+"""Политика повторной отправки уведомлений после ошибок запроса"""
+
+delivery_batcher = None
+"""Сборщик уведомлений на один callback_url в пачки"""
+
 empty_queue_msg = "empty_queue"
 task_ack = 'ack'
 task_bury = 'bury'
+task_retry = 'retry'
+
+retry_key = 'pusher_retry'
+"""Ключ данных задачи со сведениями о повторах: номер попытки и id исходной задачи"""
+
+queue_time_unit = 1000000.0
+"""Число единиц времени tarantool.queue (микросекунд) в секунде: в них meta задачи хранит ttl и ttr"""
 
 logger = logging.getLogger('pusher')
 
+
+def callback_host(task):
+    """
+    :return: хост, на который отправляется уведомление задачи
+    """
+    return urlparse((task.data or {}).get('callback_url', '')).netloc
+
+
+def task_retry_info(task):
+    """
+    :return: номер попытки отправки задачи (с нуля) и id исходной задачи
+    """
+    info = (task.data or {}).get(retry_key) or {}
+    return info.get('attempt', 0), info.get('task_id', task.task_id)
+
+
+def notification_payload(task):
+    """
+    :return: callback_url задачи, данные уведомления (с id исходной задачи) и номер попытки
+    """
+    data = task.data.copy()
+    url = data.pop('callback_url')
+    attempt, data['id'] = task_retry_info(task)
+    data.pop(retry_key, None)
+    return url, data, attempt
+
+
+def fail_task(task, attempt, task_queue):
+    """
+    Отправляет задачу после неудачной попытки attempt на повтор, а исчерпавшую попытки - хоронит.
+    """
+    if retry_policy.should_retry(attempt):
+        task_queue.put((task, task_retry))
+        return
+    logger.info('Task id={task_id} exhausted {attempts} attempts.'.format(
+        task_id=task.task_id, attempts=attempt + 1
+    ))
+    stats.incr('retry.exhausted')
+    task_queue.put((task, task_bury))
+
+
+def rejected_notification_ids(response):
+    """
+    :return: id уведомлений пачки, которые партнер не принял (список failed в JSON-ответе)
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        return set()
+    if not isinstance(body, dict):
+        return set()
+    return set(body.get('failed') or ())
+
+
 def notification_worker(task, task_queue, *args, **kwargs):
     """
     Обработчик задачи отправки уведомления.
@@ -47,18 +128,22 @@ def notification_worker(task, task_queue, *args, **kwargs):
     :type task_queue: gevent.queue.Queue
     :param args:
     :param kwargs:
+
+    Запрос к хосту уведомления должен быть заранее разрешен host_guard.acquire;
+    ошибки запроса и ответы 5xx учитываются предохранителем хоста. После ошибки
+    запроса задача повторяется по retry_policy, а исчерпав попытки, хоронится.
     """
+    failed = True
     try:
         current_thread().name = "pusher.worker#{task_id}".format(task_id=task.task_id)
-        data = task.data.copy()
-        url = data.pop('callback_url')
-        data['id'] = task.task_id
+        url, data, attempt = notification_payload(task)
 
         logger.info('Send data to callback url [{url}].'.format(url=url))
 
-        response = requests.post(
+        response = http_session.post(
             url, data=json.dumps(data), *args, **kwargs
         )
+        failed = response.status_code >= 500
         logger.info('Callback url [{url}] response status code={status_code}.'.format(
             url=url, status_code=response.status_code
         ))
@@ -66,7 +151,232 @@ def notification_worker(task, task_queue, *args, **kwargs):
         task_queue.put((task, task_ack))
     except requests.RequestException as exc:
         logger.exception(exc)
-        task_queue.put((task, task_bury))
+        fail_task(task, attempt, task_queue)
+    finally:
+        host_guard.release(callback_host(task), failed)
+
+
+def notification_batch_worker(url, tasks, task_queue, *args, **kwargs):
+    """
+    Обработчик пачки задач с одним callback_url: уведомления отправляются
+    одним запросом в виде JSON-массива.
+
+    Задачи, id уведомлений которых партнер вернул в списке failed JSON-ответа
+    ({"failed": [id, ...]}), повторяются по retry_policy, остальные подтверждаются;
+    после ошибки запроса или ответа 5xx повторяются все задачи пачки. Прочие ответы,
+    как и для одиночной задачи, окончательны: повтор запроса, отвергнутого с 4xx,
+    не поможет. Запрос к хосту должен быть заранее разрешен host_guard.acquire.
+
+    :param tasks: задачи пачки
+    :param task_queue: очередь для обработанных задач
+    :type task_queue: gevent.queue.Queue
+    """
+    failed = True
+    try:
+        current_thread().name = "pusher.batch#{task_id}".format(task_id=tasks[0].task_id)
+        payloads = [notification_payload(task) for task in tasks]
+
+        logger.info('Send {count} notifications to callback url [{url}].'.format(count=len(tasks), url=url))
+
+        response = http_session.post(
+            url, data=json.dumps([data for _, data, _ in payloads]), *args, **kwargs
+        )
+        failed = response.status_code >= 500
+        logger.info('Callback url [{url}] response status code={status_code}.'.format(
+            url=url, status_code=response.status_code
+        ))
+        rejected = None if failed else rejected_notification_ids(response)
+    except requests.RequestException as exc:
+        logger.exception(exc)
+        rejected = None
+    finally:
+        host_guard.release(urlparse(url).netloc, failed)
+
+    for task, (_, data, attempt) in zip(tasks, payloads):
+        if rejected is None or data['id'] in rejected:
+            fail_task(task, attempt, task_queue)
+        else:
+            task_queue.put((task, task_ack))
+
+
+def spawn_batch_worker(worker_pool, processed_task_queue, config, url, tasks):
+    """
+    Запускает в пуле обработчик пачки задач, собранной delivery_batcher.
+    """
+    worker_pool.spawn(
+        notification_batch_worker,
+        url,
+        tasks,
+        processed_task_queue,
+        timeout=config.HTTP_CONNECTION_TIMEOUT,
+        verify=False
+    )
+
+
+def take_tasks(tube, prefetched, prefetch_slots, take_timeout):
+    """
+    Берет задачи из очереди в буфер prefetched (кортежи (задача, время взятия)).
+
+    Задача берется, только когда в буфере есть место (prefetch_slots), поэтому
+    взятые задачи не копятся и не ждут обработчика дольше необходимого (TTR).
+    Задачи берутся через свое соединение tube, и через него же они потом
+    завершаются (см. connect_tube), поэтому после каждого take соединение
+    уступается гринлетам, которые ждут его блокировку.
+
+    :param prefetch_slots: семафор на размер буфера, освобождает тот, кто достал задачу из буфера
+    :type prefetch_slots: gevent.lock.Semaphore
+    """
+    while run:
+        prefetch_slots.acquire()
+        with tube.queue.tarantool_lock:
+            task = tube.take(take_timeout)
+        if task:
+            prefetched.put((task, time()))
+        else:
+            prefetch_slots.release()
+        gevent.sleep(0)
+
+
+def stop_takers(takers, tubes):
+    """
+    Останавливает гринлеты take_tasks. Гринлет не прерывается посреди take:
+    ответ сервера остался бы в соединении и достался бы следующему запросу.
+    """
+    for taker, tube in zip(takers, tubes):
+        with tube.queue.tarantool_lock:
+            taker.kill()
+
+
+def dispatch_task(task, taken_at, worker_pool, processed_task_queue, config):
+    """
+    Отдает задачу обработчику, как только в пуле освободится место.
+    Задачу, которая со взятия прождала дольше config.QUEUE_PREFETCH_MAX_AGE
+    (и рискует истечь по TTR во время отправки), возвращает в очередь.
+    Задачу для хоста, которому host_guard сейчас не дает запросов (перегородка
+    заполнена или предохранитель разомкнут), откладывает на config.HOST_DEFER_DELAY секунд.
+
+    Задача на адрес, уведомления на который отправляются пачками, не ждет места
+    в пуле, если для адреса уже открыта пачка, а иначе открывает новую пачку.
+    """
+    url = (task.data or {}).get('callback_url')
+    if delivery_batcher.join(url, task):
+        return
+
+    worker_pool.wait_available()
+    waited = time() - taken_at
+    stats.timing('dispatch.prefetch_wait', waited)
+    if waited > config.QUEUE_PREFETCH_MAX_AGE:
+        logger.info('Release stale task id={task_id}.'.format(task_id=task.task_id))
+        stats.incr('dispatch.stale')
+        release_task(task)
+        return
+
+    host = callback_host(task)
+    if not host_guard.acquire(host):
+        logger.info('Defer task id={task_id} for host [{host}].'.format(task_id=task.task_id, host=host))
+        stats.incr('dispatch.deferred')
+        release_task(task, delay=config.HOST_DEFER_DELAY)
+        return
+
+    if delivery_batcher.accepts(url):
+        logger.info('Open batch for callback url [{url}] with task id={task_id}.'.format(url=url, task_id=task.task_id))
+        delivery_batcher.open(url, task)
+        return
+
+    logger.info('Start worker for task id={task_id}.'.format(task_id=task.task_id))
+    worker_pool.spawn(
+        notification_worker,
+        task,
+        processed_task_queue,
+        timeout=config.HTTP_CONNECTION_TIMEOUT,
+        verify=False
+    )
+
+
+def release_task(task, **kwargs):
+    """
+    Возвращает задачу в очередь через соединение, которое ее взяло.
+
+    :param kwargs: параметры release (delay, ttl)
+    """
+    try:
+        with task.queue.tarantool_lock:
+            task.release(**kwargs)
+    except tarantool.DatabaseError as exc:
+        logger.exception(exc)
+
+
+def release_tasks(tasks):
+    """
+    Возвращает задачи в очередь.
+    """
+    for task in tasks:
+        release_task(task)
+
+
+def release_prefetched_tasks(prefetched):
+    """
+    Возвращает в очередь задачи, взятые в буфер, но не отданные обработчикам.
+    """
+    tasks = []
+    while True:
+        try:
+            task, _ = prefetched.get_nowait()
+        except gevent_queue.Empty:
+            break
+        tasks.append(task)
+    release_tasks(tasks)
+
+
+def retry_task(task):
+    """
+    Откладывает задачу для повторной отправки через retry_policy.delay секунд.
+
+    Освобожденная задача не хранит счетчик попыток, поэтому в очередь кладется
+    копия задачи с теми же приоритетом, ttl и ttr, в данных которой (retry_key)
+    записаны номер следующей попытки и id исходной задачи, а исходная подтверждается.
+
+    Если сервер отказал в подтверждении, копия удаляется, а исходная задача
+    вернется в очередь по TTR. Если же оборвалось соединение, удалить копию
+    нельзя, и уведомление может быть отправлено дважды (at-least-once).
+    """
+    attempt, task_id = task_retry_info(task)
+    data = dict(task.data)
+    data[retry_key] = {'attempt': attempt + 1, 'task_id': task_id}
+    delay = retry_policy.delay(attempt)
+    meta = task.meta()
+    copy = task.queue.tube(task.tube).put(
+        data, delay=delay, pri=meta['pri'], ttl=meta['ttl'] / queue_time_unit, ttr=meta['ttr'] / queue_time_unit
+    )
+    try:
+        task.ack()
+    except tarantool.DatabaseError:
+        copy.delete()
+        raise
+    logger.info('Retry task id={task_id} in {delay} second(s), attempt {attempt}.'.format(
+        task_id=task_id, delay=delay, attempt=attempt + 2
+    ))
+    stats.incr('retry.scheduled')
+
+
+def complete_task(task, action_name):
+    """
+    Выполняет над задачей действие action_name (ack, bury или retry)
+    через соединение, которое ее взяло.
+    """
+    logger.debug('{name} task#{task_id}.'.format(
+        name=action_name.capitalize(),
+        task_id=task.task_id
+    ))
+
+    try:
+        with task.queue.tarantool_lock:
+            if action_name == task_retry:
+                retry_task(task)
+            else:
+                getattr(task, action_name)()
+    except tarantool.DatabaseError as exc:
+        logger.exception(exc)
 
 
 def done_with_processed_tasks(task_queue):
@@ -80,21 +390,80 @@ def done_with_processed_tasks(task_queue):
     for _ in xrange(task_queue.qsize()):
         try:
             task, action_name = task_queue.get_nowait()
-
-            logger.debug('{name} task#{task_id}.'.format(
-                name=action_name.capitalize(),
-                task_id=task.task_id
-            ))
-
-            try:
-                getattr(task, action_name)()
-            except tarantool.DatabaseError as exc:
-                logger.exception(exc)
+            complete_task(task, action_name)
         except gevent_queue.Empty:
             logger.debug(empty_queue_msg)
             break
 
 
+def complete_tasks(processed):
+    """
+    Выполняет действия над задачами по очереди.
+
+    :param processed: список кортежей (объект задачи, имя действия)
+    """
+    for task, action_name in processed:
+        complete_task(task, action_name)
+
+
+def group_by_connection(batch):
+    """
+    Группирует пачку по соединениям, взявшим задачи, сохраняя порядок внутри группы.
+
+    :param batch: список кортежей (объект задачи, имя действия)
+    :return: список групп
+    """
+    groups = {}
+    for task, action_name in batch:
+        groups.setdefault(id(task.queue), []).append((task, action_name))
+    return groups.values()
+
+
+def acknowledge_tasks(task_queue, batch_size):
+    """
+    Непрерывно подтверждает обработанные задачи (гринлет-подтверждатель).
+
+    Ждет задачи в task_queue и забирает их пачками до batch_size; сервер
+    принимает действия только от сессии, взявшей задачу, поэтому пачка делится
+    по соединениям и группы выполняются параллельно, каждая через свое
+    соединение (клиент tarantool ждет ответа на каждый запрос, поэтому одно
+    соединение - один запрос за раз). Время на пачку учитывается в статистике (ack.batch).
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    """
+    while True:
+        batch = [task_queue.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(task_queue.get_nowait())
+            except gevent_queue.Empty:
+                break
+
+        started = time()
+        gevent.joinall([
+            gevent.spawn(complete_tasks, processed) for processed in group_by_connection(batch)
+        ], raise_error=True)
+        elapsed = time() - started
+        stats.timing('ack.batch', elapsed)
+        stats.incr('ack.tasks', len(batch))
+        logger.debug('Completed {count} tasks in {elapsed:.1f} ms.'.format(count=len(batch), elapsed=elapsed * 1000))
+
+
+def connect_tube(config):
+    """
+    Сервер очереди (provision/init.lua) принимает ack, bury, release и touch
+    задачи только от сессии, которая ее взяла, поэтому задача завершается через
+    соединение, которым она взята (task.queue). Клиент tarantool ждет ответа на
+    каждый запрос, и гринлеты делают запросы через соединение по очереди,
+    под его блокировкой queue.tarantool_lock (ее же клиент берет при подключении).
+
+    :return: очередь задач через новое соединение с tarantool
+    """
+    tube = get_tube(host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE, name=config.QUEUE_TUBE)
+    tube.queue.tarantool_lock = RLock()
+    return tube
+
+
 def stop_handler(signum):
     """
     Обработчик сигналов завершения приложения.
@@ -121,14 +490,25 @@ def main_loop(config):
     :type config: Config
 
     Алгоритм:
-     * Открываем соединение с tarantool.queue, использую config.QUEUE_* настройки.
-     * Создаем пул обработчиков.
+     * Создаем пул обработчиков и общую для них HTTP-сессию с пулом соединений.
+     * Создаем перегородки и предохранители по хостам (config.HOST_*, config.BREAKER_*)
+       и политику повторов (config.RETRY_*).
+     * Создаем сборщик пачек уведомлений на адреса config.BATCH_CALLBACK_URLS.
      * Создаем очередь куда обработчики будут помещать выполненные задачи.
-     * Пока количество обработчиков <= config.WORKER_POOL_SIZE, берем задачу из tarantool.queue
-       и запускаем greenlet для ее обработки.
-     * Посылаем уведомления о том, что задачи завершены в tarantool.queue.
-     * Спим config.SLEEP секунд.
+     * Запускаем config.QUEUE_TAKERS гринлетов, которые берут задачи из tarantool.queue
+       (каждый через свое соединение, config.QUEUE_* настройки) в буфер на config.QUEUE_PREFETCH задач.
+     * Достаем задачу из буфера и запускаем greenlet для ее обработки, как только
+       в пуле освободится место; фиксированных пауз в цикле нет.
+     * Гринлет-подтверждатель посылает уведомления о том, что задачи завершены,
+       в tarantool.queue пачками до config.ACK_BATCH_SIZE через соединения, взявшие задачи.
+     * Пишем статистику раз в config.STATS_INTERVAL секунд.
+     * При выходе возвращаем в очередь задачи, оставшиеся в буфере и в неотправленных пачках.
     """
+    global http_session
+    global host_guard
+    global retry_policy
+    global delivery_batcher
+
     logger.info('Connect to queue server on {host}:{port} space #{space}.'.format(
     host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
     ))
@@ -138,43 +518,50 @@ def main_loop(config):
         take_timeout=config.QUEUE_TAKE_TIMEOUT
     ))
 
-    tube = get_tube(host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE, name=config.QUEUE_TUBE)
-
     logger.info('Create worker pool[{size}].'.format(size=config.WORKER_POOL_SIZE))
     worker_pool = Pool(config.WORKER_POOL_SIZE)
+    http_session = create_http_session(config)
+    host_guard = create_host_guard(config)
+    retry_policy = create_task_retry_policy(config)
 
     processed_task_queue = gevent_queue.Queue()
+    delivery_batcher = create_delivery_batcher(
+        config, partial(spawn_batch_worker, worker_pool, processed_task_queue, config)
+    )
+    prefetched = gevent_queue.Queue()
+    prefetch_slots = Semaphore(config.QUEUE_PREFETCH)
 
-    logger.info('Run main loop. Worker pool size={count}. Sleep time is {sleep}.'.format(
-        count=config.WORKER_POOL_SIZE, sleep=config.SLEEP
+    logger.info('Run main loop. Worker pool size={count}. Prefetch={prefetch}, takers={takers}.'.format(
+        count=config.WORKER_POOL_SIZE, prefetch=config.QUEUE_PREFETCH, takers=config.QUEUE_TAKERS
     ))
 
-    while run:
-        free_workers_count = worker_pool.free_count()
-        logger.debug('Pool has {count} free workers.'.format(count=free_workers_count))
-
-        for number in xrange(free_workers_count):
-            logger.debug('Get task from tube for worker#{number}.'.format(number=number))
-
-            task = tube.take(config.QUEUE_TAKE_TIMEOUT)
-
-            if task:
-                logger.info('Start worker#{number} for task id={task_id}.'.format(
-                    task_id=task.task_id, number=number
-                ))
-
-                worker = Greenlet(
-                    notification_worker,
-                    task,
-                    processed_task_queue,
-                    timeout=config.HTTP_CONNECTION_TIMEOUT,
-                    verify=False
-                )
-                worker_pool.add(worker)
-                worker.start()
-
+    take_tubes = [connect_tube(config) for _ in xrange(config.QUEUE_TAKERS)]
+    takers = [
+        gevent.spawn(take_tasks, take_tube, prefetched, prefetch_slots, config.QUEUE_TAKE_TIMEOUT)
+        for take_tube in take_tubes
+    ]
+    acknowledger = gevent.spawn(acknowledge_tasks, processed_task_queue, config.ACK_BATCH_SIZE)
+    try:
+        while run:
+            try:
+                task, taken_at = prefetched.get(timeout=config.QUEUE_TAKE_TIMEOUT)
+            except gevent_queue.Empty:
+                pass
+            else:
+                dispatch_task(task, taken_at, worker_pool, processed_task_queue, config)
+                prefetch_slots.release()
+
+            for greenlet in takers + [acknowledger]:
+                if greenlet.ready():
+                    greenlet.get()
+
+            stats.report(logger, config.STATS_INTERVAL)
+    finally:
+        stop_takers(takers, take_tubes)
+        acknowledger.kill()
+        release_prefetched_tasks(prefetched)
+        release_tasks(delivery_batcher.drain())
         done_with_processed_tasks(processed_task_queue)
-        sleep(config.SLEEP)
 
     logger.info('Stop application loop.')
 
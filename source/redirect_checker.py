@@ -7,36 +7,142 @@ from logging.config import dictConfig
 from multiprocessing import active_children
 from time import sleep
 
-from lib.utils import (check_network_status, create_pidfile, daemonize,
-                       load_config_from_pyfile, parse_cmd_args, spawn_workers)
-from lib.worker import worker
+from lib import CheckContext
+from lib.autoscaler import create_autoscaler
+from lib.dns_resolver import create_dns_resolver
+from lib.drain import drain_workers
+from lib.network_prober import FetchMeter, create_network_prober
+from lib.shared_cache import create_shared_cache
+from lib.stats import stats
+from lib.utils import (create_pidfile, daemonize, get_tube, load_config_from_pyfile, parse_cmd_args,
+                       sort_by_start, spawn_workers)
+from lib.worker import get_worker, get_worker_concurrency, preload_worker, set_fetch_meter, set_task_meter
 
 logger = logging.getLogger('redirect_checker')
 run = True
 
 
+def prepare_caches(config):
+    """
+    Создает общие для воркеров кэши. Вызывается до запуска воркеров,
+    чтобы они получили кэши через fork.
+
+    Реестр проверяемых урлов в список не входит: его обращения - опрос
+    ждущих воркеров, счетчики объединения проверок - в статистике воркеров.
+
+    :return: окружение проверки воркеров с кэшами (CheckContext) и список (название, кэш) включенных кэшей
+    """
+    result_cache = create_shared_cache(
+        config.RESULT_CACHE_SLOTS, config.RESULT_CACHE_SLOT_SIZE, config.RESULT_CACHE_TTL
+    )
+    hop_cache = create_shared_cache(
+        config.HOP_CACHE_SLOTS, config.HOP_CACHE_SLOT_SIZE, config.HOP_CACHE_TTL
+    )
+    dns_cache = create_shared_cache(
+        config.DNS_CACHE_SLOTS, config.DNS_CACHE_SLOT_SIZE, config.DNS_CACHE_TTL
+    )
+    inflight_cache = create_shared_cache(
+        config.INFLIGHT_CACHE_SLOTS, config.INFLIGHT_CACHE_SLOT_SIZE, config.INFLIGHT_CACHE_TTL
+    )
+    context = CheckContext(
+        resolver=create_dns_resolver(dns_cache, config.DNS_PREFETCH_THREADS),
+        result_cache=result_cache,
+        hop_cache=hop_cache,
+        inflight_cache=inflight_cache
+    )
+    caches = [(u'Result', result_cache), (u'Hop', hop_cache), (u'DNS', dns_cache)]
+    return context, [(name, cache) for name, cache in caches if cache is not None]
+
+
+def prepare_autoscaler(config):
+    """
+    Создает автомасштабирование пула и подключает воркеры к учету задач.
+    Вызывается до запуска воркеров.
+
+    :return: Autoscaler или None, если выключено
+    """
+    input_tube = get_tube(
+        host=config.INPUT_QUEUE_HOST,
+        port=config.INPUT_QUEUE_PORT,
+        space=config.INPUT_QUEUE_SPACE,
+        name=config.INPUT_QUEUE_TUBE
+    )
+    autoscaler = create_autoscaler(config, input_tube, get_worker_concurrency(config))
+    if autoscaler is not None:
+        set_task_meter(autoscaler.meter)
+    return autoscaler
+
+
+def prepare_network_prober(config):
+    """
+    Запускает фоновую проверку сети и подключает к ней учет ошибок загрузки
+    в воркерах. Вызывается до запуска воркеров.
+
+    :return: NetworkProber
+    """
+    meter = FetchMeter()
+    set_fetch_meter(meter)
+    prober = create_network_prober(config, meter)
+    prober.start()
+    return prober
+
+
+def stop_workers(workers, config):
+    """
+    Плавно останавливает воркеры: взятые задачи дорабатываются или возвращаются
+    в очередь. Воркер прерывает проверку через DRAIN_TIMEOUT, но curl-запрос,
+    который в этот момент идет, может продлиться еще до HTTP_TIMEOUT.
+    """
+    drain_workers(workers, config.DRAIN_TIMEOUT + config.HTTP_TIMEOUT)
+
+
 def main_loop(config):
     logger.info(
         u'Run main loop. Worker pool size={}. Sleep time is {}.'.format(
             config.WORKER_POOL_SIZE, config.SLEEP
         ))
     parent_pid = os.getpid()
+    context, caches = prepare_caches(config)
+    worker, workers_count = get_worker(config)
+    preload_worker(config)
+    autoscaler = prepare_autoscaler(config)
+    if autoscaler is not None:
+        workers_count = autoscaler.clamp(workers_count)
+    prober = prepare_network_prober(config)
+    network_up = prober.up
+
     while run:
-        if check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
-            required_workers_count = config.WORKER_POOL_SIZE - len(active_children())
+        if prober.up and not network_up:
+            logger.info('Network is up again')
+        network_up = prober.up
+        if network_up:
+            children = active_children()
+            if autoscaler is not None:
+                scaled_count = autoscaler.update(workers_count, [c.pid for c in children])
+                if scaled_count != workers_count:
+                    logger.info(u'Autoscaling workers {} -> {}'.format(workers_count, scaled_count))
+                    workers_count = scaled_count
+            required_workers_count = workers_count - len(children)
             if required_workers_count > 0:
                 logger.info(
                     'Spawning {} workers'.format(required_workers_count))
                 spawn_workers(
                     num=required_workers_count,
                     target=worker,
-                    args=(config,),
+                    args=(config, context),
                     parent_pid=parent_pid
                 )
+            elif required_workers_count < 0:
+                logger.info('Stopping {} workers'.format(-required_workers_count))
+                # останавливаются самые новые воркеры: у старых прогреты кэши
+                stop_workers(sort_by_start(children)[required_workers_count:], config)
         else:
             logger.critical('Network is down. stopping workers')
-            for c in active_children():
-                c.terminate()
+            stop_workers(active_children(), config)
+
+        for name, cache in caches:
+            logger.info(u'{} cache stats: {}'.format(name, cache.stats()))
+        stats.report(logger, config.STATS_INTERVAL)
 
         sleep(config.SLEEP)
 
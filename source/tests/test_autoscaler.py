@@ -0,0 +1,153 @@
+# coding: utf-8
+from multiprocessing import Event, Process
+import os
+import signal
+import socket
+import time
+import unittest
+
+import mock
+from tarantool.error import DatabaseError
+
+from source.lib.autoscaler import Autoscaler, TaskMeter, create_autoscaler, get_backlog
+
+
+def hold_lock(meter, locked):
+    with meter.lock:
+        locked.set()
+        time.sleep(60)
+
+
+class TaskMeterTestCase(unittest.TestCase):
+    def test_record(self):
+        meter = TaskMeter()
+        self.assertEqual(meter.snapshot(), (0, 0.0))
+        meter.record(0.5)
+        meter.record(1.5)
+        self.assertEqual(meter.snapshot(), (2, 2.0))
+
+    def test_lock_released_by_killed_worker(self):
+        """
+        Воркер, убитый посреди записи, не оставляет метр заблокированным
+        """
+        meter = TaskMeter()
+        locked = Event()
+        holder = Process(target=hold_lock, args=(meter, locked))
+        holder.start()
+        self.assertTrue(locked.wait(5))
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+
+        writer = Process(target=meter.record, args=(0.5,))
+        writer.start()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(meter.snapshot(), (1, 0.5))
+
+
+class GetBacklogTestCase(unittest.TestCase):
+    def test_backlog(self):
+        tube = mock.Mock()
+        tube.statistics = mock.Mock(return_value={'put': '10', 'tasks': {'ready': '7', 'taken': '2'}})
+        self.assertEqual(get_backlog(tube), 7)
+
+    def test_backlog_unknown(self):
+        for error in (DatabaseError('error'), socket.error('refused'), KeyError('tasks')):
+            tube = mock.Mock()
+            tube.statistics = mock.Mock(side_effect=error)
+            self.assertIsNone(get_backlog(tube))
+
+
+class AutoscalerTestCase(unittest.TestCase):
+    def _autoscaler(self, **kwargs):
+        params = dict(min_workers=2, max_workers=20, meter=TaskMeter(), up_checks=2, down_checks=3, step=4)
+        params.update(kwargs)
+        return Autoscaler(**params)
+
+    def test_desired_busy_workers(self):
+        """
+        Без очереди нужно столько воркеров, сколько в среднем было занято, с запасом
+        """
+        autoscaler = self._autoscaler(target_utilization=0.5)
+        self.assertEqual(autoscaler.desired(0, tasks=30, busy=30.0, elapsed=10.0), 6)
+
+    def test_desired_backlog(self):
+        """
+        Очередь разбирается за drain_time
+        """
+        autoscaler = self._autoscaler(drain_time=60, target_utilization=1.0)
+        self.assertEqual(autoscaler.desired(120, tasks=10, busy=10.0, elapsed=10.0), 3)
+
+    def test_desired_concurrency(self):
+        autoscaler = self._autoscaler(worker_concurrency=10, target_utilization=1.0)
+        self.assertEqual(autoscaler.desired(0, tasks=100, busy=250.0, elapsed=10.0), 3)
+
+    def test_desired_unknown(self):
+        """
+        Очередь есть, но ни одна задача не проверена - время на задачу неизвестно
+        """
+        autoscaler = self._autoscaler()
+        self.assertIsNone(autoscaler.desired(100, tasks=0, busy=0.0, elapsed=10.0))
+        self.assertIsNone(autoscaler.desired(0, tasks=0, busy=0.0, elapsed=0))
+
+    def test_decide_grow_after_up_checks(self):
+        autoscaler = self._autoscaler()
+        self.assertEqual(autoscaler.decide(4, 15), 4)
+        self.assertEqual(autoscaler.decide(4, 15), 8)
+        self.assertEqual(autoscaler.decide(8, 15), 8)
+        self.assertEqual(autoscaler.decide(8, 15), 12)
+
+    def test_decide_shrink_after_down_checks(self):
+        autoscaler = self._autoscaler()
+        self.assertEqual([autoscaler.decide(10, 1) for _ in xrange(3)], [10, 10, 6])
+
+    def test_decide_no_flapping(self):
+        """
+        Чередование нехватки и избытка не меняет размер пула
+        """
+        autoscaler = self._autoscaler()
+        self.assertEqual([autoscaler.decide(10, desired) for desired in (12, 8, 12, 8, 12, 8)], [10] * 6)
+
+    def test_decide_bounds(self):
+        autoscaler = self._autoscaler(up_checks=1, down_checks=1, step=100)
+        self.assertEqual(autoscaler.decide(10, 50), 20)
+        self.assertEqual(autoscaler.decide(10, 0), 2)
+        self.assertEqual(autoscaler.decide(30, None), 20)
+
+    def test_decide_overloaded(self):
+        """
+        При нехватке ресурсов пул не растет, а уменьшается
+        """
+        autoscaler = self._autoscaler(up_checks=1, down_checks=1, max_load=1.5, max_rss=1000)
+        self.assertEqual(autoscaler.decide(10, 15, load=2.0, rss=10), 9)
+        self.assertEqual(autoscaler.decide(10, 15, load=1.0, rss=2000), 9)
+        self.assertEqual(autoscaler.decide(10, 15, load=1.0, rss=10), 14)
+        self.assertEqual(autoscaler.decide(10, 15, load=None, rss=None), 14)
+
+    def test_update(self):
+        """
+        Показатели берутся за период с прошлого вызова
+        """
+        meter = TaskMeter()
+        tube = mock.Mock()
+        tube.statistics = mock.Mock(return_value={'tasks': {'ready': '0'}})
+        with mock.patch('source.lib.autoscaler.time', mock.Mock(side_effect=[100.0, 110.0])):
+            autoscaler = self._autoscaler(meter=meter, tube=tube, up_checks=1, target_utilization=1.0)
+            meter.record(40.0)
+            with mock.patch('source.lib.autoscaler.get_load_per_cpu', mock.Mock(return_value=0.1)),\
+                    mock.patch('source.lib.autoscaler.get_rss', mock.Mock(return_value=0)) as get_rss:
+                self.assertEqual(autoscaler.update(2, [11, 12]), 4)
+        get_rss.assert_called_once_with([11, 12])
+        self.assertEqual((autoscaler.tasks, autoscaler.busy, autoscaler.sampled_at), (1, 40.0, 110.0))
+
+    def test_create_autoscaler(self):
+        config = mock.Mock()
+        config.AUTOSCALE_MAX_RSS_MB = 1
+        tube = mock.Mock()
+        autoscaler = create_autoscaler(config, tube, 10)
+        self.assertEqual((autoscaler.min_workers, autoscaler.max_workers, autoscaler.worker_concurrency,
+                          autoscaler.tube, autoscaler.max_rss),
+                         (config.AUTOSCALE_MIN_WORKERS, config.AUTOSCALE_MAX_WORKERS, 10, tube, 1024 * 1024))
+
+    def test_create_autoscaler_disabled(self):
+        self.assertIsNone(create_autoscaler(mock.Mock(AUTOSCALE=False), mock.Mock(), 1))
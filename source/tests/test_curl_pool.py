@@ -0,0 +1,61 @@
+# coding: utf-8
+import unittest
+
+import mock
+import pycurl
+
+from source.lib import curl_pool
+from source.lib.stats import stats
+
+
+class CurlPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        stats.reset()
+
+    def tearDown(self):
+        stats.reset()
+
+    @mock.patch('source.lib.curl_pool.pycurl.Curl', mock.Mock(side_effect=lambda: mock.Mock()))
+    def test_reuse(self):
+        """
+        Освобожденный хэндл выдается повторно
+        """
+        pool = curl_pool.CurlPool(size=2)
+        curl = pool.acquire()
+        pool.release(curl)
+        self.assertIs(pool.acquire(), curl)
+        self.assertEqual((stats.counters['curl_pool.miss'], stats.counters['curl_pool.hit']), (1, 1))
+        curl.reset.assert_called_once_with()
+        self.assertFalse(curl.close.called)
+
+    @mock.patch('source.lib.curl_pool.pycurl.Curl', mock.Mock(side_effect=lambda: mock.Mock()))
+    def test_release_over_size(self):
+        """
+        Лишние хэндлы закрываются
+        """
+        pool = curl_pool.CurlPool(size=1)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(pool.free, [first])
+        second.close.assert_called_once_with()
+
+    @mock.patch('source.lib.curl_pool.pycurl.Curl', mock.Mock(side_effect=lambda: mock.Mock()))
+    def test_share(self):
+        pool = curl_pool.CurlPool(size=1)
+        curl = pool.acquire()
+        pool.release(curl)
+        pool.acquire()
+        curl.setopt.assert_called_once_with(pycurl.SHARE, pool.share)
+
+    def test_without_share(self):
+        pool = curl_pool.CurlPool(share_dns=False, share_ssl=False)
+        self.assertIsNone(pool.share)
+
+    def test_create_curl_pool(self):
+        config = mock.Mock()
+        config.CURL_POOL_SIZE = 3
+        config.CURL_POOL_SHARE_COOKIES = True
+        pool = curl_pool.create_curl_pool(config)
+        self.assertEqual(pool.size, 3)
+        self.assertIsNotNone(pool.share)
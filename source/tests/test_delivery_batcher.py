@@ -0,0 +1,51 @@
+# coding: utf-8
+import unittest
+
+import gevent
+import mock
+
+from source.lib.delivery_batcher import DeliveryBatcher, create_delivery_batcher
+
+
+class DeliveryBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.send = mock.Mock()
+        self.batcher = DeliveryBatcher(['http://a/'], window=0.01, max_size=3, send=self.send)
+
+    def test_accepts(self):
+        self.assertTrue(self.batcher.accepts('http://a/'))
+        self.assertFalse(self.batcher.accepts('http://b/'))
+
+    def test_flush_on_window(self):
+        """
+        Пачка отправляется через window секунд после открытия
+        """
+        self.assertFalse(self.batcher.join('http://a/', 1))
+        self.batcher.open('http://a/', 1)
+        self.assertTrue(self.batcher.join('http://a/', 2))
+        self.assertEqual(self.send.call_count, 0)
+        gevent.sleep(0.02)
+        self.send.assert_called_once_with('http://a/', [1, 2])
+        self.assertEqual((self.batcher.pending, self.batcher.timers), ({}, {}))
+
+    def test_flush_on_size(self):
+        self.batcher.open('http://a/', 1)
+        self.batcher.join('http://a/', 2)
+        self.batcher.join('http://a/', 3)
+        self.send.assert_called_once_with('http://a/', [1, 2, 3])
+        self.assertFalse(self.batcher.join('http://a/', 4))
+        gevent.sleep(0.02)
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_drain(self):
+        self.batcher.open('http://a/', 1)
+        self.batcher.join('http://a/', 2)
+        self.assertEqual(self.batcher.drain(), [1, 2])
+        gevent.sleep(0.02)
+        self.assertEqual(self.send.call_count, 0)
+
+    def test_create_delivery_batcher(self):
+        config = mock.Mock(BATCH_CALLBACK_URLS=('http://a/',), BATCH_WINDOW=0.5, BATCH_MAX_SIZE=50)
+        batcher = create_delivery_batcher(config, self.send)
+        self.assertEqual((batcher.urls, batcher.window, batcher.max_size, batcher.send),
+                         (frozenset(['http://a/']), 0.5, 50, self.send))
@@ -0,0 +1,109 @@
+# coding: utf-8
+import os
+import signal
+import socket
+import time
+import unittest
+
+import mock
+
+from source.lib.drain import DRAIN_SIGNAL, Drain, DrainTimeout, drain_workers
+
+
+class DrainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.handlers = [(signum, signal.getsignal(signum)) for signum in (DRAIN_SIGNAL, signal.SIGALRM)]
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        for signum, handler in self.handlers:
+            signal.signal(signum, handler)
+
+    def test_drain_signal(self):
+        drain = Drain()
+        drain.install()
+        self.assertFalse(drain.requested)
+        os.kill(os.getpid(), DRAIN_SIGNAL)
+        self.assertTrue(drain.requested)
+
+    def test_deadline_interrupts_check(self):
+        """
+        Проверка, идущая дольше срока после сигнала, прерывается
+        """
+        drain = Drain(timeout=0.01)
+        drain.install()
+
+        def check():
+            os.kill(os.getpid(), DRAIN_SIGNAL)
+            while True:
+                time.sleep(0.01)
+                drain.check_deadline()
+
+        self.assertRaises(DrainTimeout, drain.run, check)
+        self.assertTrue(drain.expired)
+
+    def test_run_after_deadline(self):
+        """
+        До срока остановки проверка идет, после него - не начинается
+        """
+        drain = Drain(timeout=1)
+        self.assertEqual(drain.run(lambda x: x * 2, 21), 42)
+        drain._on_deadline(signal.SIGALRM, None)
+        self.assertRaises(DrainTimeout, drain.run, lambda x: x * 2, 21)
+
+    def test_signals_during_blocking_read(self):
+        """
+        Сигнал остановки и срок остановки не обрывают чтение сокета (EINTR):
+        запрос дочитывается, а проверка прерывается после него
+        """
+        drain = Drain(timeout=0.02)
+        drain.install()
+        reader, writer = socket.socketpair()
+        self.addCleanup(reader.close)
+        self.addCleanup(writer.close)
+        received = []
+
+        def check():
+            os.kill(os.getpid(), DRAIN_SIGNAL)
+            parent_pid = os.getpid()
+            child_pid = os.fork()
+            if not child_pid:
+                # повторный сигнал остановки и SIGALRM срока приходят, пока процесс ждет в recv
+                os.kill(parent_pid, DRAIN_SIGNAL)
+                time.sleep(0.1)
+                writer.sendall('response')
+                os._exit(0)
+            try:
+                received.append(reader.recv(100))
+            finally:
+                os.waitpid(child_pid, 0)
+            drain.check_deadline()
+
+        self.assertRaises(DrainTimeout, drain.run, check)
+        self.assertEqual(received, ['response'])
+        self.assertTrue(drain.requested and drain.expired)
+
+    def test_repeated_signal(self):
+        drain = Drain(timeout=5)
+        with mock.patch('source.lib.drain.signal.setitimer') as setitimer:
+            drain._on_drain(DRAIN_SIGNAL, None)
+            drain._on_drain(DRAIN_SIGNAL, None)
+        setitimer.assert_called_once_with(signal.ITIMER_REAL, 5)
+
+
+class DrainWorkersTestCase(unittest.TestCase):
+    def test_drain_workers(self):
+        """
+        Воркеры получают сигнал, не успевшие завершиться - terminate
+        """
+        finished, stuck = mock.Mock(pid=11), mock.Mock(pid=12)
+        finished.is_alive = mock.Mock(return_value=False)
+        stuck.is_alive = mock.Mock(return_value=True)
+        with mock.patch('os.kill', mock.Mock(side_effect=[None, OSError])) as kill,\
+                mock.patch('source.lib.drain.time', mock.Mock(side_effect=[100.0, 100.0, 109.0])):
+            drain_workers([finished, stuck], 8)
+        self.assertEqual(kill.call_args_list, [mock.call(11, DRAIN_SIGNAL), mock.call(12, DRAIN_SIGNAL)])
+        finished.join.assert_called_once_with(8.0)
+        stuck.join.assert_called_once_with(0)
+        self.assertFalse(finished.terminate.called)
+        self.assertTrue(stuck.terminate.called)
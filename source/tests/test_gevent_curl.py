@@ -0,0 +1,136 @@
+# coding: utf-8
+import unittest
+
+import gevent
+import mock
+import pycurl
+
+from source.lib import gevent_curl
+
+
+class FakeMulti(object):
+    """
+    CurlMulti, у которого хэндлы завершаются на втором perform после добавления
+    """
+    def __init__(self):
+        self.handles = {}
+        self.max_active = 0
+
+    def add_handle(self, curl):
+        self.handles[curl] = 0
+        self.max_active = max(self.max_active, len(self.handles))
+
+    def remove_handle(self, curl):
+        del self.handles[curl]
+
+    def perform(self):
+        for curl in self.handles:
+            self.handles[curl] += 1
+        return 0, len(self.handles)
+
+    def info_read(self):
+        done = [curl for curl, performs in self.handles.items() if performs >= 2]
+        ok_list = [curl for curl in done if not curl.fail]
+        err_list = [(curl, pycurl.E_COULDNT_CONNECT, 'connection refused') for curl in done if curl.fail]
+        return 0, ok_list, err_list
+
+    def timeout(self):
+        return 0
+
+    def fdset(self):
+        return [], [], []
+
+    def close(self):
+        pass
+
+
+class GeventCurlPerformerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.multi = FakeMulti()
+        with mock.patch('source.lib.gevent_curl.pycurl.CurlMulti', mock.Mock(return_value=self.multi)):
+            self.performer = gevent_curl.GeventCurlPerformer()
+
+    def _curl(self, fail=False):
+        curl = mock.Mock()
+        curl.fail = fail
+        return curl
+
+    def test_concurrent_perform(self):
+        """
+        Запросы разных гринлетов выполняются одновременно
+        """
+        greenlets = [gevent.spawn(self.performer.perform, self._curl()) for _ in xrange(3)]
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEqual(self.multi.max_active, 3)
+        self.assertEqual(self.multi.handles, {})
+        self.assertEqual(self.performer.waiters, {})
+
+    def test_perform_error(self):
+        greenlet = gevent.spawn(self.performer.perform, self._curl(fail=True))
+        greenlet.join()
+        self.assertIsInstance(greenlet.exception, pycurl.error)
+        self.assertEqual(greenlet.exception.args[0], pycurl.E_COULDNT_CONNECT)
+
+    def test_killed_perform(self):
+        """
+        Хэндл прерванного гринлета убирается из multi
+        """
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        greenlet = gevent.spawn(self.performer.perform, self._curl())
+        gevent.sleep(0)
+        self.assertEqual(len(self.multi.handles), 1)
+        greenlet.kill()
+        self.assertEqual(self.multi.handles, {})
+        self.assertEqual(self.performer.waiters, {})
+
+    def test_host_limits(self):
+        """
+        К одному хосту и ip одновременно идет не больше host_limit и ip_limit запросов
+        """
+        with mock.patch('source.lib.gevent_curl.pycurl.CurlMulti', mock.Mock(return_value=self.multi)):
+            performer = gevent_curl.GeventCurlPerformer(host_limit=1, ip_limit=2)
+        requests = [('a', '1.1.1.1'), ('a', '1.1.1.1'), ('b', '1.1.1.1'), ('c', '1.1.1.1')]
+        greenlets = [gevent.spawn(performer.perform, self._curl(), host, ip) for host, ip in requests]
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEqual(self.multi.max_active, 2)
+        self.assertEqual((len(performer.scheduler), dict(performer.scheduler.host_active)), (0, {}))
+        performer.close()
+
+    def test_killed_in_queue(self):
+        """
+        Гринлет, прерванный в очереди к хосту, не занимает его слот
+        """
+        self.performer.scheduler.host_limit = 1
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        first = gevent.spawn(self.performer.perform, self._curl(), 'a')
+        queued = gevent.spawn(self.performer.perform, self._curl(), 'a')
+        gevent.sleep(0)
+        queued.kill()
+        first.kill()
+        self.assertEqual(self.multi.handles, {})
+        self.assertEqual((len(self.performer.scheduler), dict(self.performer.scheduler.host_active)), (0, {}))
+
+    def test_wait_on_sockets(self):
+        self.multi.fdset = mock.Mock(return_value=([5], [], []))
+        with mock.patch('source.lib.gevent_curl.select', mock.Mock(return_value=([], [], []))) as m_select:
+            self.performer.perform(self._curl())
+        m_select.assert_called_once_with([5, self.performer.wakeup_read], [], [], 0)
+
+    def test_new_handle_wakes_driver(self):
+        """
+        Хэндл, добавленный во время ожидания сокетов, не ждет таймаута select
+        """
+        self.multi.timeout = mock.Mock(return_value=-1)
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        self.performer.driver = gevent.spawn(self.performer._run)
+        self.performer.waiters['first'] = mock.Mock()
+        gevent.sleep(0)
+        started = gevent.get_hub().loop.now()
+        gevent.spawn(self.performer.perform, self._curl())
+        gevent.sleep(0.05)
+        self.assertFalse(self.performer.woken)
+        self.assertLess(gevent.get_hub().loop.now() - started, gevent_curl.SELECT_TIMEOUT)
+        self.performer.driver.kill()
+
+    def tearDown(self):
+        self.performer.close()
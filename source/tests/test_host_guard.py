@@ -0,0 +1,126 @@
+# coding: utf-8
+import unittest
+
+import mock
+
+from source.lib.host_guard import (BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN, SWEEP_INTERVAL, CircuitBreaker,
+                                   HostGuard, create_host_guard)
+from source.lib.stats import Stats
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=10, min_requests=4, max_error_rate=0.5, open_timeout=5)
+
+    def _record(self, results, now=0):
+        for failed in results:
+            self.breaker.record(failed, now)
+
+    def test_opens_on_error_rate(self):
+        self._record([False, True, True])
+        self.assertEqual(self.breaker.state, BREAKER_CLOSED, 'too few requests')
+        self._record([False])
+        self.assertEqual(self.breaker.state, BREAKER_CLOSED, 'error rate is not above max')
+        self._record([True])
+        self.assertEqual(self.breaker.state, BREAKER_OPEN)
+        self.assertFalse(self.breaker.allow(4))
+
+    def test_window(self):
+        """
+        Результаты старше window секунд не учитываются
+        """
+        self._record([True, True, True], now=0)
+        self._record([False, True], now=10)
+        self.assertEqual(self.breaker.state, BREAKER_CLOSED)
+        self.assertEqual((len(self.breaker.results), self.breaker.failures), (2, 1))
+
+    def test_half_open_trial(self):
+        """
+        После open_timeout пропускается один пробный запрос, его результат решает состояние
+        """
+        self._record([True] * 4)
+        self.assertTrue(self.breaker.allow(5))
+        self.assertEqual(self.breaker.state, BREAKER_HALF_OPEN)
+        self.assertFalse(self.breaker.allow(5))
+        self.breaker.record(True, 6)
+        self.assertEqual(self.breaker.state, BREAKER_OPEN)
+        self.assertFalse(self.breaker.allow(10))
+        self.assertTrue(self.breaker.allow(11))
+        self.breaker.record(False, 11)
+        self.assertEqual(self.breaker.state, BREAKER_CLOSED)
+        self.assertTrue(self.breaker.allow(11))
+
+
+class HostGuardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats = Stats()
+        patcher = mock.patch('source.lib.host_guard.stats', self.stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.guard = HostGuard(2, window=10, min_requests=2, max_error_rate=0.5, open_timeout=5)
+
+    def test_bulkhead(self):
+        """
+        К одному хосту не больше max_requests запросов одновременно, другие хосты не страдают
+        """
+        self.assertTrue(self.guard.acquire('a'))
+        self.assertTrue(self.guard.acquire('a'))
+        self.assertFalse(self.guard.acquire('a'))
+        self.assertTrue(self.guard.acquire('b'))
+        self.guard.release('a', False)
+        self.assertTrue(self.guard.acquire('a'))
+        self.assertEqual(self.stats.counters['host_guard.bulkhead'], 1)
+
+    def test_breaker_metrics(self):
+        with mock.patch('source.lib.host_guard.time', mock.Mock(return_value=100)):
+            for _ in xrange(2):
+                self.guard.acquire('a')
+            for _ in xrange(2):
+                self.guard.release('a', True)
+            self.assertFalse(self.guard.acquire('a'))
+        self.assertEqual(self.stats.snapshot(), {'host_guard.open': 1, 'breaker.open': 1, 'breaker.open_hosts': 1})
+
+        with mock.patch('source.lib.host_guard.time', mock.Mock(return_value=105)):
+            self.assertTrue(self.guard.acquire('a'))
+            self.guard.release('a', False)
+        snapshot = self.stats.snapshot()
+        self.assertEqual((snapshot['breaker.half_open'], snapshot['breaker.closed'], snapshot['breaker.open_hosts']),
+                         (1, 1, 0))
+        self.assertEqual(dict(self.guard.in_flight), {})
+
+    def test_idle_breakers_forgotten(self):
+        """
+        Предохранители простаивающих хостов забываются, открытые и занятые - нет
+        """
+        self.guard.swept_at = 0
+        with mock.patch('source.lib.host_guard.time', mock.Mock(return_value=10)):
+            for host in ('idle', 'open', 'busy'):
+                self.guard.acquire(host)
+            self.guard.release('idle', False)
+            self.guard.acquire('open')
+            self.guard.release('open', True)
+            self.guard.release('open', True)
+            self.assertFalse(self.guard.acquire('open'))
+            self.guard.acquire('rejected')
+            self.guard.acquire('rejected')
+            self.assertFalse(self.guard.acquire('rejected'))
+        self.assertEqual(set(self.guard.in_flight), {'busy', 'rejected'})
+
+        with mock.patch('source.lib.host_guard.time', mock.Mock(return_value=12)):
+            self.guard.acquire('new')
+        self.assertIn('idle', self.guard.breakers, 'not swept before SWEEP_INTERVAL')
+
+        with mock.patch('source.lib.host_guard.time', mock.Mock(return_value=10 + SWEEP_INTERVAL)):
+            self.guard.acquire('next')
+        self.assertEqual(set(self.guard.breakers), {'open', 'busy', 'rejected', 'new', 'next'})
+        self.assertEqual(self.stats.gauges['host_guard.hosts'], 4)
+
+    def test_create_host_guard(self):
+        config = mock.Mock(WORKER_POOL_SIZE=10, HOST_MAX_SHARE=0.3, BREAKER_WINDOW=20, BREAKER_MIN_REQUESTS=5,
+                           BREAKER_MAX_ERROR_RATE=0.7, BREAKER_OPEN_TIMEOUT=15)
+        guard = create_host_guard(config)
+        self.assertEqual(guard.max_requests, 3)
+        self.assertEqual(guard.breaker_kwargs,
+                         dict(window=20, min_requests=5, max_error_rate=0.7, open_timeout=15))
+        config.WORKER_POOL_SIZE = 1
+        self.assertEqual(create_host_guard(config).max_requests, 1)
@@ -0,0 +1,85 @@
+# coding: utf-8
+from httplib import HTTPMessage
+from StringIO import StringIO
+import unittest
+
+import mock
+import requests
+from requests.cookies import extract_cookies_to_jar
+from requests.packages.urllib3.exceptions import EmptyPoolError
+
+from source.lib.http_pool import (MeteredHTTPConnectionPool, MeteredHTTPSConnectionPool, MeteredPoolManager,
+                                  PooledHTTPAdapter, create_http_session)
+from source.lib.stats import Stats
+
+
+class MeteredPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats = Stats()
+        patcher = mock.patch('source.lib.http_pool.stats', self.stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse_counted(self):
+        pool = MeteredHTTPConnectionPool('localhost', 80, maxsize=1, block=True)
+        conn = pool._get_conn()
+        pool._put_conn(conn)
+        with mock.patch('source.lib.http_pool.HTTPConnectionPool._get_conn',
+                        mock.Mock(return_value=conn)):
+            self.assertIs(pool._get_conn(), conn)
+        snapshot = self.stats.snapshot()
+        self.assertEqual((snapshot['http_pool.new'], snapshot['http_pool.reused'], snapshot['http_pool.wait.count']),
+                         (1, 1, 2))
+
+    def test_wait_timeout(self):
+        """
+        Соединений с хостом не больше maxsize, свободное ждем не дольше wait_timeout
+        """
+        pool = MeteredHTTPConnectionPool('localhost', 80, maxsize=1, block=True)
+        pool.wait_timeout = 0.01
+        pool._get_conn()
+        self.assertRaises(EmptyPoolError, pool._get_conn)
+        self.assertEqual(self.stats.counters['http_pool.wait_timeout'], 1)
+
+
+class MeteredPoolManagerTestCase(unittest.TestCase):
+    def test_new_pool(self):
+        manager = MeteredPoolManager(num_pools=2, wait_timeout=3, maxsize=5, block=True)
+        pool = manager.connection_from_url('http://example.com/')
+        self.assertIsInstance(pool, MeteredHTTPConnectionPool)
+        self.assertEqual((pool.wait_timeout, pool.pool.maxsize, pool.block), (3, 5, True))
+        self.assertIsInstance(manager.connection_from_url('https://example.com/'), MeteredHTTPSConnectionPool)
+        self.assertIs(manager.connection_from_url('http://example.com/other'), pool)
+
+
+class PooledHTTPAdapterTestCase(unittest.TestCase):
+    def test_pool_exhausted(self):
+        """
+        Не дождались соединения - это ошибка запроса, а не исключение urllib3
+        """
+        adapter = PooledHTTPAdapter(pool_hosts=1, pool_size=1, wait_timeout=0.01)
+        request = requests.Request('POST', 'http://example.com/', data='{}').prepare()
+        with mock.patch('source.lib.http_pool.HTTPAdapter.send', mock.Mock(side_effect=EmptyPoolError(None, 'full'))):
+            self.assertRaises(requests.ConnectionError, adapter.send, request)
+
+    def test_create_http_session(self):
+        config = mock.Mock(HTTP_POOL_HOSTS=7, HTTP_POOL_HOST_SIZE=0, WORKER_POOL_SIZE=20, HTTP_POOL_WAIT_TIMEOUT=2)
+        session = create_http_session(config)
+        adapter = session.get_adapter('https://example.com/')
+        self.assertIs(session.get_adapter('http://example.com/'), adapter)
+        self.assertEqual((adapter._pool_connections, adapter._pool_maxsize, adapter._pool_block, adapter.wait_timeout),
+                         (7, 20, True, 2))
+
+    def test_session_ignores_cookies(self):
+        """
+        Куки из ответа одного партнера не сохраняются и не уходят в запросы к другим
+        """
+        config = mock.Mock(HTTP_POOL_HOSTS=1, HTTP_POOL_HOST_SIZE=1, WORKER_POOL_SIZE=1, HTTP_POOL_WAIT_TIMEOUT=None)
+        session = create_http_session(config)
+        request = requests.Request('POST', 'http://partner.example.com/callback').prepare()
+        raw = mock.Mock(_original_response=mock.Mock(msg=HTTPMessage(StringIO('Set-Cookie: sid=1; Path=/\r\n\r\n'))))
+
+        extract_cookies_to_jar(session.cookies, request, raw)
+        self.assertEqual(len(session.cookies), 0)
+        next_request = session.prepare_request(requests.Request('POST', 'http://partner.example.com/callback'))
+        self.assertNotIn('Cookie', next_request.headers)
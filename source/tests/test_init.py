@@ -1,15 +1,22 @@
 # -*- coding:  utf-8 -*-
 __author__ = 'Ruslan'
 
+import glob
+import os
 import unittest
 import re
 
 from bs4 import BeautifulSoup
 import mock
+import pycurl
 
 from source.lib import REDIRECT_HTTP, REDIRECT_META, get_redirect_history
 from source.lib import to_unicode, get_counters, fix_market_url, PREFIX_GOOGLE_MARKET, prepare_url, get_url, \
-    ERROR_REDIRECT, make_pycurl_request, to_str, check_for_meta
+    ERROR_REDIRECT, make_pycurl_request, to_str, check_for_meta, CounterDetector, check_for_meta_with_soup, \
+    BodyBuffer, clear_url_memo, prepared_urls, idna_netlocs, prepare_curl, CheckContext, DEFAULT_CONTEXT
+from source.lib.drain import DrainTimeout
+from source.lib.retry import RetryPolicy
+from source.lib.shared_cache import SharedCache
 
 
 class TestInit(unittest.TestCase):
@@ -17,6 +24,7 @@ class TestInit(unittest.TestCase):
         self.small_timeout = 1
         self.normal_timeout = 10
         self.big_timeout = 60
+        clear_url_memo()
 
     def tearDown(self):
         pass
@@ -79,6 +87,24 @@ class TestInit(unittest.TestCase):
         self.assertEquals(get_counters(''.join([i['content'] for i in test_counter_list])),
                           [i['counter'] for i in test_counter_list])
 
+    def test_get_counters_case_insensitive(self):
+        self.assertEquals(get_counters('<script src="//MC.Yandex.RU/metrika/watch.js">'), ['YA_METRICA'])
+
+    def test_get_counters_rules_order(self):
+        """
+        счетчики возвращаются в порядке правил, а не в порядке на странице
+        """
+        content = 'top.mail.ru/jump?from=1 top-fwz1.mail.ru/counter google-analytics.com/ga.js'
+        self.assertEquals(get_counters(content), ['GOOGLE_ANALYTICS', 'TOP_MAIL_RU', 'TOP_MAIL_RU'])
+
+    def test_counter_detector_regexp_rule(self):
+        """
+        правило с метасимволами ищется как регулярное выражение
+        """
+        detector = CounterDetector([('LITERAL', r'a\.b'), ('REGEXP', r'counter\d+\.js')])
+        self.assertEquals(detector.detect('A.B counter42.js'), ['LITERAL', 'REGEXP'])
+        self.assertEquals(detector.detect('aXb counter.js'), [])
+
 # fix_market_url не проверяет что ему прилетел маркет урл, а так же не проверяет что элемент не None
     def test_fix_market_url(self):
         """
@@ -124,9 +150,43 @@ class TestInit(unittest.TestCase):
             except UnicodeError:
                 self.fail('UnicodeError not caught in prepare_url()')
 
+    def test_prepare_url_memo(self):
+        """
+        повторный урл не разбирается заново
+        """
+        url = u'http://пример.рф/путь?q=1'
+        expected = prepare_url(url)
+        with mock.patch('source.lib.urlparse', mock.Mock()) as m_urlparse:
+            self.assertEqual(prepare_url(url), expected)
+        self.assertFalse(m_urlparse.called)
+
+    def test_prepare_url_memo_size(self):
+        with mock.patch('source.lib.URL_MEMO_SIZE', 2):
+            for host in ('a.ru', 'b.ru', 'c.ru'):
+                prepare_url('http://' + host + '/')
+            self.assertEqual(prepared_urls.keys(), ['http://c.ru/'])
+
+    def test_prepare_url_netloc_memo(self):
+        """
+        хост кодируется в idna один раз
+        """
+        prepare_url(u'http://пример.рф/a')
+        with mock.patch('source.lib.to_unicode', mock.Mock(side_effect=to_unicode)):
+            self.assertEqual(prepare_url(u'http://пример.рф/b'), u'http://xn--e1afmkfd.xn--p1ai/b')
+        self.assertEqual(len(idna_netlocs), 1)
+
+    def test_prepare_url_safe_ascii_not_quoted(self):
+        with mock.patch('source.lib.quote', mock.Mock()) as m_quote:
+            self.assertEqual(prepare_url('http://example.ru/a/b-c_d.html?q=a b'), u'http://example.ru/a/b-c_d.html?q=a b')
+        self.assertFalse(m_quote.called)
+
+    def test_prepare_url_unsafe_quoted(self):
+        self.assertEqual(prepare_url(u'http://example.ru/a b:c/ф;p=x y?q=1'),
+                         u'http://example.ru/a%20b%3Ac/%D1%84;p=x+y?q=1')
+
 # make_pycurl_request не проверяет аргументы на None, или если url не string, то все красиво упадет ^^
     def _make_pycurl_request(self, redirect_url, test_resp, url='example.net',
-                             useragent=None, curl_mock=mock.MagicMock()):
+                             useragent=None, curl_mock=mock.MagicMock(), context=DEFAULT_CONTEXT):
         string_io_mock = mock.Mock(return_value=test_resp)
         curl_mock.getinfo = mock.Mock(return_value=redirect_url)
         curl_mock.setopt = mock.Mock()
@@ -134,7 +194,7 @@ class TestInit(unittest.TestCase):
                 mock.patch('source.lib.to_unicode', mock.Mock(return_value=redirect_url)), \
                 mock.patch('StringIO.StringIO.getvalue', string_io_mock), \
                 mock.patch('pycurl.Curl', mock.Mock(return_value=curl_mock)):
-            return make_pycurl_request(url, self.big_timeout, useragent)
+            return make_pycurl_request(url, self.big_timeout, useragent, context)
 
     @mock.patch('source.lib.prepare_url', mock.Mock())
     def test_make_pycurl_request(self):
@@ -175,6 +235,123 @@ class TestInit(unittest.TestCase):
         self.assertEqual(response, resp_test, 'Wrong response')
         self.assertEqual(redirect, redirect_url, 'Wrong redirect url')
 
+    @mock.patch('source.lib.prepare_url', mock.Mock())
+    def test_make_pycurl_request_with_pool(self):
+        """
+        Хэндл берется из пула и возвращается в него
+        """
+        curl_m = mock.MagicMock()
+        pool = mock.Mock()
+        pool.acquire = mock.Mock(return_value=curl_m)
+        self._make_pycurl_request(None, 'response', curl_mock=curl_m, context=CheckContext(handle_pool=pool))
+        pool.release.assert_called_once_with(curl_m)
+        self.assertFalse(curl_m.close.called)
+
+    @mock.patch('source.lib.prepare_url', mock.Mock())
+    def test_make_pycurl_request_aborted_by_limit(self):
+        """
+        Прерывание передачи по лимиту размера - не ошибка
+        """
+        curl_m = mock.MagicMock()
+        curl_m.perform = mock.Mock(side_effect=pycurl.error(pycurl.E_WRITE_ERROR, 'write error'))
+        buff = mock.Mock()
+        buff.aborted = True
+        buff.getvalue = mock.Mock(return_value='head')
+        with mock.patch('source.lib.create_body_buffer', mock.Mock(return_value=buff)):
+            response, redirect = self._make_pycurl_request(None, 'ignored', curl_mock=curl_m)
+        self.assertEqual(response, 'head')
+
+    @mock.patch('source.lib.prepare_url', mock.Mock())
+    def test_make_pycurl_request_error(self):
+        curl_m = mock.MagicMock()
+        curl_m.perform = mock.Mock(side_effect=pycurl.error(pycurl.E_COULDNT_CONNECT, 'connection refused'))
+        self.assertRaises(pycurl.error, self._make_pycurl_request, None, 'head', curl_mock=curl_m)
+
+    def _body_buffer(self, chunks, headers=('HTTP/1.1 200 OK\r\n',), head_limit=20, body_limit=40, resolver=None):
+        buff = BodyBuffer('http://example.net/', head_limit, body_limit, resolver)
+        for line in headers:
+            buff.header(line)
+        results = [buff.write(chunk) for chunk in chunks]
+        return buff, results
+
+    def test_body_buffer_unlimited(self):
+        buff, results = self._body_buffer(['a' * 100] * 3, head_limit=None, body_limit=None)
+        self.assertEqual(buff.getvalue(), 'a' * 300)
+        self.assertEqual(results, [None] * 3)
+
+    def test_body_buffer_final_page(self):
+        """
+        Страница без мета-редиректа читается до body_limit
+        """
+        buff, results = self._body_buffer(['<html><body>', 'x' * 20, 'y' * 20])
+        self.assertEqual(buff.getvalue(), '<html><body>' + 'x' * 20 + 'y' * 8)
+        self.assertEqual(results, [None, None, 0])
+        self.assertTrue(buff.aborted)
+
+    def test_body_buffer_meta_redirect(self):
+        """
+        После мета-редиректа тело не копится, передача прерывается после head_limit
+        """
+        page = '<meta http-equiv="refresh" content="0;url=/next">'
+        buff, results = self._body_buffer([page, 'x' * 20], head_limit=60)
+        self.assertEqual(buff.getvalue(), page)
+        self.assertEqual(results, [None, 0])
+
+    def test_body_buffer_meta_refresh_without_url(self):
+        """
+        Мета-тег без урла - конечная страница
+        """
+        page = '<meta http-equiv="refresh" content="30">'
+        buff, results = self._body_buffer([page], head_limit=60, body_limit=100)
+        self.assertEqual(results, [None])
+        self.assertEqual(buff.limit, 100)
+
+    def test_body_buffer_http_redirect(self):
+        """
+        У ответа с http-редиректом читается не больше head_limit
+        """
+        headers = ('HTTP/1.1 302 Found\r\n', 'Location: /next\r\n')
+        buff, results = self._body_buffer(['<html><body>', 'x' * 20], headers)
+        self.assertEqual(buff.getvalue(), '<html><body>' + 'x' * 8)
+        self.assertEqual(results, [None, 0])
+        self.assertEqual(buff.redirect_url, 'http://example.net/next')
+
+    def test_body_buffer_long_head(self):
+        """
+        Если мета-редирект не найден в первых head_limit байтах, страница считается конечной
+        """
+        page = '<head><script>' + 'x' * 30
+        buff, results = self._body_buffer([page])
+        self.assertEqual(results, [0])
+        self.assertEqual(buff.getvalue(), page[:40])
+
+    def test_body_buffer_prefetch(self):
+        """
+        Хост из Location и из мета-редиректа начинает разрешаться до конца хопа
+        """
+        resolver = mock.Mock()
+        self._body_buffer([], ('HTTP/1.1 302 Found\r\n', 'Location: http://next.ru/a\r\n'), resolver=resolver)
+        self._body_buffer(['<meta http-equiv="refresh" content="0;url=http://meta.ru/">'], head_limit=60,
+                          resolver=resolver)
+        self.assertEqual(resolver.prefetch.call_args_list, [mock.call('http://next.ru/a'), mock.call('http://meta.ru/')])
+
+    def test_prepare_curl_resolve(self):
+        """
+        Адреса хоста из общего кэша передаются curl через RESOLVE
+        """
+        curl_m = mock.Mock()
+        resolver = mock.Mock()
+        resolver.curl_resolve = mock.Mock(return_value=['example.net:80:1.2.3.4'])
+        prepare_curl(curl_m, 'http://example.net/', 1, BodyBuffer('http://example.net/'), resolver=resolver)
+        curl_m.setopt.assert_any_call(curl_m.RESOLVE, ['example.net:80:1.2.3.4'])
+
+    def test_prepare_curl_not_resolved(self):
+        curl_m = mock.Mock()
+        resolver = mock.Mock()
+        resolver.curl_resolve = mock.Mock(return_value=None)
+        prepare_curl(curl_m, 'http://example.net/', 1, BodyBuffer('http://example.net/'), resolver=resolver)
+        self.assertNotIn(curl_m.RESOLVE, [args[0] for args, _ in curl_m.setopt.call_args_list])
+
 #Аналогично make_pycurl_request
     def test_get_url_error_redirect(self):
         """
@@ -185,6 +362,40 @@ class TestInit(unittest.TestCase):
         with mock.patch('source.lib.make_pycurl_request', mock.Mock(side_effect=ValueError('value error'))):
             self.assertEquals(get_url(url, timeout=self.normal_timeout), (url, ERROR_REDIRECT, None))
 
+    def _get_url_with_retries(self, side_effect):
+        policy = RetryPolicy(retries=2, base_delay=0.1)
+        request = mock.Mock(side_effect=side_effect)
+        with mock.patch('source.lib.make_pycurl_request', request), \
+                mock.patch('source.lib.time.sleep') as sleep, \
+                mock.patch('source.lib.checker_stats') as stats, \
+                mock.patch('source.lib.logger', mock.Mock()):
+            result = get_url('http://example.net/', timeout=self.normal_timeout,
+                             context=CheckContext(retry_policy=policy))
+        counters = [args[0] for args, _ in stats.incr.call_args_list]
+        return result, request.call_count, sleep.call_count, counters
+
+    def test_get_url_retry_success(self):
+        """
+        Хоп с временной ошибкой повторяется, после паузы
+        """
+        error = pycurl.error(pycurl.E_OPERATION_TIMEDOUT, 'timeout')
+        result, requests, sleeps, counters = self._get_url_with_retries([error, ('', None)])
+        self.assertEqual(result, (None, None, ''))
+        self.assertEqual((requests, sleeps), (2, 1))
+        self.assertEqual(counters, ['retry.attempt', 'retry.success'])
+
+    def test_get_url_retry_exhausted(self):
+        error = pycurl.error(pycurl.E_COULDNT_CONNECT, 'connection refused')
+        result, requests, sleeps, counters = self._get_url_with_retries([error] * 3)
+        self.assertEqual(result, ('http://example.net/', ERROR_REDIRECT, None))
+        self.assertEqual((requests, sleeps), (3, 2))
+        self.assertEqual(counters, ['retry.attempt', 'retry.attempt', 'retry.exhausted'])
+
+    def test_get_url_no_retry_for_value_error(self):
+        result, requests, sleeps, counters = self._get_url_with_retries(ValueError('bad url'))
+        self.assertEqual(result, ('http://example.net/', ERROR_REDIRECT, None))
+        self.assertEqual((requests, sleeps, counters), (1, 0, []))
+
     def test_get_url_ok_redirect(self):
         """
         Пропускает ok login redirects
@@ -288,6 +499,152 @@ class TestInit(unittest.TestCase):
             self.assertEquals(([redirect_type], [url, redirect_url], ["GOOGLE_ANALYTICS"]),
                               get_redirect_history(url=url, timeout=self.small_timeout), "invalid returned values")
 
+    def test_get_redirect_history_cached(self):
+        """
+        При попадании в кэш запросов нет
+        """
+        url = "http://example.ru"
+        cached = (["type"], [url, "http://redirect.url"], [])
+        cache = mock.Mock()
+        cache.get = mock.Mock(return_value=cached)
+        with mock.patch('source.lib.get_url', mock.Mock()) as m_get_url:
+            self.assertEquals(get_redirect_history(url=url, timeout=self.small_timeout,
+                                                   context=CheckContext(result_cache=cache)), cached)
+        self.assertFalse(m_get_url.called)
+        cache.get.assert_called_once_with(url)
+
+    def test_get_redirect_history_stored_in_cache(self):
+        url = "http://example.ru"
+        cache = mock.Mock()
+        cache.get = mock.Mock(return_value=None)
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, None))):
+            get_redirect_history(url=url, timeout=self.small_timeout, context=CheckContext(result_cache=cache))
+        cache.set.assert_called_once_with(url, ([], [url], []))
+
+    def test_get_redirect_history_error_not_cached(self):
+        url = "http://example.ru"
+        cache = mock.Mock()
+        cache.get = mock.Mock(return_value=None)
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(url, ERROR_REDIRECT, None))):
+            get_redirect_history(url=url, timeout=self.small_timeout, context=CheckContext(result_cache=cache))
+        self.assertFalse(cache.set.called)
+
+    def test_get_redirect_history_cached_hops(self):
+        """
+        Цепочка доходит до уже известного хопа, остаток берется из кэша хопов
+        """
+        url = "http://example.ru"
+        tracker = "http://tracker.ru/"
+        landing = "http://landing.ru/"
+        hops = {
+            tracker: (landing, REDIRECT_HTTP, None),
+            landing: (None, None, ["YA_METRICA"]),
+        }
+        cache = mock.Mock()
+        cache.get = mock.Mock(side_effect=hops.get)
+        context = CheckContext(hop_cache=cache)
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(tracker, REDIRECT_META, ''))) as m_get_url:
+            self.assertEquals(([REDIRECT_META, REDIRECT_HTTP], [url, tracker, landing], ["YA_METRICA"]),
+                              get_redirect_history(url=url, timeout=self.small_timeout, context=context))
+        m_get_url.assert_called_once_with(url=url, timeout=self.small_timeout, user_agent=None, context=context)
+        cache.set.assert_called_once_with(url, (tracker, REDIRECT_META, None))
+
+    def test_get_redirect_history_final_counters_cached(self):
+        url = "http://example.ru"
+        cache = mock.Mock()
+        cache.get = mock.Mock(return_value=None)
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, 'google-analytics.com/ga.js'))):
+            get_redirect_history(url=url, timeout=self.small_timeout, context=CheckContext(hop_cache=cache))
+        cache.set.assert_called_once_with(url, (None, None, ["GOOGLE_ANALYTICS"]))
+
+    def test_get_redirect_history_error_hop_not_cached(self):
+        url = "http://example.ru"
+        cache = mock.Mock()
+        cache.get = mock.Mock(return_value=None)
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(url, ERROR_REDIRECT, None))):
+            get_redirect_history(url=url, timeout=self.small_timeout, context=CheckContext(hop_cache=cache))
+        self.assertFalse(cache.set.called)
+
+    def test_get_redirect_history_coalesced(self):
+        """
+        Урл уже проверяет другой воркер - его результат ждем, а не запрашиваем сами
+        """
+        url = "http://example.ru"
+        result = ([REDIRECT_HTTP], [url, "http://redirect.url"], [])
+        inflight = SharedCache(slots=8, slot_size=1024, ttl=5)
+        self.assertTrue(inflight.add(url, (None,)))
+
+        def finish_elsewhere(seconds):
+            inflight.set(url, (result,))
+
+        with mock.patch('source.lib.time.sleep', mock.Mock(side_effect=finish_elsewhere)) as m_sleep, \
+                mock.patch('source.lib.get_url', mock.Mock()) as m_get_url:
+            self.assertEquals(get_redirect_history(url=url, timeout=self.small_timeout,
+                                                   context=CheckContext(inflight_cache=inflight)), result)
+        self.assertFalse(m_get_url.called)
+        self.assertEqual(m_sleep.call_count, 1)
+
+    def test_get_redirect_history_coalesce_owner(self):
+        """
+        Проверяющий урл воркер отмечает его в реестре и оставляет результат ждущим
+        """
+        url = "http://example.ru"
+        inflight = SharedCache(slots=8, slot_size=1024, ttl=5)
+        seen = []
+        with mock.patch('source.lib.get_url',
+                        mock.Mock(side_effect=lambda **kwargs: seen.append(inflight.get(url)) or (None, None, None))):
+            result = get_redirect_history(url=url, timeout=self.small_timeout,
+                                          context=CheckContext(inflight_cache=inflight))
+        self.assertEqual(seen, [(None,)])
+        self.assertEqual(inflight.get(url), (result,))
+
+    def test_get_redirect_history_coalesce_owner_gone(self):
+        """
+        Проверка в другом воркере прервалась - урл проверяется заново
+        """
+        url = "http://example.ru"
+        inflight = SharedCache(slots=8, slot_size=1024, ttl=5)
+        inflight.add(url, (None,))
+        with mock.patch('source.lib.time.sleep', mock.Mock(side_effect=lambda seconds: inflight.delete(url))), \
+                mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, None))) as m_get_url:
+            self.assertEquals(get_redirect_history(url=url, timeout=self.small_timeout,
+                                                   context=CheckContext(inflight_cache=inflight)), ([], [url], []))
+        self.assertEqual(m_get_url.call_count, 1)
+
+    def test_get_redirect_history_coalesce_result_too_big(self):
+        """
+        Результат, не поместившийся в слот реестра, не оставляет урл отмеченным как проверяемый
+        """
+        url = "http://example.ru"
+        inflight = SharedCache(slots=8, slot_size=256, ttl=5)
+        with mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, 'page'))), \
+                mock.patch('source.lib.get_counters', mock.Mock(return_value=['C' * 300])):
+            result = get_redirect_history(url=url, timeout=self.small_timeout,
+                                          context=CheckContext(inflight_cache=inflight))
+        self.assertEqual(result, ([], [url], ['C' * 300]))
+        self.assertIsNone(inflight.get(url))
+        self.assertEqual(inflight.stats()['too_big'], 1)
+
+    def test_get_redirect_history_coalesce_interrupted(self):
+        url = "http://example.ru"
+        inflight = SharedCache(slots=8, slot_size=1024, ttl=5)
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=KeyboardInterrupt)):
+            self.assertRaises(KeyboardInterrupt, get_redirect_history, url=url, timeout=self.small_timeout,
+                              context=CheckContext(inflight_cache=inflight))
+        self.assertIsNone(inflight.get(url))
+
+    def test_get_redirect_history_interrupted_between_hops(self):
+        """
+        interrupt_check вызывается перед каждым хопом и прерывает проверку после законченного запроса
+        """
+        url = "http://example.ru"
+        interrupt_check = mock.Mock(side_effect=[None, DrainTimeout()])
+        get_url = mock.Mock(return_value=("http://redirect.url", "http_status", None))
+        with mock.patch('source.lib.get_url', get_url):
+            self.assertRaises(DrainTimeout, get_redirect_history, url=url, timeout=self.small_timeout,
+                              context=CheckContext(interrupt_check=interrupt_check))
+        self.assertEqual((get_url.call_count, interrupt_check.call_count), (1, 2))
+
     def test_redirect_one(self):
         """
         только 1 редирект
@@ -302,10 +659,10 @@ class TestInit(unittest.TestCase):
                               get_redirect_history(url=url, timeout=self.small_timeout, max_redirects=1),
                               "invalid returned values")
 
-    def _prepare_mock(self):
+    def _prepare_mock(self, content=True):
         m = mock.MagicMock(name="result")
         m.attrs = {
-            "content": True,
+            "content": content,
             "http-equiv": "refresh"
         }
         return m
@@ -315,11 +672,10 @@ class TestInit(unittest.TestCase):
         В контенте не 2 параметра
         :return:
         """
-        result = self._prepare_mock()
-        result.__getitem__ = mock.Mock(return_value="content")
+        result = self._prepare_mock("content")
         with mock.patch.object(re, 'search', mock.Mock()) as research, \
                 mock.patch.object(BeautifulSoup, 'find', return_value=result):
-            check_for_meta("content", "url")
+            check_for_meta_with_soup("content", "url")
             self.assertFalse(research.called)
 
     def test_check_for_meta_correct(self):
@@ -328,10 +684,9 @@ class TestInit(unittest.TestCase):
         :return:
         """
         url = "localhost/lal?what_are_you_doing=dont_know"
-        result = self._prepare_mock()
-        result.__getitem__ = mock.Mock(return_value="wait;url=" + url)
+        result = self._prepare_mock("wait;url=" + url)
         with mock.patch.object(BeautifulSoup, 'find', return_value=result):
-            check = check_for_meta("content", "url")
+            check = check_for_meta_with_soup("content", "url")
             self.assertEquals(check, url)
 
     def test_check_for_meta_no_meta(self):
@@ -340,7 +695,7 @@ class TestInit(unittest.TestCase):
         """
         ret = None
         with mock.patch.object(BeautifulSoup, 'find', return_value=ret):
-            check = check_for_meta("content", "url")
+            check = check_for_meta_with_soup("content", "url")
             self.assertIsNone(check)
 
     def test_check_for_meta_without_httpequiv_attr(self):
@@ -352,7 +707,7 @@ class TestInit(unittest.TestCase):
             "content": True,
         }
         with mock.patch.object(BeautifulSoup, 'find', return_value=result):
-            check = check_for_meta("content", "url")
+            check = check_for_meta_with_soup("content", "url")
             self.assertIsNone(check)
 
     def test_check_for_meta_httpequiv_no_refresh(self):
@@ -365,5 +720,33 @@ class TestInit(unittest.TestCase):
             'http-equiv': "no refresh"
         }
         with mock.patch.object(BeautifulSoup, 'find', return_value=result):
-            check = check_for_meta("content", "url")
+            check = check_for_meta_with_soup("content", "url")
             self.assertIsNone(check)
+
+    def test_check_for_meta_same_as_soup(self):
+        """
+        Потоковый поиск дает тот же результат, что и разбор в BeautifulSoup, на сохраненных страницах
+        """
+        pages = glob.glob(os.path.join(os.path.dirname(__file__), 'pages', '*.html'))
+        self.assertTrue(pages)
+        for page in pages:
+            with open(page) as f:
+                content = f.read()
+            self.assertEquals(check_for_meta(content, 'http://example.net/page'),
+                              check_for_meta_with_soup(content, 'http://example.net/page'), page)
+
+    def test_check_for_meta_without_soup(self):
+        """
+        Страница без мета-редиректа не разбирается в BeautifulSoup
+        """
+        content = '<html><head><title>t</title></head><body>' + '<p>text</p>' * 1000 + '</body></html>'
+        with mock.patch('source.lib.BeautifulSoup') as soup:
+            self.assertIsNone(check_for_meta(content, 'url'))
+        self.assertFalse(soup.called)
+
+    def test_check_for_meta_stops_at_body(self):
+        """
+        Мета-тег после начала содержимого страницы не ищется
+        """
+        content = '<html><body><div><meta http-equiv="refresh" content="0;url=http://a.ru/"></div></body></html>'
+        self.assertIsNone(check_for_meta(content, 'url'))
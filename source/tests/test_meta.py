@@ -0,0 +1,47 @@
+# coding: utf-8
+import unittest
+
+from source.lib import meta
+
+
+class MetaTagScannerTestCase(unittest.TestCase):
+    def test_incremental_feed(self):
+        """
+        Тег, разрезанный между кусками, находится
+        """
+        scanner = meta.MetaTagScanner()
+        self.assertFalse(scanner.feed('<html><head><me'))
+        self.assertTrue(scanner.feed('ta http-equiv="refresh" content="0;url=/a">'))
+        self.assertEqual(scanner.attrs, {'http-equiv': 'refresh', 'content': '0;url=/a'})
+
+    def test_stops_at_head_end(self):
+        scanner = meta.MetaTagScanner()
+        self.assertTrue(scanner.feed('<html><head><title>t</title></head>'))
+        self.assertIsNone(scanner.attrs)
+        self.assertTrue(scanner.feed('<meta http-equiv="refresh" content="0;url=/a">'))
+        self.assertIsNone(scanner.attrs)
+
+    def test_stops_at_body_tag(self):
+        scanner = meta.MetaTagScanner()
+        self.assertTrue(scanner.feed('<html><div>'))
+        self.assertFalse(scanner.failed)
+
+    def test_not_utf8(self):
+        scanner = meta.MetaTagScanner()
+        self.assertTrue(scanner.feed('<html><head><title>\xd2\xe5\xf1\xf2</title>'))
+        self.assertTrue(scanner.failed)
+
+    def test_split_utf8_character(self):
+        scanner = meta.MetaTagScanner()
+        text = u'<title>тест</title><meta name="x">'.encode('utf-8')
+        self.assertFalse(scanner.feed(text[:9]))
+        self.assertTrue(scanner.feed(text[9:]))
+        self.assertFalse(scanner.failed)
+        self.assertEqual(scanner.attrs, {'name': 'x'})
+
+    def test_find_first_meta(self):
+        content = '<head>' + ' ' * meta.CHUNK_SIZE + '<meta charset="utf-8"><meta name="second">'
+        self.assertEqual(meta.find_first_meta(content), ({'charset': 'utf-8'}, False))
+
+    def test_find_first_meta_empty(self):
+        self.assertEqual(meta.find_first_meta(''), (None, False))
@@ -0,0 +1,288 @@
+# coding: utf-8
+import unittest
+
+import mock
+import pycurl
+
+from source.lib import ERROR_REDIRECT, REDIRECT_HTTP, CheckContext
+from source.lib import multi
+from source.lib.dns_resolver import DnsResolver
+from source.lib.retry import RetryPolicy
+from source.lib.shared_cache import SharedCache
+
+
+class FakeCurl(object):
+    """
+    curl-хэндл, который отвечает по заранее заданной таблице урл -> (контент, редирект)
+    """
+    URL = pycurl.URL
+    USERAGENT = pycurl.USERAGENT
+    WRITEFUNCTION = pycurl.WRITEFUNCTION
+    HEADERFUNCTION = pycurl.HEADERFUNCTION
+    FOLLOWLOCATION = pycurl.FOLLOWLOCATION
+    TIMEOUT = pycurl.TIMEOUT
+    RESOLVE = pycurl.RESOLVE
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.options = {}
+
+    def setopt(self, option, value):
+        self.options[option] = value
+
+    def getinfo(self, option):
+        return self.responses[self.options[pycurl.URL]][1]
+
+    def reset(self):
+        self.options = {}
+
+    def close(self):
+        pass
+
+
+class FakeMulti(object):
+    """
+    CurlMulti, у которого каждый добавленный хэндл завершается за один perform
+    """
+    def __init__(self):
+        self.handles = []
+        self.max_active = 0
+
+    def add_handle(self, curl):
+        self.handles.append(curl)
+        self.max_active = max(self.max_active, len(self.handles))
+
+    def remove_handle(self, curl):
+        self.handles.remove(curl)
+
+    def perform(self):
+        return 0, len(self.handles)
+
+    def info_read(self):
+        ok_list, err_list = [], []
+        for curl in self.handles:
+            content, redirect = curl.responses[curl.options[pycurl.URL]]
+            if isinstance(content, Exception):
+                err_list.append((curl, 7, 'connection refused'))
+            elif curl.options[pycurl.WRITEFUNCTION](content) == 0:
+                err_list.append((curl, pycurl.E_WRITE_ERROR, 'write error'))
+            else:
+                ok_list.append(curl)
+        return 0, ok_list, err_list
+
+    def select(self, timeout):
+        return 0
+
+    def close(self):
+        pass
+
+
+class RedirectEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.responses = {
+            'http://a.ru/': ('', 'http://b.ru/'),
+            'http://b.ru/': ('google-analytics.com/ga.js', None),
+            'http://loop.ru/': ('', 'http://loop.ru/'),
+            'http://down.ru/': (Exception(), None),
+        }
+        self.fake_multi = FakeMulti()
+
+    def _run(self, urls, concurrency=multi.DEFAULT_CONCURRENCY, **kwargs):
+        with mock.patch('source.lib.multi.pycurl.CurlMulti', mock.Mock(return_value=self.fake_multi)), \
+                mock.patch('source.lib.multi.pycurl.Curl', mock.Mock(side_effect=lambda: FakeCurl(self.responses))), \
+                mock.patch('source.lib.multi.logger', mock.Mock()):
+            return multi.get_redirect_histories(urls, timeout=1, concurrency=concurrency, **kwargs)
+
+    def test_chain_result(self):
+        """
+        Результат совпадает с форматом get_redirect_history
+        """
+        result = self._run(['http://a.ru/'])
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://a.ru/', 'http://b.ru/'], ['GOOGLE_ANALYTICS'])])
+
+    def test_results_in_urls_order(self):
+        urls = ['http://b.ru/', 'http://a.ru/', 'http://b.ru/']
+        result = self._run(urls)
+        self.assertEqual([history_urls[0] for _, history_urls, _ in result], urls)
+
+    def test_redirect_loop(self):
+        result = self._run(['http://loop.ru/'])
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://loop.ru/', 'http://loop.ru/'], [])])
+
+    def test_error(self):
+        result = self._run(['http://down.ru/'])
+        self.assertEqual(result, [([ERROR_REDIRECT], ['http://down.ru/', 'http://down.ru/'], [])])
+
+    def test_error_retried(self):
+        """
+        Хоп с временной ошибкой повторяется после паузы, пауза не занимает слот
+        """
+        responses = [(Exception(), None), ('', None)]
+        self.responses['http://flaky.ru/'] = responses[0]
+        clock = [100.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+            self.responses['http://flaky.ru/'] = responses[1]
+
+        with mock.patch('source.lib.retry.random.uniform', mock.Mock(return_value=0.5)), \
+                mock.patch('source.lib.logger', mock.Mock()), \
+                mock.patch('source.lib.multi.time', mock.Mock(side_effect=lambda: clock[0])), \
+                mock.patch('source.lib.multi.sleep', mock.Mock(side_effect=sleep)) as m_sleep, \
+                mock.patch('source.lib.multi.stats') as stats:
+            result = self._run(['http://flaky.ru/'], context=CheckContext(retry_policy=RetryPolicy(retries=2)))
+        self.assertEqual(result, [([], ['http://flaky.ru/'], [])])
+        m_sleep.assert_called_once_with(0.5)
+        stats.incr.assert_called_once_with('retry.success')
+
+    def test_error_retries_exhausted(self):
+        with mock.patch('source.lib.logger', mock.Mock()), \
+                mock.patch('source.lib.checker_stats') as stats:
+            context = CheckContext(retry_policy=RetryPolicy(retries=2, base_delay=0))
+            result = self._run(['http://down.ru/'], context=context)
+        self.assertEqual(result, [([ERROR_REDIRECT], ['http://down.ru/', 'http://down.ru/'], [])])
+        self.assertEqual([args[0] for args, _ in stats.incr.call_args_list],
+                         ['retry.attempt', 'retry.attempt', 'retry.exhausted'])
+
+    def test_body_limit(self):
+        """
+        Прерванная по лимиту загрузка конечной страницы - не ошибка
+        """
+        self.responses['http://big.ru/'] = ('x' * 100 + 'google-analytics.com/ga.js', None)
+        result = self._run(['http://big.ru/'], context=CheckContext(head_limit=10, body_limit=50))
+        self.assertEqual(result, [([], ['http://big.ru/'], [])])
+
+    def test_cached(self):
+        cached = ([REDIRECT_HTTP], ['http://c.ru/', 'http://b.ru/'], [])
+        cache = mock.Mock()
+        cache.get = mock.Mock(side_effect=lambda key: cached if key == 'http://c.ru/' else None)
+        result = self._run(['http://c.ru/', 'http://b.ru/'], context=CheckContext(result_cache=cache))
+        self.assertEqual(result, [cached, ([], ['http://b.ru/'], ['GOOGLE_ANALYTICS'])])
+        self.assertEqual(self.fake_multi.max_active, 1)
+        cache.set.assert_called_once_with('http://b.ru/', result[1])
+
+    def test_cached_hops(self):
+        """
+        Хоп, известный из кэша хопов, не запрашивается
+        """
+        hops = {'http://b.ru/': (None, None, ['YA_METRICA'])}
+        cache = mock.Mock()
+        cache.get = mock.Mock(side_effect=hops.get)
+        result = self._run(['http://a.ru/'], context=CheckContext(hop_cache=cache))
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://a.ru/', 'http://b.ru/'], ['YA_METRICA'])])
+        cache.set.assert_called_once_with('http://a.ru/', ('http://b.ru/', REDIRECT_HTTP, None))
+
+    def test_ignored_domain_without_requests(self):
+        url = 'https://my.mail.ru/apps/'
+        self.assertEqual(self._run([url]), [([], [url], [])])
+        self.assertEqual(self.fake_multi.max_active, 0)
+
+    def test_concurrency_limit(self):
+        self._run(['http://a.ru/'] * 10, concurrency=3)
+        self.assertEqual(self.fake_multi.max_active, 3)
+
+    def test_host_concurrency(self):
+        result = self._run(['http://b.ru/'] * 5 + ['http://a.ru/'], host_concurrency=2)
+        self.assertEqual(self.fake_multi.max_active, 3)
+        self.assertEqual(result[-1], ([REDIRECT_HTTP], ['http://a.ru/', 'http://b.ru/'], ['GOOGLE_ANALYTICS']))
+
+    def test_ip_concurrency(self):
+        """
+        Лимит на ip действует на разные хосты с одним адресом
+        """
+        with mock.patch('source.lib.multi.get_host_address', mock.Mock(return_value='1.2.3.4')):
+            self._run(['http://b.ru/', 'http://a.ru/', 'http://b.ru/'], host_concurrency=5, ip_concurrency=1)
+        self.assertEqual(self.fake_multi.max_active, 1)
+
+    def test_dns_not_blocking(self):
+        """
+        Движок не ждет DNS: адрес хоста берется только из кэша, промах уходит на фоновое разрешение
+        """
+        resolver = DnsResolver({}, prefetch_threads=0)
+        with mock.patch('source.lib.dns_resolver.socket.getaddrinfo', mock.Mock()) as m_gai, \
+                mock.patch.object(resolver, '_enqueue', mock.Mock()) as enqueue:
+            result = self._run(['http://a.ru/'], context=CheckContext(resolver=resolver))
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://a.ru/', 'http://b.ru/'], ['GOOGLE_ANALYTICS'])])
+        self.assertFalse(m_gai.called)
+        self.assertIn(mock.call('a.ru', 80), enqueue.call_args_list)
+        self.assertIn(mock.call('b.ru', 80), enqueue.call_args_list)
+
+    def test_create_redirect_engine(self):
+        config = mock.Mock()
+        context = CheckContext()
+        with mock.patch('source.lib.multi.pycurl.CurlMulti', mock.Mock(return_value=self.fake_multi)):
+            engine = multi.create_redirect_engine(config, context=context)
+        self.assertEqual((engine.timeout, engine.concurrency, engine.waiting.host_limit, engine.waiting.ip_limit),
+                         (config.HTTP_TIMEOUT, config.ENGINE_CONCURRENCY, config.ENGINE_HOST_CONCURRENCY,
+                          config.ENGINE_IP_CONCURRENCY))
+        self.assertIs(engine.context, context)
+
+    def test_callback(self):
+        callback = mock.Mock()
+        with mock.patch('source.lib.multi.pycurl.CurlMulti', mock.Mock(return_value=self.fake_multi)), \
+                mock.patch('source.lib.multi.pycurl.Curl', mock.Mock(side_effect=lambda: FakeCurl(self.responses))):
+            engine = multi.RedirectEngine(timeout=1)
+            engine.add('http://b.ru/', callback)
+            engine.run()
+        callback.assert_called_once_with(([], ['http://b.ru/'], ['GOOGLE_ANALYTICS']))
+
+    def _engine(self, inflight):
+        with mock.patch('source.lib.multi.pycurl.CurlMulti', mock.Mock(return_value=self.fake_multi)):
+            return multi.RedirectEngine(timeout=1, context=CheckContext(inflight_cache=inflight))
+
+    def _inflight(self):
+        inflight = SharedCache(slots=8, slot_size=1024, ttl=5)
+        self.addCleanup(inflight.close)
+        return inflight
+
+    def test_coalesced_in_engine(self):
+        """
+        Тот же урл, поставленный в движок дважды, запрашивается один раз
+        """
+        inflight = self._inflight()
+        with mock.patch.object(self.fake_multi, 'add_handle', wraps=self.fake_multi.add_handle) as add_handle:
+            result = self._run(['http://b.ru/', 'http://b.ru/'], context=CheckContext(inflight_cache=inflight))
+        self.assertEqual(result, [([], ['http://b.ru/'], ['GOOGLE_ANALYTICS'])] * 2)
+        self.assertEqual(add_handle.call_count, 1)
+        self.assertEqual(inflight.get('http://b.ru/'), (result[0],))
+
+    def test_coalesced_with_other_worker(self):
+        """
+        Урл, который проверяет другой воркер, не запрашивается: движок ждет его результат
+        """
+        inflight = self._inflight()
+        result = ([REDIRECT_HTTP], ['http://a.ru/', 'http://c.ru/'], [])
+        inflight.add('http://a.ru/', (None,))
+        engine = self._engine(inflight)
+        callback = mock.Mock()
+        engine.add('http://a.ru/', callback)
+        engine.step(0)
+        self.assertTrue(engine.has_work())
+        self.assertEqual(callback.call_count, 0)
+
+        inflight.set('http://a.ru/', (result,))
+        engine.parked_poll_at = 0
+        engine.run()
+        callback.assert_called_once_with(result)
+        self.assertEqual(self.fake_multi.max_active, 0)
+        engine.close()
+
+    def test_coalesce_interrupted(self):
+        """
+        Если проверка другим воркером прервана, движок проверяет урл сам
+        """
+        inflight = self._inflight()
+        inflight.add('http://b.ru/', (None,))
+        interrupt = mock.Mock(side_effect=lambda seconds: inflight.delete('http://b.ru/'))
+        with mock.patch('source.lib.multi.sleep', interrupt):
+            result = self._run(['http://b.ru/'], context=CheckContext(inflight_cache=inflight))
+        self.assertEqual(result, [([], ['http://b.ru/'], ['GOOGLE_ANALYTICS'])])
+        self.assertEqual(inflight.get('http://b.ru/'), (result[0],))
+
+    def test_close_releases_claims(self):
+        inflight = self._inflight()
+        engine = self._engine(inflight)
+        engine.add('http://b.ru/')
+        self.assertEqual(inflight.get('http://b.ru/'), (None,))
+        engine.close()
+        self.assertIsNone(inflight.get('http://b.ru/'))
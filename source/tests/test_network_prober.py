@@ -0,0 +1,134 @@
+# coding: utf-8
+from multiprocessing import Event, Process
+import os
+import signal
+import time
+import unittest
+
+import mock
+
+from source.lib.network_prober import FetchMeter, NetworkProber, create_network_prober
+
+
+def hold_lock(meter, locked):
+    with meter.lock:
+        locked.set()
+        time.sleep(60)
+
+
+class FetchMeterTestCase(unittest.TestCase):
+    def test_record(self):
+        meter = FetchMeter()
+        meter.record(False)
+        meter.record(True)
+        meter.record(True)
+        self.assertEqual(meter.snapshot(), (3, 2))
+
+    def test_lock_released_by_killed_worker(self):
+        """
+        Воркер, убитый посреди записи, не оставляет метр заблокированным
+        """
+        meter = FetchMeter()
+        locked = Event()
+        holder = Process(target=hold_lock, args=(meter, locked))
+        holder.start()
+        self.assertTrue(locked.wait(5))
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+
+        writer = Process(target=meter.record, args=(True,))
+        writer.start()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(meter.snapshot(), (1, 1))
+
+
+class NetworkProberTestCase(unittest.TestCase):
+    def _prober(self, **kwargs):
+        params = dict(urls=['http://a', 'http://b'], down_checks=3, up_checks=2)
+        params.update(kwargs)
+        return NetworkProber(**params)
+
+    def test_probe_all_any_endpoint(self):
+        """
+        Сеть есть, если ответил хотя бы один адрес; адреса опрашиваются с таймаутом проверки
+        """
+        prober = self._prober(timeout=0.5)
+        with mock.patch('source.lib.network_prober.check_network_status',
+                        mock.Mock(side_effect=lambda url, timeout: url == 'http://b')) as check:
+            self.assertTrue(prober.probe_all())
+        self.assertEqual(sorted(check.call_args_list),
+                         [mock.call('http://a', 0.5), mock.call('http://b', 0.5)])
+        with mock.patch('source.lib.network_prober.check_network_status', mock.Mock(return_value=False)):
+            self.assertFalse(prober.probe_all())
+
+    def test_probe_metrics(self):
+        prober = self._prober()
+        with mock.patch('source.lib.network_prober.check_network_status', mock.Mock(return_value=False)),\
+                mock.patch('source.lib.network_prober.time', mock.Mock(side_effect=[1.0, 1.25])),\
+                mock.patch('source.lib.network_prober.stats') as stats:
+            prober.probe('http://a', [None], 0)
+        stats.timing.assert_called_once_with('network.probe', 0.25)
+        stats.incr.assert_called_once_with('network.probe_failed')
+
+    def test_down_after_consecutive_failures(self):
+        prober = self._prober()
+        self.assertEqual([prober.update(ok) for ok in (False, False, True, False, False)], [False] * 5)
+        self.assertTrue(prober.up)
+        self.assertTrue(prober.update(False))
+        self.assertFalse(prober.up)
+
+    def test_up_after_consecutive_successes(self):
+        prober = self._prober()
+        prober.up = False
+        self.assertEqual([prober.update(ok) for ok in (True, False, True)], [False] * 3)
+        with mock.patch('source.lib.network_prober.stats') as stats:
+            self.assertTrue(prober.update(True))
+        self.assertTrue(prober.up)
+        stats.incr.assert_called_once_with('network.up')
+
+    def test_workers_failing(self):
+        """
+        Доля ошибок загрузки считается за период с прошлой проверки
+        """
+        meter = FetchMeter()
+        prober = self._prober(meter=meter, max_error_rate=0.5, min_fetches=4)
+        for failed in (True, True, True):
+            meter.record(failed)
+        self.assertFalse(prober.workers_failing(), 'too few fetches')
+        for failed in (True, True, True, False):
+            meter.record(failed)
+        self.assertTrue(prober.workers_failing())
+        for failed in (True, False, False, False):
+            meter.record(failed)
+        self.assertFalse(prober.workers_failing())
+
+    def test_check(self):
+        prober = self._prober(meter=FetchMeter())
+        with mock.patch.object(prober, 'probe_all', mock.Mock(return_value=True)),\
+                mock.patch.object(prober, 'workers_failing', mock.Mock(return_value=True)):
+            self.assertFalse(prober.check())
+        with mock.patch.object(prober, 'probe_all', mock.Mock(return_value=True)),\
+                mock.patch.object(prober, 'workers_failing', mock.Mock(return_value=False)):
+            self.assertTrue(prober.check())
+
+    def test_start(self):
+        """
+        Начальное состояние - результат первой проверки, дальше проверки идут в фоне
+        """
+        prober = self._prober()
+        with mock.patch.object(prober, 'check', mock.Mock(return_value=False)),\
+                mock.patch('source.lib.network_prober.Thread') as thread:
+            prober.start()
+        self.assertFalse(prober.up)
+        thread.assert_called_once_with(target=prober._loop, name='NetworkProber')
+        thread.return_value.start.assert_called_once_with()
+
+    def test_create_network_prober(self):
+        config = mock.Mock()
+        meter = mock.Mock()
+        meter.snapshot = mock.Mock(return_value=(0, 0))
+        prober = create_network_prober(config, meter)
+        self.assertEqual((prober.urls, prober.timeout, prober.down_checks, prober.meter),
+                         (config.NETWORK_CHECK_URLS, config.NETWORK_CHECK_TIMEOUT,
+                          config.NETWORK_CHECK_DOWN_CHECKS, meter))
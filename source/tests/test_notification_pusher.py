@@ -1,14 +1,34 @@
+import json
 import unittest
 import mock
 
+import gevent
 import source.notification_pusher as notification_pusher
 from gevent import queue as gevent_queue
+from gevent.lock import RLock, Semaphore
+from gevent.pool import Pool
+from source.lib.retry import TaskRetryPolicy
 
 
 def russian_woman_and_horse(*args, **kwargs):
     notification_pusher.run = False
 
 
+def taken_task(**kwargs):
+    """
+    task taken through a connection with a request lock, as made by connect_tube
+    """
+    task = mock.Mock(**kwargs)
+    task.queue.tarantool_lock = RLock()
+    return task
+
+
+def take_tube():
+    tube = mock.Mock()
+    tube.queue.tarantool_lock = RLock()
+    return tube
+
+
 class MainLoopTestCase(unittest.TestCase):
     def setUp(self):
         pass
@@ -23,8 +43,23 @@ class MainLoopTestCase(unittest.TestCase):
         config.QUEUE_SPACE = 0
         config.QUEUE_TUBE = 'tube'
         config.QUEUE_TAKE_TIMEOUT = 0
+        config.QUEUE_TAKERS = 1
+        config.QUEUE_PREFETCH = 2
+        config.QUEUE_PREFETCH_MAX_AGE = 10
+        config.ACK_BATCH_SIZE = 10
+        config.HOST_MAX_SHARE = 0.5
+        config.BREAKER_WINDOW = 30
+        config.BREAKER_MIN_REQUESTS = 10
+        config.BREAKER_MAX_ERROR_RATE = 0.5
+        config.BREAKER_OPEN_TIMEOUT = 30
+        config.RETRY_MAX_ATTEMPTS = 3
+        config.RETRY_DELAY = 10
+        config.RETRY_MAX_DELAY = 600
+        config.BATCH_CALLBACK_URLS = ()
+        config.BATCH_WINDOW = 0.5
+        config.BATCH_MAX_SIZE = 100
         config.WORKER_POOL_SIZE = 0
-        config.SLEEP = 1
+        config.STATS_INTERVAL = 60
         return config
 
     @mock.patch('source.lib.utils.tarantool_queue.Queue')
@@ -33,33 +68,280 @@ class MainLoopTestCase(unittest.TestCase):
     def test_main_loop_stopped(self, m_gevent_queue, m_pool, m_queue):
         notification_pusher.run = False
         notification_pusher.logger = mock.Mock()
+        m_gevent_queue.return_value.get_nowait = mock.Mock(side_effect=gevent_queue.Empty)
         config = self._config()
         notification_pusher.main_loop(config)
 
-        self.assertEqual(m_queue.call_count, 1, "Expected only one call")
+        self.assertEqual(m_queue.call_count, config.QUEUE_TAKERS, "Expected one connection per taker")
         m_pool.assert_called_once_with(config.WORKER_POOL_SIZE)
-        self.assertEqual(m_gevent_queue.call_count, 1, "Expected only one call")
+        self.assertEqual(m_gevent_queue.call_count, 2, "Expected processed tasks queue and prefetch buffer")
         notification_pusher.logger.info.assert_called_with('Stop application loop.')
 
+    @mock.patch('source.lib.utils.tarantool_queue.Queue', mock.Mock())
+    @mock.patch('source.notification_pusher.Pool', mock.Mock())
+    def test_main_loop_http_session(self):
+        """
+        workers share one pooled http session created from config
+        """
+        notification_pusher.run = False
+        notification_pusher.logger = mock.Mock()
+        config = self._config()
+        with mock.patch('source.notification_pusher.create_http_session', mock.Mock()) as create_http_session:
+            notification_pusher.main_loop(config)
+        create_http_session.assert_called_once_with(config)
+        self.assertEqual(notification_pusher.http_session, create_http_session.return_value)
+
+    @mock.patch('source.lib.utils.tarantool_queue.Queue', mock.Mock())
+    @mock.patch('source.notification_pusher.Pool', mock.Mock())
+    @mock.patch('source.notification_pusher.create_http_session', mock.Mock())
+    def test_main_loop_host_guard(self):
+        notification_pusher.run = False
+        notification_pusher.logger = mock.Mock()
+        config = self._config()
+        with mock.patch('source.notification_pusher.create_host_guard', mock.Mock()) as create_host_guard:
+            notification_pusher.main_loop(config)
+        create_host_guard.assert_called_once_with(config)
+        self.assertEqual(notification_pusher.host_guard, create_host_guard.return_value)
+        self.assertEqual(notification_pusher.retry_policy.max_attempts, config.RETRY_MAX_ATTEMPTS)
+
+    @mock.patch('source.lib.utils.tarantool_queue.Queue', mock.Mock())
+    @mock.patch('source.notification_pusher.Pool', mock.Mock())
+    @mock.patch('source.notification_pusher.create_http_session', mock.Mock())
+    def test_main_loop_releases_pending_batches(self):
+        notification_pusher.run = False
+        notification_pusher.logger = mock.Mock()
+        tasks = [taken_task(), taken_task()]
+        with mock.patch('source.notification_pusher.create_delivery_batcher',
+                        mock.Mock(return_value=mock.Mock(drain=mock.Mock(return_value=tasks)))):
+            notification_pusher.main_loop(self._config())
+        for task in tasks:
+            task.release.assert_called_once_with()
+
 
-    @mock.patch('source.notification_pusher.gevent_queue.Queue', mock.Mock())
-    @mock.patch('source.lib.utils.tarantool_queue.Queue')
-    @mock.patch('source.notification_pusher.Pool')
-    def test_main_loop_run(self, m_pool, m_queue):
+    def _take(self, tasks):
+        def take(timeout):
+            gevent.sleep(0)
+            return tasks.pop(0) if tasks else None
+        return take
+
+    def test_main_loop_run(self):
+        """
+        tasks taken by the taker greenlet are dispatched without sleeping in the loop
+        """
         notification_pusher.run = True
-        workers_count = 5
+        notification_pusher.logger = mock.Mock()
+        config = self._config()
+        config.WORKER_POOL_SIZE = 2
+        tube = mock.Mock()
+        tasks = [mock.Mock(task_id=task_id, queue=tube.queue) for task_id in xrange(3)]
+        tube.take = self._take(list(tasks))
+        dispatched = []
+
+        def dispatch_task(task, taken_at, worker_pool, processed_task_queue, config):
+            dispatched.append(task)
+            if len(dispatched) == len(tasks):
+                notification_pusher.run = False
+
+        with mock.patch('source.notification_pusher.get_tube',
+                        mock.Mock(side_effect=[tube, mock.Mock(), mock.Mock()])), \
+                mock.patch('source.notification_pusher.create_http_session', mock.Mock()), \
+                mock.patch('source.notification_pusher.dispatch_task', dispatch_task), \
+                mock.patch('source.notification_pusher.sleep', mock.Mock()) as m_sleep, \
+                mock.patch('source.notification_pusher.done_with_processed_tasks', mock.Mock()):
+            notification_pusher.main_loop(config)
+
+        self.assertEqual(dispatched, tasks)
+        self.assertEqual([task.queue for task in tasks], [tube.queue] * len(tasks),
+                         "tasks stay on the taker connection")
+        self.assertIsInstance(tube.queue.tarantool_lock, RLock)
+        self.assertEqual(m_sleep.call_count, 0)
+
+    def test_main_loop_taker_failed(self):
+        """
+        queue errors in a taker stop the main loop, prefetched tasks are released
+        """
+        import tarantool
 
-        m_pool().free_count = mock.Mock(return_value=workers_count)
+        notification_pusher.run = True
+        notification_pusher.logger = mock.Mock()
+        tube = mock.Mock()
+        task = mock.Mock(task_id=1, queue=tube.queue)
+        tube.take = mock.Mock(side_effect=[task, tarantool.DatabaseError()])
+        with mock.patch('source.notification_pusher.get_tube',
+                        mock.Mock(side_effect=[tube, mock.Mock(), mock.Mock()])), \
+                mock.patch('source.notification_pusher.create_http_session', mock.Mock()), \
+                mock.patch('source.notification_pusher.dispatch_task', mock.Mock()):
+            self.assertRaises(tarantool.DatabaseError, notification_pusher.main_loop, self._config())
+        notification_pusher.run = True
 
-        m_queue().tube = mock.Mock()
-        m_queue().tube.take = mock.Mock(return_value=type('', (), {'task_id': 42}))
 
-        with mock.patch('source.notification_pusher.sleep', mock.Mock(side_effect=russian_woman_and_horse)), \
-                mock.patch('source.notification_pusher.done_with_processed_tasks', mock.Mock()):
-            notification_pusher.main_loop(self._config())
+class TakeTasksTestCase(unittest.TestCase):
+    def test_take_tasks_prefetch_limit(self):
+        """
+        no more than prefetch tasks are taken ahead of workers
+        """
+        tube = take_tube()
+        tube.take = mock.Mock(side_effect=lambda timeout: mock.Mock())
+        prefetched = gevent_queue.Queue()
+        slots = Semaphore(2)
+        notification_pusher.run = True
+        taker = gevent.spawn(notification_pusher.take_tasks, tube, prefetched, slots, 0)
+        gevent.sleep(0.01)
+        self.assertEqual((tube.take.call_count, prefetched.qsize()), (2, 2))
+        prefetched.get()
+        slots.release()
+        gevent.sleep(0.01)
+        self.assertEqual(tube.take.call_count, 3)
+        taker.kill()
+
+    def test_take_tasks_empty(self):
+        """
+        slot is freed when the queue has no task
+        """
+        calls = []
+
+        def take(timeout):
+            calls.append(timeout)
+            if len(calls) == 2:
+                russian_woman_and_horse()
+            return None
+
+        tube = take_tube()
+        tube.take = take
+        notification_pusher.run = True
+        notification_pusher.take_tasks(tube, gevent_queue.Queue(), Semaphore(1), 0.5)
+        notification_pusher.run = True
+        self.assertEqual(calls, [0.5, 0.5])
+
+
+    def _spawn_taker(self, tube, take_time):
+        def take(timeout):
+            gevent.sleep(take_time)
+            tube.taken.append(timeout)
+            return None
 
-        self.assertEquals(m_queue().tube().take.call_count, workers_count)
-        self.assertEquals(m_pool().add.call_count, workers_count)
+        tube.taken = []
+        tube.take = take
+        notification_pusher.run = True
+        return gevent.spawn(notification_pusher.take_tasks, tube, gevent_queue.Queue(), Semaphore(1), 0)
+
+    def test_task_completed_on_taker_connection(self):
+        """
+        task is acked through the connection that took it, between the taker's requests
+        """
+        tube = take_tube()
+        taker = self._spawn_taker(tube, 0.001)
+        task = mock.Mock(queue=tube.queue)
+        task.ack = mock.Mock(side_effect=lambda: self.assertTrue(tube.queue.tarantool_lock._is_owned()))
+        gevent.sleep(0.005)
+        with gevent.Timeout(1):
+            notification_pusher.complete_task(task, 'ack')
+        task.ack.assert_called_once_with()
+        taker.kill()
+
+    def test_stop_takers(self):
+        """
+        taker is not interrupted in the middle of take
+        """
+        tube = take_tube()
+        taker = self._spawn_taker(tube, 0.01)
+        gevent.sleep(0.005)
+        notification_pusher.stop_takers([taker], [tube])
+        self.assertTrue(taker.dead)
+        self.assertEqual(len(tube.taken), 1)
+
+
+class DispatchTaskTestCase(unittest.TestCase):
+    def setUp(self):
+        notification_pusher.logger = mock.Mock()
+        self.config = mock.Mock(QUEUE_PREFETCH_MAX_AGE=10, HTTP_CONNECTION_TIMEOUT=5, HOST_DEFER_DELAY=3)
+        patcher = mock.patch('source.notification_pusher.host_guard', mock.Mock())
+        self.host_guard = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('source.notification_pusher.delivery_batcher',
+                             mock.Mock(join=mock.Mock(return_value=False), accepts=mock.Mock(return_value=False)))
+        self.delivery_batcher = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dispatch(self):
+        task = mock.Mock(data={'callback_url': 'http://partner.ru:8080/push'})
+        pool = mock.Mock()
+        with mock.patch('source.notification_pusher.time', mock.Mock(return_value=105)):
+            notification_pusher.dispatch_task(task, 100, pool, 'processed', self.config)
+        pool.wait_available.assert_called_once_with()
+        self.host_guard.acquire.assert_called_once_with('partner.ru:8080')
+        pool.spawn.assert_called_once_with(notification_pusher.notification_worker, task, 'processed',
+                                           timeout=5, verify=False)
+
+    def test_dispatch_deferred(self):
+        """
+        task for a host that is saturated or has an open breaker is put back with a delay
+        """
+        task = taken_task(data={'callback_url': 'http://partner.ru/push'})
+        task.release = mock.Mock(side_effect=lambda **kwargs: self.assertTrue(task.queue.tarantool_lock._is_owned()))
+        pool = mock.Mock()
+        self.host_guard.acquire.return_value = False
+        with mock.patch('source.notification_pusher.time', mock.Mock(return_value=105)):
+            notification_pusher.dispatch_task(task, 100, pool, 'processed', self.config)
+        task.release.assert_called_once_with(delay=3)
+        self.assertEqual(pool.spawn.call_count, 0)
+
+    def test_dispatch_joins_open_batch(self):
+        """
+        task for an open batch does not wait for a worker or take a host slot
+        """
+        task = mock.Mock(data={'callback_url': 'http://partner.ru/push'})
+        pool = mock.Mock()
+        self.delivery_batcher.join.return_value = True
+        notification_pusher.dispatch_task(task, 100, pool, 'processed', self.config)
+        self.delivery_batcher.join.assert_called_once_with('http://partner.ru/push', task)
+        self.assertEqual((pool.wait_available.call_count, self.host_guard.acquire.call_count), (0, 0))
+
+    def test_dispatch_opens_batch(self):
+        task = mock.Mock(data={'callback_url': 'http://partner.ru/push'})
+        pool = mock.Mock()
+        self.delivery_batcher.accepts.return_value = True
+        with mock.patch('source.notification_pusher.time', mock.Mock(return_value=105)):
+            notification_pusher.dispatch_task(task, 100, pool, 'processed', self.config)
+        self.host_guard.acquire.assert_called_once_with('partner.ru')
+        self.delivery_batcher.open.assert_called_once_with('http://partner.ru/push', task)
+        self.assertEqual(pool.spawn.call_count, 0)
+
+    def test_spawn_batch_worker(self):
+        pool = mock.Mock()
+        notification_pusher.spawn_batch_worker(pool, 'processed', self.config, 'url', ['task'])
+        pool.spawn.assert_called_once_with(notification_pusher.notification_batch_worker, 'url', ['task'],
+                                           'processed', timeout=5, verify=False)
+
+    def test_dispatch_stale(self):
+        """
+        task that waited too long for a worker goes back to the queue before its TTR expires
+        """
+        task = taken_task()
+        pool = mock.Mock()
+        with mock.patch('source.notification_pusher.time', mock.Mock(return_value=111)):
+            notification_pusher.dispatch_task(task, 100, pool, 'processed', self.config)
+        task.release.assert_called_once_with()
+        self.assertEqual(pool.spawn.call_count, 0)
+
+    def test_dispatch_waits_for_worker(self):
+        pool = Pool(1)
+        pool.spawn(gevent.sleep, 0.01)
+        with mock.patch('source.notification_pusher.notification_worker', mock.Mock()):
+            notification_pusher.dispatch_task(mock.Mock(data={}), notification_pusher.time(), pool, 'processed',
+                                              self.config)
+        self.assertEqual(len(pool), 1)
+        pool.join()
+
+    def test_release_prefetched_tasks(self):
+        prefetched = gevent_queue.Queue()
+        tasks = [taken_task(), taken_task()]
+        for task in tasks:
+            prefetched.put((task, 0))
+        notification_pusher.release_prefetched_tasks(prefetched)
+        for task in tasks:
+            task.release.assert_called_once_with()
+        self.assertTrue(prefetched.empty())
 
 
 class StopHandlerTestCase(unittest.TestCase):
@@ -101,7 +383,7 @@ class DoneWithProcessedTasksTestCase(unittest.TestCase):
         return m_task_queue
 
     def test_done_with_processed_tasks_successed(self):
-        m_task = mock.Mock()
+        m_task = taken_task()
         m_task.task_method = mock.Mock()
 
         notification_pusher.done_with_processed_tasks(self._m_task_queue(mock.Mock(return_value=(m_task, 'task_method'))))
@@ -111,7 +393,7 @@ class DoneWithProcessedTasksTestCase(unittest.TestCase):
     def test_done_with_processed_tasks_db_error(self):
         import tarantool
 
-        m_task = mock.Mock()
+        m_task = taken_task()
         m_task.task_method = mock.Mock(side_effect=tarantool.DatabaseError())
 
         try:
@@ -129,6 +411,140 @@ class DoneWithProcessedTasksTestCase(unittest.TestCase):
             self.fail("gevent_queue.Empty exception must be caught")
 
 
+class RetryTaskTestCase(unittest.TestCase):
+    def setUp(self):
+        notification_pusher.logger = mock.Mock()
+        patcher = mock.patch('source.notification_pusher.retry_policy', TaskRetryPolicy(base_delay=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _task(self, data):
+        task = taken_task(task_id=7, tube='tube', data=data)
+        task.meta = mock.Mock(return_value={'pri': 3, 'ttl': 3600000000, 'ttr': 30000000})
+        return task
+
+    def test_retry_task(self):
+        """
+        copy with the next attempt number is put with a delay, original task is acked
+        """
+        task = self._task({'callback_url': 'url', 'x': 1})
+        notification_pusher.complete_task(task, 'retry')
+
+        task.queue.tube.assert_called_once_with('tube')
+        task.queue.tube.return_value.put.assert_called_once_with(
+            {'callback_url': 'url', 'x': 1, 'pusher_retry': {'attempt': 1, 'task_id': 7}},
+            delay=10, pri=3, ttl=3600, ttr=30
+        )
+        task.ack.assert_called_once_with()
+        self.assertEqual(task.data, {'callback_url': 'url', 'x': 1})
+
+    def test_retry_task_delay_grows(self):
+        task = self._task({'callback_url': 'url', 'pusher_retry': {'attempt': 2, 'task_id': 5}})
+        notification_pusher.complete_task(task, 'retry')
+
+        task.queue.tube.return_value.put.assert_called_once_with(
+            {'callback_url': 'url', 'pusher_retry': {'attempt': 3, 'task_id': 5}},
+            delay=40, pri=3, ttl=3600, ttr=30
+        )
+
+    def test_retry_task_db_error(self):
+        import tarantool
+
+        task = self._task({'callback_url': 'url'})
+        task.queue.tube.return_value.put = mock.Mock(side_effect=tarantool.DatabaseError())
+        notification_pusher.complete_task(task, 'retry')
+        self.assertEqual(task.ack.call_count, 0, "task stays taken and returns to the queue after TTR")
+
+    def test_retry_task_ack_error(self):
+        """
+        copy is deleted when the original task can not be acked, so the task is not duplicated
+        """
+        import tarantool
+
+        task = self._task({'callback_url': 'url'})
+        task.ack = mock.Mock(side_effect=tarantool.DatabaseError())
+        notification_pusher.complete_task(task, 'retry')
+
+        task.queue.tube.return_value.put.return_value.delete.assert_called_once_with()
+        self.assertEqual(notification_pusher.logger.exception.call_count, 1)
+
+
+class AcknowledgeTasksTestCase(unittest.TestCase):
+    def setUp(self):
+        notification_pusher.logger = mock.Mock()
+
+    def _acknowledge(self, task_queue, batch_size):
+        greenlet = gevent.spawn(notification_pusher.acknowledge_tasks, task_queue, batch_size)
+        gevent.sleep(0.01)
+        greenlet.kill()
+
+    def test_acknowledge_tasks_batches(self):
+        """
+        tasks are completed in batches
+        """
+        tasks = [taken_task(task_id=task_id) for task_id in xrange(5)]
+        task_queue = gevent_queue.Queue()
+        for task in tasks:
+            task_queue.put((task, 'ack'))
+        with mock.patch('source.notification_pusher.stats') as stats:
+            self._acknowledge(task_queue, 3)
+
+        for task in tasks:
+            task.ack.assert_called_once_with()
+        self.assertEqual(stats.incr.call_args_list, [mock.call('ack.tasks', 3), mock.call('ack.tasks', 2)])
+        self.assertEqual(stats.timing.call_count, 2)
+
+    def test_acknowledge_tasks_by_connection(self):
+        """
+        each task is completed on the connection that took it, in order within the connection
+        """
+        tubes = [take_tube(), take_tube()]
+        completed = []
+
+        def task_on(tube, task_id):
+            task = mock.Mock(task_id=task_id, queue=tube.queue)
+            task.ack = mock.Mock(side_effect=lambda: completed.append((tube.queue.tarantool_lock._is_owned(), task_id)))
+            return task
+
+        tasks = [task_on(tubes[0], 0), task_on(tubes[1], 1), task_on(tubes[0], 2), task_on(tubes[1], 3)]
+        task_queue = gevent_queue.Queue()
+        for task in tasks:
+            task_queue.put((task, 'ack'))
+        self._acknowledge(task_queue, 10)
+
+        self.assertEqual([task.queue for task in tasks], [tubes[0].queue, tubes[1].queue] * 2)
+        self.assertEqual(sorted(completed), [(True, task_id) for task_id in xrange(4)])
+        self.assertEqual([task_id for _, task_id in completed if task_id % 2 == 0], [0, 2])
+
+    def test_acknowledge_tasks_db_error(self):
+        """
+        one failed action does not stop the rest of the batch
+        """
+        import tarantool
+
+        failed, task = taken_task(task_id=1), taken_task(task_id=2)
+        failed.bury = mock.Mock(side_effect=tarantool.DatabaseError())
+        task_queue = gevent_queue.Queue()
+        task_queue.put((failed, 'bury'))
+        task_queue.put((task, 'ack'))
+        self._acknowledge(task_queue, 10)
+
+        failed.bury.assert_called_once_with()
+        task.ack.assert_called_once_with()
+
+    def test_acknowledge_tasks_connection_error(self):
+        """
+        connection errors stop the acknowledger so the main loop can notice them
+        """
+        task = taken_task(task_id=1)
+        task.ack = mock.Mock(side_effect=IOError())
+        task_queue = gevent_queue.Queue()
+        task_queue.put((task, 'ack'))
+        greenlet = gevent.spawn(notification_pusher.acknowledge_tasks, task_queue, 10)
+        greenlet.join(1)
+        self.assertIsInstance(greenlet.exception, IOError)
+
+
 class NotificationWorkerCaseTest(unittest.TestCase):
     def setUp(self):
         notification_pusher.logger = mock.Mock()
@@ -137,25 +553,142 @@ class NotificationWorkerCaseTest(unittest.TestCase):
             'task_id': 42,
         })
         self.m_task_queue = mock.Mock()
+        patcher = mock.patch('source.notification_pusher.host_guard', mock.Mock())
+        self.host_guard = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('source.notification_pusher.retry_policy', TaskRetryPolicy(max_attempts=3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @mock.patch('source.notification_pusher.current_thread', mock.Mock())
-    @mock.patch('source.notification_pusher.requests', mock.Mock())
+    @mock.patch('source.notification_pusher.http_session', mock.Mock(post=mock.Mock(return_value=mock.Mock(
+        status_code=200))))
     def test_notification_worker_success(self):
         notification_pusher.notification_worker(
             self.worker_task, self.m_task_queue
         )
 
         self.m_task_queue.put.assert_called_once_with((self.worker_task, 'ack'))
+        self.assertEqual(notification_pusher.http_session.post.call_args[0][0], 'url')
+        self.host_guard.release.assert_called_once_with('', False)
 
     @mock.patch('source.notification_pusher.current_thread', mock.Mock())
-    @mock.patch('source.notification_pusher.requests.post',
-                mock.Mock(side_effect=[notification_pusher.requests.RequestException()]))
+    @mock.patch('source.notification_pusher.http_session', mock.Mock(post=mock.Mock(return_value=mock.Mock(
+        status_code=503))))
+    def test_notification_worker_server_error(self):
+        """
+        5xx responses count against the host breaker
+        """
+        notification_pusher.notification_worker(
+            self.worker_task, self.m_task_queue
+        )
+
+        self.m_task_queue.put.assert_called_once_with((self.worker_task, 'ack'))
+        self.host_guard.release.assert_called_once_with('', True)
+
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    @mock.patch('source.notification_pusher.http_session',
+                mock.Mock(post=mock.Mock(side_effect=[notification_pusher.requests.RequestException()])))
     def test_notification_worker_request_exception(self):
+        """
+        failed request is retried through the queue
+        """
         notification_pusher.notification_worker(
             self.worker_task, self.m_task_queue
         )
 
-        self.m_task_queue.put.assert_called_once_with((self.worker_task, 'bury'))
+        self.m_task_queue.put.assert_called_once_with((self.worker_task, 'retry'))
+        self.host_guard.release.assert_called_once_with('', True)
+
+    @mock.patch('source.notification_pusher.current_thread', mock.Mock())
+    @mock.patch('source.notification_pusher.http_session',
+                mock.Mock(post=mock.Mock(side_effect=[notification_pusher.requests.RequestException()])))
+    def test_notification_worker_retries_exhausted(self):
+        """
+        task is buried after the last attempt; retried payload keeps the original task id
+        """
+        task = mock.Mock(task_id=50, data={'callback_url': 'url', 'pusher_retry': {'attempt': 2, 'task_id': 42}})
+        notification_pusher.notification_worker(task, self.m_task_queue)
+
+        self.m_task_queue.put.assert_called_once_with((task, 'bury'))
+        self.assertEqual(json.loads(notification_pusher.http_session.post.call_args[1]['data']), {'id': 42})
+
+
+@mock.patch('source.notification_pusher.current_thread', mock.Mock())
+class NotificationBatchWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        notification_pusher.logger = mock.Mock()
+        patcher = mock.patch('source.notification_pusher.host_guard', mock.Mock())
+        self.host_guard = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('source.notification_pusher.retry_policy', TaskRetryPolicy(max_attempts=3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tasks = [
+            mock.Mock(task_id=1, data={'callback_url': 'http://partner.ru/push', 'x': 1}),
+            mock.Mock(task_id=2, data={'callback_url': 'http://partner.ru/push', 'x': 2,
+                                       'pusher_retry': {'attempt': 2, 'task_id': 20}}),
+        ]
+        self.task_queue = gevent_queue.Queue()
+
+    def _run(self, response=None, error=None):
+        session = mock.Mock(post=mock.Mock(return_value=response, side_effect=error))
+        with mock.patch('source.notification_pusher.http_session', session):
+            notification_pusher.notification_batch_worker('http://partner.ru/push', self.tasks, self.task_queue,
+                                                          timeout=5)
+        return session.post
+
+    def _processed(self):
+        return [self.task_queue.get_nowait() for _ in xrange(self.task_queue.qsize())]
+
+    def test_batch_acked(self):
+        """
+        notifications are sent as one json array, every task is acked
+        """
+        post = self._run(mock.Mock(status_code=200, json=mock.Mock(side_effect=ValueError())))
+
+        self.assertEqual(post.call_args[0][0], 'http://partner.ru/push')
+        self.assertEqual(json.loads(post.call_args[1]['data']), [{'x': 1, 'id': 1}, {'x': 2, 'id': 20}])
+        self.assertEqual(self._processed(), [(self.tasks[0], 'ack'), (self.tasks[1], 'ack')])
+        self.host_guard.release.assert_called_once_with('partner.ru', False)
+
+    def test_batch_rejected_ids(self):
+        """
+        notifications listed as failed by the partner are retried individually
+        """
+        self._run(mock.Mock(status_code=200, json=mock.Mock(return_value={'failed': [1, 20]})))
+
+        self.assertEqual(self._processed(), [(self.tasks[0], 'retry'), (self.tasks[1], 'bury')])
+
+    def test_batch_request_exception(self):
+        self._run(error=notification_pusher.requests.RequestException())
+
+        self.assertEqual(self._processed(), [(self.tasks[0], 'retry'), (self.tasks[1], 'bury')])
+        self.host_guard.release.assert_called_once_with('partner.ru', True)
+
+    def test_batch_server_error(self):
+        """
+        whole batch is retried after a 5xx response, whatever its body
+        """
+        self._run(mock.Mock(status_code=503, json=mock.Mock(return_value={'failed': [1]})))
+
+        self.assertEqual(self._processed(), [(self.tasks[0], 'retry'), (self.tasks[1], 'bury')])
+        self.host_guard.release.assert_called_once_with('partner.ru', True)
+
+    def test_batch_client_error(self):
+        """
+        4xx response is final, as for a single notification
+        """
+        self._run(mock.Mock(status_code=400, json=mock.Mock(side_effect=ValueError())))
+
+        self.assertEqual(self._processed(), [(self.tasks[0], 'ack'), (self.tasks[1], 'ack')])
+        self.host_guard.release.assert_called_once_with('partner.ru', False)
+
+    def test_rejected_notification_ids(self):
+        self.assertEqual(notification_pusher.rejected_notification_ids(mock.Mock(json=mock.Mock(return_value=[1]))),
+                         set())
+        self.assertEqual(notification_pusher.rejected_notification_ids(mock.Mock(json=mock.Mock(return_value={}))),
+                         set())
 
 
 class InstallSignalHandlersTestCase(unittest.TestCase):
@@ -56,15 +56,19 @@ class RedirectCheckerTestCase(unittest.TestCase):
         pid = 42
         config = Config()
         config.SLEEP = 1
-        config.CHECK_URL = 'url'
+        config.STATS_INTERVAL = 60
         config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
         config.WORKER_POOL_SIZE = 50
         mock_spawn_workers = mock.Mock()
-        mock_check_network_status = mock.Mock(return_value=True)
+        mock_prepare_network_prober = mock.Mock(return_value=mock.Mock(up=True))
         children = [mock.Mock()]
         count = config.WORKER_POOL_SIZE - len(children)
         mock_sleep = mock.Mock(side_effect=stop_main_loop)
-        with mock.patch('source.redirect_checker.check_network_status', mock_check_network_status),\
+        context = mock.Mock()
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock_prepare_network_prober),\
+                 mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(context, []))),\
+                 mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
                  mock.patch('os.getpid', mock.Mock(return_value=pid)),\
                  mock.patch('source.redirect_checker.spawn_workers', mock_spawn_workers),\
                  mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=children)),\
@@ -72,26 +76,35 @@ class RedirectCheckerTestCase(unittest.TestCase):
             redirect_checker.main_loop(config)
         self.assert_(mock_spawn_workers.call_args[1]['num'] == count)
         self.assert_(mock_spawn_workers.call_args[1]['parent_pid'] == pid)
+        self.assertEqual(mock_spawn_workers.call_args[1]['args'], (config, context))
         redirect_checker.run = True
 
     def test_main_loop_no_workers(self):
         pid = 42
         config = Config()
         config.SLEEP = 8
-        config.CHECK_URL = 'url'
+        config.STATS_INTERVAL = 60
         config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
         config.WORKER_POOL_SIZE = 2
-        active_children = [mock.Mock() for _ in range(6)]
+        config.DRAIN_TIMEOUT = 5
+        active_children = [mock.Mock(_identity=(identity,)) for identity in (3, 1, 6, 2, 5, 4)]
         mock_spawn_workers = mock.Mock()
-        mock_check_network_status = mock.Mock(return_value=True)
+        mock_prepare_network_prober = mock.Mock(return_value=mock.Mock(up=True))
         mock_sleep = mock.Mock(side_effect=stop_main_loop)
-        with mock.patch('source.redirect_checker.check_network_status', mock_check_network_status),\
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock_prepare_network_prober),\
+                 mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, []))),\
+                 mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
                  mock.patch('os.getpid', mock.Mock(return_value=pid)),\
                  mock.patch('source.redirect_checker.spawn_workers', mock_spawn_workers),\
+                 mock.patch('source.redirect_checker.drain_workers', mock.Mock()) as drain_workers,\
                  mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=active_children)),\
                  mock.patch('source.redirect_checker.sleep', mock_sleep):
             redirect_checker.main_loop(config)
         self.assertEqual(mock_spawn_workers.call_count, 0)
+        stopped = [worker._identity[0] for worker in drain_workers.call_args[0][0]]
+        self.assertEqual(stopped, [3, 4, 5, 6], 'newest workers are stopped')
+        self.assertEqual(drain_workers.call_args[0][1], config.DRAIN_TIMEOUT + config.HTTP_TIMEOUT)
         mock_sleep.assert_called_once_with(config.SLEEP)
         redirect_checker.run = True
 
@@ -99,19 +112,213 @@ class RedirectCheckerTestCase(unittest.TestCase):
         pid = 42
         config = Config()
         config.SLEEP = 8
-        config.CHECK_URL = 'url'
+        config.STATS_INTERVAL = 60
         config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
         config.WORKER_POOL_SIZE = 2
+        config.DRAIN_TIMEOUT = 5
         mock_spawn_workers = mock.Mock()
-        mock_check_network_status = mock.Mock(return_value=False)
+        mock_prepare_network_prober = mock.Mock(return_value=mock.Mock(up=False))
         test_active_children = mock.Mock()
         mock_sleep = mock.Mock(side_effect=stop_main_loop)
-        with mock.patch('source.redirect_checker.check_network_status', mock_check_network_status),\
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock_prepare_network_prober),\
+                 mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, []))),\
+                 mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
                 mock.patch('os.getpid', mock.Mock(return_value=pid)),\
+                mock.patch('source.redirect_checker.drain_workers', mock.Mock()) as drain_workers,\
                 mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=[test_active_children])),\
                 mock.patch('source.redirect_checker.sleep', mock_sleep):
             redirect_checker.main_loop(config)
         self.assertEqual(mock_spawn_workers.call_count, 0)
-        self.assertEqual(test_active_children.terminate.call_count, 1, "Expected only one call")
+        drain_workers.assert_called_once_with([test_active_children], config.DRAIN_TIMEOUT + config.HTTP_TIMEOUT)
+        self.assertEqual(test_active_children.terminate.call_count, 0, "workers are drained, not terminated")
         mock_sleep.assert_called_once_with(config.SLEEP)
-        redirect_checker.run = True
\ No newline at end of file
+        redirect_checker.run = True
+
+    def test_main_loop_cache_stats(self):
+        config = Config()
+        config.SLEEP = 8
+        config.STATS_INTERVAL = 60
+        config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
+        config.WORKER_POOL_SIZE = 0
+        cache = mock.Mock()
+        caches = [(u'Result', cache)]
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock.Mock(return_value=mock.Mock(up=True))),\
+                mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, caches))),\
+                mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
+                mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=[])),\
+                mock.patch('source.redirect_checker.sleep', mock.Mock(side_effect=stop_main_loop)):
+            redirect_checker.main_loop(config)
+        self.assertEqual(cache.stats.call_count, 1)
+        redirect_checker.run = True
+
+    def test_main_loop_gevent_mode(self):
+        """
+        in gevent mode EVENT_LOOP_PROCESSES event loop workers are kept
+        """
+        config = Config()
+        config.SLEEP = 1
+        config.STATS_INTERVAL = 60
+        config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'gevent'
+        config.WORKER_POOL_SIZE = 100
+        config.EVENT_LOOP_PROCESSES = 2
+        mock_spawn_workers = mock.Mock()
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock.Mock(return_value=mock.Mock(up=True))),\
+                mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, []))),\
+                mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
+                mock.patch('source.redirect_checker.spawn_workers', mock_spawn_workers),\
+                mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=[mock.Mock()])),\
+                mock.patch('source.redirect_checker.sleep', mock.Mock(side_effect=stop_main_loop)):
+            redirect_checker.main_loop(config)
+        self.assertEqual(mock_spawn_workers.call_args[1]['num'], 1)
+        self.assertEqual(mock_spawn_workers.call_args[1]['target'], redirect_checker.get_worker(config)[0])
+        self.assertEqual(mock_spawn_workers.call_args[1]['target'].__name__, 'event_loop_worker')
+        redirect_checker.run = True
+
+    def test_main_loop_preloads_worker(self):
+        """
+        supervisor is warmed up as a template before workers are forked from it
+        """
+        config = Config()
+        config.SLEEP = 1
+        config.STATS_INTERVAL = 60
+        config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
+        config.WORKER_POOL_SIZE = 1
+        calls = mock.Mock()
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock.Mock(return_value=mock.Mock(up=True))),\
+                mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, []))),\
+                mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
+                mock.patch('source.redirect_checker.preload_worker', calls.preload_worker),\
+                mock.patch('source.redirect_checker.spawn_workers', calls.spawn_workers),\
+                mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=[])),\
+                mock.patch('source.redirect_checker.sleep', mock.Mock(side_effect=stop_main_loop)):
+            redirect_checker.main_loop(config)
+        self.assertEqual([name for name, _, _ in calls.mock_calls], ['preload_worker', 'spawn_workers'])
+        calls.preload_worker.assert_called_once_with(config)
+        redirect_checker.run = True
+
+    def _autoscaled_main_loop(self, children, scaled_count):
+        config = Config()
+        config.SLEEP = 1
+        config.STATS_INTERVAL = 60
+        config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
+        config.WORKER_POOL_SIZE = 50
+        config.DRAIN_TIMEOUT = 5
+        autoscaler = mock.Mock()
+        autoscaler.clamp = mock.Mock(return_value=len(children))
+        autoscaler.update = mock.Mock(return_value=scaled_count)
+        mock_spawn_workers = mock.Mock()
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock.Mock(return_value=mock.Mock(up=True))),\
+                mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, []))),\
+                mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=autoscaler)),\
+                mock.patch('source.redirect_checker.spawn_workers', mock_spawn_workers),\
+                mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=children)),\
+                mock.patch('source.redirect_checker.sleep', mock.Mock(side_effect=stop_main_loop)):
+            redirect_checker.main_loop(config)
+        redirect_checker.run = True
+        autoscaler.clamp.assert_called_once_with(config.WORKER_POOL_SIZE)
+        autoscaler.update.assert_called_once_with(len(children), [c.pid for c in children])
+        return mock_spawn_workers
+
+    def test_main_loop_autoscale_up(self):
+        children = [mock.Mock(pid=pid) for pid in (11, 12)]
+        mock_spawn_workers = self._autoscaled_main_loop(children, 5)
+        self.assertEqual(mock_spawn_workers.call_args[1]['num'], 3)
+
+    def test_main_loop_autoscale_down(self):
+        """
+        the most recently started extra workers are drained
+        """
+        children = [mock.Mock(pid=pid, _identity=(identity,)) for pid, identity in ((11, 2), (12, 3), (13, 1))]
+        with mock.patch('source.redirect_checker.drain_workers', mock.Mock()) as drain_workers:
+            mock_spawn_workers = self._autoscaled_main_loop(children, 1)
+        self.assertEqual(mock_spawn_workers.call_count, 0)
+        self.assertEqual(drain_workers.call_args[0][0], children[:2])
+
+    def test_prepare_autoscaler(self):
+        config = mock.Mock()
+        autoscaler = mock.Mock()
+        with mock.patch('source.redirect_checker.get_tube', mock.Mock()) as get_tube,\
+                mock.patch('source.redirect_checker.create_autoscaler', mock.Mock(return_value=autoscaler)) as create,\
+                mock.patch('source.redirect_checker.get_worker_concurrency', mock.Mock(return_value=3)),\
+                mock.patch('source.redirect_checker.set_task_meter', mock.Mock()) as set_task_meter:
+            self.assertEqual(redirect_checker.prepare_autoscaler(config), autoscaler)
+        create.assert_called_once_with(config, get_tube.return_value, 3)
+        set_task_meter.assert_called_once_with(autoscaler.meter)
+
+    def test_prepare_network_prober(self):
+        """
+        prober is started and workers report fetch errors to its meter
+        """
+        prober = mock.Mock()
+        with mock.patch('source.redirect_checker.create_network_prober', mock.Mock(return_value=prober)) as create,\
+                mock.patch('source.redirect_checker.set_fetch_meter', mock.Mock()) as set_fetch_meter:
+            self.assertEqual(redirect_checker.prepare_network_prober(mock.Mock()), prober)
+        meter = set_fetch_meter.call_args[0][0]
+        self.assertEqual(create.call_args[0][1], meter)
+        prober.start.assert_called_once_with()
+
+    def test_main_loop_network_recovered(self):
+        """
+        workers are spawned again once the prober reports the network up
+        """
+        config = Config()
+        config.SLEEP = 1
+        config.STATS_INTERVAL = 60
+        config.HTTP_TIMEOUT = 1
+        config.WORKER_MODE = 'process'
+        config.WORKER_POOL_SIZE = 2
+        config.DRAIN_TIMEOUT = 5
+        prober = mock.Mock(up=False)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            prober.up = True
+            if len(sleeps) == 2:
+                stop_main_loop()
+
+        with mock.patch('source.redirect_checker.prepare_network_prober', mock.Mock(return_value=prober)),\
+                mock.patch('source.redirect_checker.prepare_caches', mock.Mock(return_value=(None, []))),\
+                mock.patch('source.redirect_checker.prepare_autoscaler', mock.Mock(return_value=None)),\
+                mock.patch('source.redirect_checker.spawn_workers', mock.Mock()) as spawn_workers,\
+                mock.patch('source.redirect_checker.drain_workers', mock.Mock()) as drain_workers,\
+                mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=[])),\
+                mock.patch('source.redirect_checker.sleep', sleep):
+            redirect_checker.main_loop(config)
+        redirect_checker.run = True
+        drain_workers.assert_called_once_with([], config.DRAIN_TIMEOUT + config.HTTP_TIMEOUT)
+        self.assertEqual(spawn_workers.call_args[1]['num'], 2)
+
+    def test_prepare_caches(self):
+        """
+        caches are created from config and put into the check context, disabled ones are not returned
+        """
+        config = Config()
+        config.RESULT_CACHE_SLOTS = 16
+        config.RESULT_CACHE_SLOT_SIZE = 1024
+        config.RESULT_CACHE_TTL = 60
+        config.HOP_CACHE_SLOTS = 32
+        config.HOP_CACHE_SLOT_SIZE = 512
+        config.HOP_CACHE_TTL = 10
+        config.DNS_CACHE_SLOTS = 0
+        config.DNS_CACHE_SLOT_SIZE = 256
+        config.DNS_CACHE_TTL = 300
+        config.DNS_PREFETCH_THREADS = 2
+        config.INFLIGHT_CACHE_SLOTS = 64
+        config.INFLIGHT_CACHE_SLOT_SIZE = 1024
+        config.INFLIGHT_CACHE_TTL = 30
+        result_cache, hop_cache, inflight_cache = mock.Mock(), mock.Mock(), mock.Mock()
+        with mock.patch('source.redirect_checker.create_shared_cache',
+                        mock.Mock(side_effect=[result_cache, hop_cache, None, inflight_cache])) as create:
+            context, caches = redirect_checker.prepare_caches(config)
+        self.assertEqual(create.call_args_list,
+                         [mock.call(16, 1024, 60), mock.call(32, 512, 10), mock.call(0, 256, 300),
+                          mock.call(64, 1024, 30)])
+        self.assertEqual((context.result_cache, context.hop_cache, context.inflight_cache, context.resolver),
+                         (result_cache, hop_cache, inflight_cache, None))
+        self.assertEqual(caches, [(u'Result', result_cache), (u'Hop', hop_cache)])
@@ -0,0 +1,55 @@
+# coding: utf-8
+import unittest
+
+import mock
+import pycurl
+
+from source.lib.retry import RetryPolicy, TaskRetryPolicy, create_retry_policy, create_task_retry_policy
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    def test_should_retry_transient_error(self):
+        policy = RetryPolicy(retries=2)
+        error = pycurl.error(pycurl.E_COULDNT_CONNECT, 'connection refused')
+        self.assertTrue(policy.should_retry(0, error))
+        self.assertTrue(policy.should_retry(1, error))
+        self.assertFalse(policy.should_retry(2, error))
+
+    def test_should_not_retry_other_errors(self):
+        policy = RetryPolicy(retries=2)
+        self.assertFalse(policy.should_retry(0, pycurl.error(pycurl.E_URL_MALFORMAT, 'bad url')))
+        self.assertFalse(policy.should_retry(0, pycurl.error()))
+        self.assertFalse(policy.should_retry(0, ValueError('bad url')))
+
+    def test_delay_exponential_with_jitter(self):
+        """
+        Пауза случайна, ее верхняя граница растет вдвое до max_delay
+        """
+        policy = RetryPolicy(retries=5, base_delay=0.5, max_delay=3)
+        with mock.patch('source.lib.retry.random.uniform', mock.Mock(side_effect=lambda low, high: high)) as uniform:
+            self.assertEqual([policy.delay(attempt) for attempt in xrange(4)], [0.5, 1.0, 2.0, 3])
+        self.assertEqual(uniform.call_args_list[0], mock.call(0, 0.5))
+
+    def test_create_retry_policy(self):
+        config = mock.Mock(HOP_RETRIES=3, HOP_RETRY_DELAY=0.1, HOP_RETRY_MAX_DELAY=2)
+        policy = create_retry_policy(config)
+        self.assertEqual((policy.retries, policy.base_delay, policy.max_delay), (3, 0.1, 2))
+
+    def test_create_retry_policy_disabled(self):
+        self.assertIsNone(create_retry_policy(mock.Mock(HOP_RETRIES=0)))
+
+
+class TaskRetryPolicyTestCase(unittest.TestCase):
+    def test_should_retry(self):
+        policy = TaskRetryPolicy(max_attempts=3)
+        self.assertEqual([policy.should_retry(attempt) for attempt in xrange(4)], [True, True, False, False])
+        self.assertFalse(TaskRetryPolicy(max_attempts=1).should_retry(0))
+
+    def test_delay_exponential(self):
+        policy = TaskRetryPolicy(base_delay=10, max_delay=60)
+        self.assertEqual([policy.delay(attempt) for attempt in xrange(4)], [10, 20, 40, 60])
+
+    def test_create_task_retry_policy(self):
+        config = mock.Mock(RETRY_MAX_ATTEMPTS=4, RETRY_DELAY=5, RETRY_MAX_DELAY=300)
+        policy = create_task_retry_policy(config)
+        self.assertEqual((policy.max_attempts, policy.base_delay, policy.max_delay), (4, 5, 300))
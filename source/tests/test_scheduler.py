@@ -0,0 +1,48 @@
+# coding: utf-8
+import unittest
+
+from source.lib.scheduler import HostScheduler
+
+
+class HostSchedulerTestCase(unittest.TestCase):
+    def _push(self, scheduler, items):
+        for host, ip, item in items:
+            scheduler.push(host, ip, item)
+
+    def test_round_robin(self):
+        """
+        Хосты обходятся по кругу, а не в порядке постановки в очередь
+        """
+        scheduler = HostScheduler()
+        self._push(scheduler, [('a', None, 1), ('a', None, 2), ('a', None, 3), ('b', None, 4), ('c', None, 5)])
+        self.assertEqual(len(scheduler), 5)
+        self.assertEqual([scheduler.pop()[2] for _ in xrange(5)], [1, 4, 5, 2, 3])
+        self.assertIsNone(scheduler.pop())
+        self.assertEqual(len(scheduler), 0)
+
+    def test_host_limit(self):
+        scheduler = HostScheduler(host_limit=2)
+        self._push(scheduler, [('a', None, 1), ('a', None, 2), ('a', None, 3), ('b', None, 4)])
+        self.assertEqual([scheduler.pop()[2] for _ in xrange(3)], [1, 4, 2])
+        self.assertIsNone(scheduler.pop())
+        scheduler.done('a', None)
+        self.assertEqual(scheduler.pop(), ('a', None, 3))
+
+    def test_ip_limit(self):
+        """
+        Разные хосты на одном ip делят лимит ip
+        """
+        scheduler = HostScheduler(host_limit=5, ip_limit=1)
+        self._push(scheduler, [('a', '1.1.1.1', 1), ('b', '1.1.1.1', 2), ('c', None, 3)])
+        self.assertEqual(scheduler.pop(), ('a', '1.1.1.1', 1))
+        self.assertEqual(scheduler.pop(), ('c', None, 3))
+        self.assertIsNone(scheduler.pop())
+        scheduler.done('a', '1.1.1.1')
+        self.assertEqual(scheduler.pop(), ('b', '1.1.1.1', 2))
+
+    def test_done_forgets_idle_hosts(self):
+        scheduler = HostScheduler(host_limit=1, ip_limit=1)
+        scheduler.push('a', '1.1.1.1', 1)
+        scheduler.pop()
+        scheduler.done('a', '1.1.1.1')
+        self.assertEqual((dict(scheduler.host_active), dict(scheduler.ip_active)), ({}, {}))
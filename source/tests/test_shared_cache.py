@@ -0,0 +1,148 @@
+# coding: utf-8
+from multiprocessing import Event, Process
+import os
+import signal
+import time
+import unittest
+
+import mock
+
+from source.lib import shared_cache
+
+
+def put_in_cache(cache, key, value):
+    cache.set(key, value)
+
+
+def hold_lock(cache, locked):
+    with cache.lock:
+        locked.set()
+        time.sleep(60)
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = shared_cache.SharedCache(slots=4, slot_size=256, ttl=10, ways=2)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_set(self):
+        value = ([u'http_status'], [u'http://a.ru/', u'http://b.ru/'], ['YA_METRICA'])
+        self.assertIsNone(self.cache.get('http://a.ru/'))
+        self.assertTrue(self.cache.set('http://a.ru/', value))
+        self.assertEqual(self.cache.get('http://a.ru/'), value)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (1, 1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_overwrite(self):
+        self.cache.set('key', 1)
+        self.cache.set('key', 2)
+        self.assertEqual(self.cache.get('key'), 2)
+        self.assertEqual(self.cache.stats()['evictions'], 0)
+
+    def test_ttl(self):
+        with mock.patch('source.lib.shared_cache.time', mock.Mock(return_value=100)):
+            self.cache.set('key', 'value')
+        with mock.patch('source.lib.shared_cache.time', mock.Mock(return_value=109)):
+            self.assertEqual(self.cache.get('key'), 'value')
+        with mock.patch('source.lib.shared_cache.time', mock.Mock(return_value=110)):
+            self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.stats()['expired'], 1)
+
+    def test_lru_eviction(self):
+        """
+        Из заполненного набора вытесняется запись, к которой дольше не обращались
+        """
+        cache = shared_cache.SharedCache(slots=2, slot_size=256, ttl=10, ways=2)
+        with mock.patch('source.lib.shared_cache.time', mock.Mock(side_effect=[1, 2, 3, 4, 5, 5, 5])):
+            cache.set('first', 1)
+            cache.set('second', 2)
+            cache.get('first')
+            cache.set('third', 3)
+            self.assertEqual(cache.get('first'), 1)
+            self.assertIsNone(cache.get('second'))
+            self.assertEqual(cache.get('third'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_too_big(self):
+        self.assertFalse(self.cache.set('key', 'x' * 1000))
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.stats()['too_big'], 1)
+
+    def test_add(self):
+        """
+        add не перезаписывает действующую запись, но занимает устаревшую
+        """
+        with mock.patch('source.lib.shared_cache.time', mock.Mock(return_value=100)):
+            self.assertTrue(self.cache.add('key', 1, ttl=5))
+            self.assertFalse(self.cache.add('key', 2))
+            self.assertEqual(self.cache.get('key'), 1)
+        with mock.patch('source.lib.shared_cache.time', mock.Mock(return_value=106)):
+            self.assertTrue(self.cache.add('key', 3))
+            self.assertEqual(self.cache.get('key'), 3)
+
+    def test_delete(self):
+        self.cache.set('key', 'value')
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_shared_between_processes(self):
+        """
+        Запись, сделанная в дочернем процессе, видна в родительском
+        """
+        process = Process(target=put_in_cache, args=(self.cache, 'key', 'from child'))
+        process.start()
+        process.join()
+        self.assertEqual(self.cache.get('key'), 'from child')
+
+    def test_lock_released_by_killed_process(self):
+        """
+        Процесс, убитый посреди операции с кэшем, не оставляет его заблокированным
+        """
+        locked = Event()
+        holder = Process(target=hold_lock, args=(self.cache, locked))
+        holder.start()
+        self.assertTrue(locked.wait(5))
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+
+        writer = Process(target=put_in_cache, args=(self.cache, 'key', 'after kill'))
+        writer.start()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(self.cache.get('key'), 'after kill')
+
+    def test_corrupt_slot(self):
+        """
+        Испорченный слот - промах, слот освобождается
+        """
+        self.cache.set('key', 'value')
+        offset = self.cache._find(self.cache._hash('key'), time.time())
+        data_offset = offset + shared_cache.SLOT_HEADER.size
+        self.cache.mm[data_offset:data_offset + 4] = 'junk'
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.stats()['corrupt'], 1)
+        self.assertIsNone(self.cache._find(self.cache._hash('key'), time.time()))
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_overwrite_keeps_one_slot(self):
+        """
+        Ключ перезаписывается в своем слоте, даже если перед ним в наборе освободился другой
+        """
+        cache = shared_cache.SharedCache(slots=2, slot_size=256, ttl=10, ways=2)
+        cache.set('other', 1)
+        cache.set('key', 1)
+        cache.delete('other')
+        cache.set('key', 2)
+        key_hash = cache._hash('key')
+        slots = [shared_cache.SLOT_HEADER.unpack_from(cache.mm, offset)[0] for offset in cache._set_offsets(key_hash)]
+        self.assertEqual(slots.count(key_hash), 1)
+        self.assertEqual(cache.get('key'), 2)
+
+    def test_create_shared_cache(self):
+        self.assertIsNone(shared_cache.create_shared_cache(0, 256, 10))
+        cache = shared_cache.create_shared_cache(16, 256, 10)
+        self.assertEqual((cache.sets * cache.ways, cache.slot_size, cache.ttl), (16, 256, 10))
@@ -0,0 +1,43 @@
+# coding: utf-8
+import unittest
+
+import mock
+
+from source.lib.stats import Stats
+
+
+class StatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats = Stats()
+
+    def test_snapshot(self):
+        self.stats.incr('hit')
+        self.stats.incr('hit', 2)
+        self.stats.timing('fetch', 1.0)
+        self.stats.timing('fetch', 3.0)
+        self.assertEqual(self.stats.snapshot(), {
+            'hit': 3,
+            'fetch.count': 2,
+            'fetch.avg': 2.0,
+            'fetch.max': 3.0,
+        })
+
+    def test_gauge(self):
+        self.stats.gauge('open', 2)
+        self.stats.gauge('open', 1)
+        self.assertEqual(self.stats.snapshot(), {'open': 1})
+        self.stats.reset()
+        self.assertEqual(self.stats.snapshot(), {})
+
+    def test_ratio(self):
+        self.assertEqual(self.stats.ratio('hit', 'miss'), 0.0)
+        self.stats.incr('hit', 3)
+        self.stats.incr('miss')
+        self.assertEqual(self.stats.ratio('hit', 'miss'), 0.75)
+
+    def test_report_interval(self):
+        logger = mock.Mock()
+        with mock.patch('source.lib.stats.time', mock.Mock(return_value=self.stats.reported_at + 5)):
+            self.assertFalse(self.stats.report(logger, 10))
+            self.assertTrue(self.stats.report(logger, 5))
+        self.assertEqual(logger.info.call_count, 1)
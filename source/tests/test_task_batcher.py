@@ -0,0 +1,103 @@
+# coding: utf-8
+import unittest
+
+import mock
+from tarantool.error import DatabaseError
+
+from source.lib.task_batcher import TaskBatcher
+
+
+class TaskBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.input_tube = mock.Mock()
+        self.output_tube = mock.Mock()
+        self.calls = mock.Mock()
+        self.output_tube.put = self.calls.put
+
+    def _task(self, task_id):
+        task = mock.Mock()
+        task.task_id = task_id
+        task.ack = getattr(self.calls, 'ack{}'.format(task_id))
+        return task
+
+    def test_take_batch(self):
+        """
+        Ждем только первую задачу, остальные забираем без ожидания
+        """
+        self.input_tube.take = mock.Mock(side_effect=[1, 2, 3, 4])
+        batcher = TaskBatcher(self.input_tube, batch_size=3)
+        self.assertEqual(batcher.take(0.1), [1, 2, 3])
+        self.assertEqual(self.input_tube.take.call_args_list, [mock.call(0.1), mock.call(0), mock.call(0)])
+
+    def test_take_not_ready(self):
+        self.input_tube.take = mock.Mock(side_effect=[1, None])
+        batcher = TaskBatcher(self.input_tube, batch_size=3)
+        self.assertEqual(batcher.take(0.1), [1])
+
+    def test_take_empty(self):
+        self.input_tube.take = mock.Mock(return_value=None)
+        batcher = TaskBatcher(self.input_tube, batch_size=3)
+        self.assertEqual(batcher.take(0.1), [])
+        self.assertEqual(self.input_tube.take.call_count, 1)
+
+    def test_flush_on_size(self):
+        """
+        Результаты кладутся в очередь до подтверждения задач
+        """
+        batcher = TaskBatcher(self.input_tube, batch_size=2, flush_interval=100)
+        batcher.done(self._task(1), self.output_tube, 'data1')
+        self.assertEqual(self.calls.mock_calls, [])
+        batcher.done(self._task(2), self.output_tube, 'data2', pri=3)
+        self.assertEqual(self.calls.mock_calls, [
+            mock.call.put('data1'), mock.call.put('data2', pri=3), mock.call.ack1(), mock.call.ack2()
+        ])
+        self.assertEqual(batcher.pending, [])
+
+    def test_flush_on_time(self):
+        batcher = TaskBatcher(self.input_tube, batch_size=10, flush_interval=1)
+        with mock.patch('source.lib.task_batcher.time', mock.Mock(side_effect=[100.5, 101, 101, 101])):
+            batcher.flushed_at = 100
+            batcher.done(self._task(1))
+            batcher.flush_if_due()
+            self.assertEqual(self.calls.mock_calls, [])
+            batcher.flush_if_due()
+        self.assertEqual(self.calls.mock_calls, [mock.call.ack1()])
+
+    def test_ack_error(self):
+        batcher = TaskBatcher(self.input_tube)
+        task = self._task(1)
+        task.ack = mock.Mock(side_effect=DatabaseError)
+        with mock.patch('source.lib.task_batcher.logger') as logger:
+            batcher.done(task, self.output_tube, 'data')
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(self.calls.mock_calls, [mock.call.put('data')])
+
+    def test_touch_stale(self):
+        """
+        Задача, ждавшая в пачке дольше половины ttr, продлевается перед проверкой
+        """
+        tasks = [self._task(task_id) for task_id in (1, 2, 3)]
+        self.input_tube.take = mock.Mock(side_effect=tasks)
+        batcher = TaskBatcher(self.input_tube, batch_size=3, ttr=60)
+        with mock.patch('source.lib.task_batcher.time', mock.Mock(return_value=100)):
+            batcher.take(0.1)
+        self.assertEqual(set(batcher.taken_at), {2, 3})
+
+        with mock.patch('source.lib.task_batcher.time', mock.Mock(return_value=125)):
+            self.assertTrue(batcher.start(tasks[0]))
+            self.assertTrue(batcher.start(tasks[1]))
+        self.assertFalse(tasks[1].touch.called)
+
+        tasks[2].touch.side_effect = DatabaseError
+        with mock.patch('source.lib.task_batcher.time', mock.Mock(return_value=131)):
+            self.assertFalse(batcher.start(tasks[2]))
+        tasks[2].touch.assert_called_once_with()
+        self.assertEqual(batcher.taken_at, {})
+
+    def test_touch_ok(self):
+        task = self._task(2)
+        batcher = TaskBatcher(self.input_tube, batch_size=2, ttr=60)
+        batcher.taken_at[2] = 100
+        with mock.patch('source.lib.task_batcher.time', mock.Mock(return_value=130)):
+            self.assertTrue(batcher.start(task))
+        task.touch.assert_called_once_with()
@@ -1,4 +1,6 @@
 __author__ = 'Ruslan'
+import multiprocessing
+import signal
 import unittest
 import mock
 from mock import patch, Mock
@@ -165,6 +167,13 @@ class SpawnWorkersTestCase(unittest.TestCase):
             utils.spawn_workers(num, "target", args, num)
             self.assertFalse(mock_process.called)
 
+    def test_sort_by_start(self):
+        """
+        Test workers are ordered by creation, not by pid
+        """
+        workers = [multiprocessing.Process(target=None) for _ in xrange(3)]
+        self.assertEqual(utils.sort_by_start([workers[1], workers[2], workers[0]]), workers)
+
 
 class ForOneTestTestCase(unittest.TestCase):
     def setUp(self):
@@ -213,4 +222,56 @@ class ForOneTestTestCase(unittest.TestCase):
         Test work with exception
         """
         with patch('urllib2.urlopen', Mock(side_effect=ValueError("network status fail"))):
-            self.assertFalse(utils.check_network_status(Mock(), 10))
\ No newline at end of file
+            self.assertFalse(utils.check_network_status(Mock(), 10))
+
+class ParentDeathTestCase(unittest.TestCase):
+    def test_set_parent_death_signal(self):
+        libc = mock.Mock()
+        libc.prctl = mock.Mock(return_value=0)
+        with mock.patch('source.lib.utils.ctypes.CDLL', mock.Mock(return_value=libc)):
+            self.assertTrue(utils.set_parent_death_signal(signal.SIGTERM))
+        libc.prctl.assert_called_once_with(utils.PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0)
+
+    def test_set_parent_death_signal_failed(self):
+        libc = mock.Mock()
+        libc.prctl = mock.Mock(return_value=-1)
+        with mock.patch('source.lib.utils.ctypes.CDLL', mock.Mock(return_value=libc)):
+            self.assertFalse(utils.set_parent_death_signal(signal.SIGTERM))
+
+    def test_set_parent_death_signal_without_prctl(self):
+        with mock.patch('source.lib.utils.ctypes.CDLL', mock.Mock(side_effect=OSError)):
+            self.assertFalse(utils.set_parent_death_signal(signal.SIGTERM))
+
+    def test_parent_is_alive(self):
+        with mock.patch('os.getppid', mock.Mock(return_value=42)):
+            self.assertTrue(utils.parent_is_alive(42))
+            self.assertFalse(utils.parent_is_alive(43))
+
+
+class HostLoadTestCase(unittest.TestCase):
+    def test_get_load_per_cpu(self):
+        with mock.patch('os.getloadavg', mock.Mock(return_value=(6.0, 1.0, 1.0))),\
+                mock.patch('source.lib.utils.cpu_count', mock.Mock(return_value=4)):
+            self.assertEqual(utils.get_load_per_cpu(), 1.5)
+
+    def test_get_load_per_cpu_unavailable(self):
+        with mock.patch('os.getloadavg', mock.Mock(side_effect=OSError)):
+            self.assertIsNone(utils.get_load_per_cpu())
+
+    def test_get_rss(self):
+        """
+        resident pages of alive processes are summed, exited ones are skipped
+        """
+        def open_statm(path):
+            if path == '/proc/2/statm':
+                raise IOError('no such process')
+            return mock.MagicMock(__enter__=mock.Mock(return_value=mock.Mock(read=mock.Mock(return_value='100 25 3'))))
+
+        with mock.patch('source.lib.utils.open', mock.Mock(side_effect=open_statm), create=True),\
+                mock.patch('os.path.exists', mock.Mock(return_value=True)),\
+                mock.patch('os.sysconf', mock.Mock(return_value=4096)):
+            self.assertEqual(utils.get_rss([1, 2, 3]), 2 * 25 * 4096)
+
+    def test_get_rss_without_proc(self):
+        with mock.patch('os.path.exists', mock.Mock(return_value=False)):
+            self.assertIsNone(utils.get_rss([1]))
@@ -1,10 +1,34 @@
 # coding=utf-8
 __author__ = 'Ruslan'
 from tarantool import DatabaseError
+import os
+import signal
+import sys
+import time
 import unittest
+
+import gevent
 import mock
 
-from source.lib import worker
+from source.lib import CheckContext, worker
+
+
+class FakeDrain(object):
+    """Drain без сигналов: остановка запрашивается вызовом request"""
+    def __init__(self, *args):
+        self.requested = False
+
+    def install(self):
+        pass
+
+    def request(self, *args, **kwargs):
+        self.requested = True
+
+    def run(self, func, *args):
+        return func(*args)
+
+    def check_deadline(self):
+        pass
 
 
 class GetRedirectHistoryFromTaskTestCase(unittest.TestCase):
@@ -52,6 +76,116 @@ class GetRedirectHistoryFromTaskTestCase(unittest.TestCase):
                          'check_type': 'normal', 'suspicious': task.data['suspicious']}
         self._get_redirect_history(task, data_modified, m_return, False)
 
+    def test_get_redirect_history_from_task_fetch_recorded(self):
+        """
+        Ошибки загрузки учитываются в общем метре для проверки сети
+        """
+        meter = mock.Mock()
+        for m_return in ([['ERROR'], [], []], [['http_status'], [], []]):
+            task = mock.Mock()
+            task.data = {'url': 'http://example.net', 'recheck': True, 'url_id': 'this is id'}
+            with mock.patch('source.lib.worker.fetch_meter', meter),\
+                    mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=m_return)):
+                worker.get_redirect_history_from_task(task, 1)
+        self.assertEqual(meter.record.call_args_list, [mock.call(True), mock.call(False)])
+
+
+class PrepareWorkerTestCase(unittest.TestCase):
+    @mock.patch('source.lib.worker.create_retry_policy')
+    @mock.patch('source.lib.worker.create_curl_pool')
+    def test_prepare_worker(self, m_create_curl_pool, m_create_retry_policy):
+        """
+        Окружение от супервизора дополняется частью, своей у каждого воркера; кэши остаются общими
+        """
+        config = mock.Mock(COUNTER_RULES=[('YA_METRICA', 'watch.js')], HTTP_HEAD_BYTES_LIMIT=10,
+                           HTTP_BODY_BYTES_LIMIT=20)
+        cache = mock.Mock()
+        context = CheckContext(result_cache=cache)
+        worker.prepare_worker(config, context)
+        m_create_curl_pool.assert_called_once_with(config)
+        m_create_retry_policy.assert_called_once_with(config)
+        self.assertEqual((context.handle_pool, context.retry_policy, context.head_limit, context.body_limit),
+                         (m_create_curl_pool.return_value, m_create_retry_policy.return_value, 10, 20))
+        self.assertEqual(context.counter_detector.detect('watch.js'), ['YA_METRICA'])
+        self.assertIs(context.result_cache, cache)
+
+
+class CheckTaskTestCase(unittest.TestCase):
+    def test_check_task_recorded(self):
+        """
+        Время проверки задачи учитывается в общем метре, в том числе при ошибке
+        """
+        meter = mock.Mock()
+        task = mock.MagicMock()
+        with mock.patch('source.lib.worker.task_meter', meter),\
+                mock.patch('source.lib.worker.time', mock.Mock(side_effect=[1.0, 3.0, 5.0, 5.5])),\
+                mock.patch('source.lib.worker.logger'),\
+                mock.patch('source.lib.worker.get_redirect_history_from_task',
+                           mock.Mock(side_effect=[(False, {}), ValueError('boom')])):
+            self.assertEqual(worker.check_task(task, mock.Mock(), CheckContext()), (False, {}))
+            self.assertRaises(ValueError, worker.check_task, task, mock.Mock(), CheckContext())
+        self.assertEqual(meter.record.call_args_list, [mock.call(2.0), mock.call(0.5)])
+
+
+class PreloadWorkerTestCase(unittest.TestCase):
+    def _preload_worker(self, mode):
+        config = mock.Mock()
+        config.WORKER_MODE = mode
+        with mock.patch('source.lib.worker.codecs.lookup') as lookup,\
+                mock.patch('source.lib.worker.check_for_meta_with_soup') as check_for_meta_with_soup,\
+                mock.patch('source.lib.worker.import_module') as import_module,\
+                mock.patch('source.lib.worker.pkg_resources.require') as require:
+            worker.preload_worker(config)
+        lookup.assert_called_once_with('idna')
+        self.assertEqual(check_for_meta_with_soup.call_count, 1)
+        return import_module, require
+
+    def test_preload_process_worker(self):
+        import_module, require = self._preload_worker(worker.WORKER_MODE_PROCESS)
+        self.assertFalse(import_module.called)
+        self.assertFalse(require.called)
+
+    def test_preload_event_loop_worker(self):
+        """
+        Для gevent-воркеров заранее загружается то, что нужно patch_all
+        """
+        import_module, require = self._preload_worker(worker.WORKER_MODE_GEVENT)
+        self.assertEqual([args[0] for args, _ in import_module.call_args_list],
+                         list(worker.GEVENT_PATCHED_MODULES) + [worker.GEVENT_PLUGINS_MODULE])
+        require.assert_called_once_with('gevent')
+
+    def test_preload_old_gevent(self):
+        """
+        Модули, которых нет в установленной версии gevent, пропускаются, как и плагины до gevent 1.3
+        """
+        def import_module(name):
+            if name != 'gevent.socket':
+                raise ImportError('No module named ' + name)
+
+        with mock.patch('source.lib.worker.import_module', mock.Mock(side_effect=import_module)),\
+                mock.patch('source.lib.worker.pkg_resources.require') as require:
+            worker.preload_worker(mock.Mock(WORKER_MODE=worker.WORKER_MODE_GEVENT))
+            self.assertEqual(worker.import_existing_modules(['gevent.socket', 'gevent.time']), ['gevent.socket'])
+        self.assertFalse(require.called)
+
+    def test_preload_installed_gevent(self):
+        """
+        Прогрев с установленной версией gevent: все ее модули из GEVENT_PATCHED_MODULES загружены
+        """
+        with mock.patch('source.lib.worker.logger'):
+            worker.preload_worker(mock.Mock(WORKER_MODE=worker.WORKER_MODE_GEVENT))
+        existing = [name for name in worker.GEVENT_PATCHED_MODULES
+                    if os.path.exists(os.path.join(os.path.dirname(gevent.__file__), name.split('.')[1] + '.py'))]
+        self.assertIn('gevent.socket', existing)
+        self.assertEqual([name for name in existing if name not in sys.modules], [])
+
+    def test_worker_ready(self):
+        with mock.patch('source.lib.worker.time', mock.Mock(return_value=10.5)),\
+                mock.patch('source.lib.worker.stats') as stats,\
+                mock.patch('source.lib.worker.logger'):
+            worker.worker_ready(10.0)
+        stats.timing.assert_called_once_with('worker.startup', 0.5)
+
 
 class WorkerTestCase(unittest.TestCase):
     def setUp(self):
@@ -60,20 +194,29 @@ class WorkerTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
-    def _worker(self, tube_side, exists_return, get_redirect_history_from_task_return):
+    def _worker(self, tube_side, exists_return, get_redirect_history_from_task_return, drain=None, batch_size=1):
         parent_pid = 33
         config = mock.MagicMock()
+        config.QUEUE_BATCH_SIZE = batch_size
+        config.QUEUE_FLUSH_INTERVAL = 0
+        config.QUEUE_TASK_TTR = 60
         with mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=tube_side)), \
-                mock.patch('os.path.exists', mock.Mock(side_effect=exists_return)),\
+                mock.patch('source.lib.worker.Drain', mock.Mock(return_value=drain or FakeDrain())), \
+                mock.patch('source.lib.worker.parent_is_alive', mock.Mock(side_effect=exists_return)),\
+                mock.patch('source.lib.worker.set_parent_death_signal', mock.Mock()) as set_parent_death_signal,\
                 mock.patch('source.lib.worker.get_redirect_history_from_task',
                            mock.Mock(return_value=get_redirect_history_from_task_return)) \
                 as get_redirect_history_from_task,\
-                mock.patch('source.lib.worker.logger', mock.Mock()) as logger:
+                mock.patch('source.lib.worker.prepare_worker', mock.Mock()) as prepare_worker,\
+                mock.patch('source.lib.worker.logger', mock.Mock()) as logger,\
+                mock.patch('source.lib.task_batcher.logger', logger):
 
-            worker.worker(config, parent_pid)
+            worker.worker(config, CheckContext(), parent_pid)
 
         # Потенциально сюда можно складывать все необходимые к проверке mock'и
         return {'get_redirect_history_from_task': get_redirect_history_from_task,
+                'prepare_worker': prepare_worker,
+                'set_parent_death_signal': set_parent_death_signal,
                 'logger': logger}
 
     def test_worker_parent_is_dead(self):
@@ -88,6 +231,69 @@ class WorkerTestCase(unittest.TestCase):
         mocks = self._worker([input_tube, output_tube], exists_side_effect, None)
         self.assertFalse(input_tube.called)
 
+    def test_worker_prepared(self):
+        """
+        worker is configured before taking tasks
+        """
+        tube = mock.MagicMock()
+        mocks = self._worker([tube, tube], [False], None)
+        self.assertEqual(mocks['prepare_worker'].call_count, 1)
+
+    def test_worker_parent_death_signal(self):
+        """
+        worker asks the kernel to terminate it when the parent dies
+        """
+        tube = mock.MagicMock()
+        mocks = self._worker([tube, tube], [False], None)
+        mocks['set_parent_death_signal'].assert_called_once_with(signal.SIGTERM)
+
+    def test_worker_drain(self):
+        """
+        После запроса остановки воркер не берет новые задачи, а взятые, но не начатые, возвращает в очередь
+        """
+        class DrainAfterCheck(FakeDrain):
+            def run(self, func, *args):
+                result = func(*args)
+                self.requested = True
+                return result
+
+        tube = mock.MagicMock()
+        tasks = [mock.MagicMock(), mock.MagicMock()]
+        tube.take = mock.Mock(side_effect=tasks)
+        with mock.patch('source.lib.worker.release_task') as release_task:
+            mocks = self._worker([tube, tube], [True] * 5, (False, {}), DrainAfterCheck(), batch_size=2)
+        self.assertEqual(tube.take.call_count, 2)
+        self.assertEqual(mocks['get_redirect_history_from_task'].call_count, 1)
+        self.assertTrue(tasks[0].ack.called)
+        release_task.assert_called_once_with(tasks[1])
+        mocks['logger'].info.assert_called_with('Worker drained. exiting')
+
+    def test_worker_drain_timeout(self):
+        """
+        Проверка, прерванная по сроку остановки, возвращается в очередь, а не завершается
+        """
+        class TimedOutDrain(FakeDrain):
+            def run(self, func, *args):
+                self.requested = True
+                raise worker.DrainTimeout()
+
+        tube = mock.MagicMock()
+        task = mock.MagicMock()
+        tube.take = mock.Mock(return_value=task)
+        with mock.patch('source.lib.worker.release_task') as release_task:
+            self._worker([tube, tube], [True] * 5, (False, {}), TimedOutDrain())
+        release_task.assert_called_once_with(task)
+        self.assertFalse(task.ack.called)
+        self.assertEqual(tube.put.call_count, 0)
+
+    def test_release_task(self):
+        task = mock.MagicMock()
+        task.release = mock.Mock(side_effect=DatabaseError)
+        with mock.patch('source.lib.worker.logger') as logger:
+            worker.release_task(task)
+        task.release.assert_called_once_with()
+        self.assertTrue(logger.exception.called)
+
     def test_worker_task_is_none(self):
         """
         task is none
@@ -139,4 +345,220 @@ class WorkerTestCase(unittest.TestCase):
         tube.take = mock.Mock(return_value=task)
         task.ack = mock.Mock(side_effect=DatabaseError)
         mocks = self._worker([tube, tube], (True, False), None)
-        self.assertTrue(mocks['logger'].exception.called)
\ No newline at end of file
+        self.assertTrue(mocks['logger'].exception.called)
+
+class EventLoopWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = mock.MagicMock()
+        self.config.WORKER_POOL_SIZE = 4
+        self.config.EVENT_LOOP_PROCESSES = 2
+        self.config.QUEUE_BATCH_SIZE = 10
+        self.config.QUEUE_FLUSH_INTERVAL = 0
+        self.config.QUEUE_TAKE_TIMEOUT = 1
+        self.config.ENGINE_HOST_CONCURRENCY = 3
+        self.config.ENGINE_IP_CONCURRENCY = 5
+        self.input_tube = mock.MagicMock()
+        self.output_tube = mock.MagicMock()
+        self.drain = FakeDrain()
+
+    def _task(self, task_id):
+        task = mock.MagicMock()
+        task.task_id = task_id
+        return task
+
+    def _event_loop_worker(self, check_side_effect):
+        with mock.patch('source.lib.worker.parent_is_alive', mock.Mock(side_effect=[True, False])):
+            self._run_event_loop_worker(check_side_effect)
+
+    def _run_event_loop_worker(self, check_side_effect):
+        context = CheckContext()
+        with mock.patch('source.lib.worker.patch_all', mock.Mock()) as patch_all,\
+                mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[self.input_tube, self.output_tube])),\
+                mock.patch('source.lib.worker.set_parent_death_signal', mock.Mock()) as set_parent_death_signal,\
+                mock.patch('source.lib.worker.get_redirect_history_from_task',
+                           mock.Mock(side_effect=check_side_effect)),\
+                mock.patch('source.lib.worker.prepare_worker', mock.Mock()),\
+                mock.patch('source.lib.worker.Drain', mock.Mock(return_value=self.drain)),\
+                mock.patch('source.lib.worker.logger', mock.Mock()),\
+                mock.patch('source.lib.task_batcher.logger', mock.Mock()):
+            worker.event_loop_worker(self.config, context, 33)
+        self.assertTrue(patch_all.called)
+        set_parent_death_signal.assert_called_once_with(signal.SIGTERM)
+        self.assertIsInstance(context.performer, worker.GeventCurlPerformer)
+        self.assertEqual((context.performer.scheduler.host_limit, context.performer.scheduler.ip_limit), (3, 5))
+
+    def test_tasks_checked_concurrently(self):
+        """
+        Берется не больше задач, чем свободных гринлетов в пуле
+        """
+        tasks = [self._task(task_id) for task_id in xrange(3)]
+        self.input_tube.take = mock.Mock(side_effect=tasks)
+        self._event_loop_worker(lambda task, *args: (False, task.task_id))
+        self.assertEqual(self.input_tube.take.call_count, 2)
+        self.assertEqual(self.output_tube.put.call_args_list, [mock.call(0), mock.call(1)])
+        self.assertTrue(tasks[0].ack.called and tasks[1].ack.called)
+        self.assertFalse(tasks[2].ack.called)
+
+    def test_wait_for_free_greenlet(self):
+        """
+        Когда свободных гринлетов нет, воркер ждет завершения проверки, а не таймаута
+        """
+        self.config.WORKER_POOL_SIZE = 2
+        task = self._task(1)
+        self.input_tube.take = mock.Mock(side_effect=[task])
+
+        def check(task, *args):
+            gevent.sleep(0.01)
+            return False, task.task_id
+
+        with mock.patch('source.lib.worker.parent_is_alive', mock.Mock(side_effect=[True, True, False])):
+            started = time.time()
+            self._run_event_loop_worker(check)
+        self.assertLess(time.time() - started, self.config.QUEUE_TAKE_TIMEOUT)
+        self.assertEqual(self.input_tube.take.call_count, 1)
+        self.assertTrue(task.ack.called)
+
+    def test_failed_task_released(self):
+        task = self._task(1)
+        self.input_tube.take = mock.Mock(side_effect=[task, None])
+        self._event_loop_worker(Exception('boom'))
+        task.release.assert_called_once_with(delay=self.config.RECHECK_DELAY)
+        self.assertFalse(task.ack.called)
+        self.assertFalse(self.output_tube.put.called)
+
+    def test_drain_interrupts_checks(self):
+        """
+        Проверки, не закончившиеся за DRAIN_TIMEOUT, прерываются, их задачи возвращаются в очередь
+        """
+        tasks = [self._task(task_id) for task_id in xrange(2)]
+        self.input_tube.take = mock.Mock(side_effect=tasks)
+        self.config.DRAIN_TIMEOUT = 0.01
+
+        def check(task, *args):
+            if task.task_id == 0:
+                return False, 0
+            self.drain.requested = True
+            gevent.sleep(10)
+
+        with mock.patch('source.lib.worker.parent_is_alive', mock.Mock(return_value=True)):
+            self._run_event_loop_worker(check)
+        self.assertTrue(tasks[0].ack.called)
+        tasks[1].release.assert_called_once_with()
+        self.assertFalse(tasks[1].ack.called)
+
+    def test_get_worker(self):
+        self.config.WORKER_MODE = worker.WORKER_MODE_GEVENT
+        self.assertEqual(worker.get_worker(self.config), (worker.event_loop_worker, 2))
+        self.config.WORKER_MODE = worker.WORKER_MODE_ENGINE
+        self.assertEqual(worker.get_worker(self.config), (worker.engine_worker, 2))
+        self.config.WORKER_MODE = worker.WORKER_MODE_PROCESS
+        self.assertEqual(worker.get_worker(self.config), (worker.worker, 4))
+
+    def test_get_worker_concurrency(self):
+        self.config.WORKER_MODE = worker.WORKER_MODE_GEVENT
+        self.assertEqual(worker.get_worker_concurrency(self.config), 2)
+        self.config.WORKER_MODE = worker.WORKER_MODE_ENGINE
+        self.assertEqual(worker.get_worker_concurrency(self.config), 2)
+        self.config.WORKER_MODE = worker.WORKER_MODE_PROCESS
+        self.assertEqual(worker.get_worker_concurrency(self.config), 1)
+
+    def test_get_tasks_in_flight(self):
+        self.assertEqual(worker.get_tasks_in_flight(self.config), 2)
+        self.config.EVENT_LOOP_PROCESSES = 8
+        self.assertEqual(worker.get_tasks_in_flight(self.config), 1)
+
+
+class FakeEngine(object):
+    """RedirectEngine, который заканчивает проверку урла за steps[url] шагов (по умолчанию за один)"""
+    def __init__(self, steps=None):
+        self.steps = steps or {}
+        self.checks = []
+        self.added = []
+        self.max_checks = 0
+        self.closed = False
+
+    def add(self, url, callback):
+        self.added.append(url)
+        self.checks.append([url, callback, self.steps.get(url, 1)])
+        self.max_checks = max(self.max_checks, len(self.checks))
+
+    def has_work(self):
+        return bool(self.checks)
+
+    def step(self, select_timeout):
+        for check in self.checks[:]:
+            check[2] -= 1
+            if not check[2]:
+                self.checks.remove(check)
+                check[1](([], [check[0]], []))
+
+    def close(self):
+        self.closed = True
+
+
+class EngineWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = mock.MagicMock()
+        self.config.WORKER_POOL_SIZE = 4
+        self.config.EVENT_LOOP_PROCESSES = 2
+        self.config.QUEUE_BATCH_SIZE = 10
+        self.config.QUEUE_FLUSH_INTERVAL = 0
+        self.input_tube = mock.MagicMock()
+        self.output_tube = mock.MagicMock()
+        self.drain = FakeDrain()
+
+    def _task(self, task_id):
+        task = mock.MagicMock()
+        task.task_id = task_id
+        task.data = {'url': 'http://{}.ru/'.format(task_id), 'url_id': task_id, 'recheck': False}
+        return task
+
+    def _engine_worker(self, tasks, engine, alive):
+        queued = list(tasks)
+        self.input_tube.take = mock.Mock(side_effect=lambda timeout: queued.pop(0) if queued else None)
+        context = CheckContext()
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[self.input_tube, self.output_tube])),\
+                mock.patch('source.lib.worker.parent_is_alive', mock.Mock(side_effect=alive)),\
+                mock.patch('source.lib.worker.set_parent_death_signal', mock.Mock()),\
+                mock.patch('source.lib.worker.prepare_worker', mock.Mock()) as prepare_worker,\
+                mock.patch('source.lib.worker.create_redirect_engine', mock.Mock(return_value=engine)) as create,\
+                mock.patch('source.lib.worker.Drain', mock.Mock(return_value=self.drain)),\
+                mock.patch('source.lib.worker.logger', mock.Mock()),\
+                mock.patch('source.lib.task_batcher.logger', mock.Mock()):
+            worker.engine_worker(self.config, context, 33)
+        prepare_worker.assert_called_once_with(self.config, context)
+        create.assert_called_once_with(self.config, context.handle_pool, context)
+
+    def test_tasks_checked_in_engine(self):
+        """
+        Задачи проверяются в движке по несколько, новые берутся по мере завершения старых
+        """
+        tasks = [self._task(task_id) for task_id in xrange(3)]
+        engine = FakeEngine({'http://0.ru/': 3})
+        self._engine_worker(tasks, engine, [True, True, True, False])
+        self.assertEqual(engine.added, ['http://0.ru/', 'http://1.ru/', 'http://2.ru/'])
+        self.assertEqual(engine.max_checks, 2)
+        self.assertEqual([args[0]['url_id'] for args, _ in self.output_tube.put.call_args_list], [1, 2, 0])
+        self.assertEqual(self.output_tube.put.call_args_list[0][0][0]['result'], [[], ['http://1.ru/'], []])
+        self.assertTrue(all(task.ack.called for task in tasks))
+        self.assertTrue(engine.closed)
+
+    def test_drain_releases_unfinished(self):
+        """
+        Проверки, не закончившиеся за DRAIN_TIMEOUT после сигнала, бросаются, их задачи возвращаются в очередь
+        """
+        self.config.DRAIN_TIMEOUT = 0
+        tasks = [self._task(task_id) for task_id in xrange(2)]
+        engine = FakeEngine({'http://0.ru/': 100})
+        step = engine.step
+
+        def step_and_drain(select_timeout):
+            step(select_timeout)
+            self.drain.requested = True
+
+        engine.step = step_and_drain
+        self._engine_worker(tasks, engine, mock.Mock(return_value=True))
+        tasks[0].release.assert_called_once_with()
+        self.assertFalse(tasks[0].ack.called)
+        self.assertTrue(tasks[1].ack.called)
+        self.assertTrue(engine.closed)